@@ -0,0 +1,174 @@
+"""
+Admission control: requests to expensive routes take a slot in a lane of limited concurrency, so uploads,
+downloads and long lists cannot take every worker thread from the cheap reads. Clients and authors can also be
+rate limited with token buckets. A request that would have to wait past its queue budget is turned away with a
+503 and Retry-After instead of adding to the pile.
+"""
+from collections import Counter, OrderedDict
+import math, threading, time
+
+# Most token buckets kept in memory. The least recently used are dropped first, which only forgets a full bucket.
+MAX_BUCKETS = 100000
+
+class Rejected(Exception):
+    def __init__(self, status, message, retryAfter):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retryAfter = retryAfter
+
+class TokenBuckets:
+    """Token buckets in process memory: each key earns rate tokens a second, up to burst, and a request spends one."""
+    def __init__(self, maxEntries=MAX_BUCKETS):
+        self.maxEntries = maxEntries
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst, now=None):
+        """Spends a token of key's bucket and returns 0, or returns the seconds until one is there."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            tokens, updatedAt = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updatedAt) * rate)
+            waited = tokens < 1
+            self.buckets[key] = (tokens if waited else tokens - 1, now)
+            if len(self.buckets) > self.maxEntries:
+                self.buckets.popitem(last=False)
+        return (1 - tokens) / rate if waited else 0
+
+class RedisTokenBuckets:
+    """
+    Shares the limits between processes through anything with the redis-py incr/expire API. Each key may spend
+    burst tokens per window of burst / rate seconds, a fixed window that lets through at most twice the burst
+    across a window boundary but costs a single round trip.
+    """
+    def __init__(self, client, prefix="hypeclips:limit:"):
+        self.client = client
+        self.prefix = prefix
+
+    def take(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        window = burst / rate
+        start = now - now % window
+        windowKey = f"{self.prefix}{key}:{int(start / window)}"
+        spent = self.client.incr(windowKey)
+        if spent == 1:
+            self.client.expire(windowKey, math.ceil(window))
+        return 0 if spent <= burst else start + window - now
+
+class Lane:
+    """At most limit requests at once. The rest wait for a slot as long as their queue budget allows."""
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.slots = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+
+    def acquire(self, timeout):
+        with self.lock:
+            self.waiting += 1
+        try:
+            acquired = self.slots.acquire(timeout=max(timeout, 0))
+        finally:
+            with self.lock:
+                self.waiting -= 1
+                self.active += acquired
+        return acquired
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+        self.slots.release()
+
+def queuedSeconds(requestStart, now=None):
+    """
+    How long a request waited before reaching the app, from the X-Request-Start header a front proxy adds
+    ("t=" and a Unix time in seconds, milliseconds or microseconds, as nginx, Heroku and New Relic write it).
+    """
+    if not requestStart:
+        return 0.0
+    try:
+        start = float(requestStart.strip().removeprefix("t="))
+    except ValueError:
+        return 0.0
+    while start > 1e11:
+        start /= 1000
+    return max(0.0, (time.time() if now is None else now) - start)
+
+class AdmissionControl:
+    """
+    Decides whether a request is served. routeLanes maps endpoints to the name of their lane, and limits holds
+    (rate, burst) for "client" and "author", with a rate of 0 meaning unlimited. Rejections are counted by
+    reason and endpoint.
+    """
+    def __init__(self, lanes, routeLanes, buckets, limits, queueBudget):
+        self.lanes = {lane.name: lane for lane in lanes}
+        self.routeLanes = routeLanes
+        self.buckets = buckets
+        self.limits = limits
+        self.queueBudget = queueBudget
+        self.lock = threading.Lock()
+        self.rejections = Counter()
+
+    def reject(self, reason, endpoint, status, message, retryAfter):
+        with self.lock:
+            self.rejections[(reason, endpoint)] += 1
+        return Rejected(status, message, max(1, math.ceil(retryAfter)))
+
+    def limit(self, kind, key, endpoint):
+        # Raises Rejected once key has used up its bucket. An unreachable shared backend lets requests through.
+        rate, burst = self.limits[kind]
+        if not rate:
+            return
+        try:
+            wait = self.buckets.take(f"{kind}:{key}", rate, burst)
+        except Exception:
+            return
+        if wait:
+            raise self.reject(f"{kind}_rate", endpoint, 429, "too many requests, slow down", wait)
+
+    def admit(self, endpoint, client, requestStart=None):
+        """
+        Returns the Lane the request now holds a slot of, or None for a route without one. Raises Rejected if the
+        client is over its rate, or if the request waited longer than the queue budget before or in its lane.
+        """
+        self.limit("client", client, endpoint)
+        remaining = self.queueBudget - queuedSeconds(requestStart)
+        if remaining <= 0:
+            raise self.reject("queue_time", endpoint, 503, "the server is too busy, try again", 1)
+        lane = self.lanes.get(self.routeLanes.get(endpoint))
+        if lane is not None and not lane.acquire(remaining):
+            raise self.reject("lane_full", endpoint, 503, "the server is too busy, try again", 1)
+        return lane
+
+    def release(self, lane):
+        if lane is not None:
+            lane.release()
+
+    def stats(self):
+        with self.lock:
+            rejections = {}
+            for (reason, endpoint), count in self.rejections.items():
+                rejections.setdefault(reason, {})[endpoint] = count
+        return {"lanes": {name: {"limit": lane.limit, "active": lane.active, "waiting": lane.waiting}
+                          for name, lane in self.lanes.items()},
+                "rejections": rejections}
+
+    def render(self):
+        # The rejection counters in the Prometheus text format, for GET /metrics
+        lines = ["# TYPE hypeclips_rejected_requests_total counter"]
+        with self.lock:
+            for (reason, endpoint), count in sorted(self.rejections.items()):
+                lines.append(f'hypeclips_rejected_requests_total{{reason="{reason}",endpoint="{endpoint}"}} {count}')
+        lines.append("# TYPE hypeclips_lane_active_requests gauge")
+        for name, lane in sorted(self.lanes.items()):
+            lines.append(f'hypeclips_lane_active_requests{{lane="{name}"}} {lane.active}')
+        return "\n".join(lines) + "\n"
+
+def createTokenBuckets(name, redisUrl):
+    if name == "redis":
+        import redis
+        return RedisTokenBuckets(redis.Redis.from_url(redisUrl))
+    return TokenBuckets()
@@ -0,0 +1,448 @@
+"""
+Serves the app over ASGI, so a process can hold thousands of slow clip downloads and chunk uploads at once:
+
+    uvicorn asgi:asgiApp --workers 2
+
+Clip downloads, resumable upload chunks, comment streams, logins and registrations are handled here on the event
+loop, reading the same models through an async session. Every other request, and every download or chunk that would not succeed (a
+missing clip, a 304, a chunk out of order...), is passed to the Flask app on a worker thread once its body has
+arrived, so the responses are exactly those of the Flask routes.
+"""
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_etags, parse_range_header
+from application import ADMITTED_ENVIRON_KEY, COMMENT_STREAM_HEADERS, app, db, admission, metrics, passwordHasher, sessionTokens, storage, viewCounter, checkSession, clipFile, commentEvent, countPlayback, newCommentEvent, openCommentStream, Clip, Rendition, UploadSession, User
+from admission import Rejected
+from auth import HasherBusy, needsRehash
+from database import createAsyncEngine
+from mp4 import InvalidMp4, Mp4Parser
+from streaming import CHUNK_SIZE, immutableHeaders, rangesFor, resolveRanges
+from transcoding import ORIGINAL_RENDITION
+from uploads import ChunkTooLarge, appendChunkAsync, truncateUpload
+from urllib.parse import parse_qs
+import asyncio, json, os, re, sys, tempfile, time
+
+CLIP_PATH = re.compile(r"^/clips/(\d+)$")
+CHUNK_PATH = re.compile(r"^/uploads/([^/]+)/chunks/(\d+)$")
+COMMENT_STREAM_PATH = re.compile(r"^/comments/(\d+)/stream$")
+SIGN_IN_PATHS = {"/login": "login", "/register": "register"}
+# Login and registration bodies are a username and a password, so anything longer is not one
+MAX_CREDENTIALS_SIZE = 64 * 1024
+# Request bodies passed to Flask are kept in memory up to this size, and in a temporary file beyond it
+SPOOL_SIZE = 1024 * 1024
+
+class ClientDisconnected(Exception):
+    pass
+
+async def requestBody(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        yield message.get("body", b"")
+        if not message.get("more_body", False):
+            break
+
+async def disconnection(receive):
+    # Returns once the client has gone, for responses that would otherwise only notice when they next write
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+def isJson(headers):
+    # As Flask's request.is_json decides it
+    mimetype = headers.get("Content-Type", "").split(";")[0].strip().lower()
+    return mimetype == "application/json" or (mimetype.startswith("application/") and mimetype.endswith("+json"))
+
+def asgiHeaders(headers):
+    return [(name.lower().encode("latin-1"), str(value).encode("latin-1")) for name, value in headers]
+
+def requestHeaders(scope):
+    return Headers([(name.decode("latin-1"), value.decode("latin-1")) for name, value in scope["headers"]])
+
+async def sendJson(send, status, body, headers=None):
+    data = json.dumps(body).encode()
+    await send({"type": "http.response.start", "status": status, "headers": asgiHeaders(
+        [("Content-Type", "application/json"), ("Content-Length", len(data))] + list((headers or {}).items()))})
+    await send({"type": "http.response.body", "body": data})
+
+async def sendRejection(send, rejection):
+    await sendJson(send, rejection.status, {"status": rejection.message}, {"Retry-After": str(rejection.retryAfter)})
+
+def wsgiEnviron(scope, body, length):
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": (scope.get("server") or ("localhost", 80))[0],
+        "SERVER_PORT": str((scope.get("server") or ("localhost", 80))[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    # The body has been read in full by now, which also covers chunked requests that came without a length
+    environ["CONTENT_LENGTH"] = str(length)
+    return environ
+
+class AsgiApplication:
+    def __init__(self, flaskApp):
+        self.flaskApp = flaskApp
+        self.engine = None
+        self.sessionFactory = None
+
+    def session(self):
+        # The engine is made on first use, once the Flask app's configuration is final
+        if self.engine is None:
+            with self.flaskApp.app_context():
+                url = db.engine.url
+            self.engine = createAsyncEngine(self.flaskApp, url)
+            self.sessionFactory = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        return self.sessionFactory()
+
+    async def close(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        try:
+            clipMatch = CLIP_PATH.match(scope["path"]) if scope["method"] == "GET" else None
+            chunkMatch = CHUNK_PATH.match(scope["path"]) if scope["method"] == "PUT" else None
+            commentMatch = COMMENT_STREAM_PATH.match(scope["path"]) if scope["method"] == "GET" else None
+            signInEndpoint = SIGN_IN_PATHS.get(scope["path"]) if scope["method"] == "POST" else None
+            if clipMatch is None and chunkMatch is None and commentMatch is None and signInEndpoint is None:
+                await self.callFlask(scope, receive, send)
+                return
+            # Admitted here for the whole response, including when Flask answers instead, so the lane's slot is
+            # held until the last byte and the request is only counted once
+            endpoint = "getClipById" if clipMatch else "addUploadChunk" if chunkMatch else \
+                "streamComments" if commentMatch else signInEndpoint
+            try:
+                lane = await asyncio.to_thread(admission.admit, endpoint,
+                    (scope.get("client") or ("", 0))[0], requestHeaders(scope).get("X-Request-Start"))
+            except Rejected as rejection:
+                await sendRejection(send, rejection)
+                return
+            try:
+                if clipMatch and await self.streamClip(scope, send, int(clipMatch.group(1))):
+                    return
+                if chunkMatch and await self.receiveChunk(scope, receive, send, chunkMatch.group(1), int(chunkMatch.group(2))):
+                    return
+                if commentMatch and await self.streamComments(scope, receive, send, int(commentMatch.group(1))):
+                    return
+                if signInEndpoint:
+                    await self.signIn(scope, receive, send, signInEndpoint == "register")
+                    return
+                await self.callFlask(scope, receive, send, admitted=True)
+            finally:
+                admission.release(lane)
+        except ClientDisconnected:
+            pass
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                # Counts still in memory would otherwise wait for the exit handler. A failed flush is logged and kept for it.
+                try:
+                    await asyncio.to_thread(viewCounter.flush)
+                except Exception:
+                    pass
+                await self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def observe(self, scope, route, start, bytesSent=0, endpoint=None):
+        # The Flask request hooks never see these requests, so they are recorded here
+        if self.flaskApp.config["INSTRUMENTATION"]:
+            metrics.observeRequest(scope["method"], route, time.perf_counter() - start, 0, 0.0)
+            if bytesSent:
+                metrics.addBytesSent(endpoint, bytesSent)
+
+    async def streamClip(self, scope, send, clipId):
+        """Sends a clip, or one range of it, and returns False for any other outcome so Flask answers instead."""
+        start = time.perf_counter()
+        # The redirect to a presigned URL and the front proxy's own sending are both Flask's to answer
+        if self.flaskApp.config.get("SENDFILE_MODE") or storage.redirects:
+            return False
+        headers = requestHeaders(scope)
+        name = parse_qs(scope["query_string"].decode("latin-1")).get("rendition", [None])[0]
+
+        async with self.session() as session:
+            clip = await session.get(Clip, clipId)
+            if clip is None:
+                return False
+            rendition = (await session.execute(select(Rendition).filter_by(clipId=clip.id,
+                name=name or ORIGINAL_RENDITION))).scalars().first()
+        if rendition is None and name is not None:
+            return False
+
+        key, etag = clipFile(clip, rendition)
+        path = storage.path(key)
+        if parse_etags(headers.get("If-None-Match")).contains_weak(etag) or not os.path.exists(path):
+            return False
+        countPlayback(clip.id, ((scope.get("client") or ("", 0))[0], headers.get("User-Agent", "")), headers.get("Range"))
+
+        size = os.path.getsize(path)
+        ranges = rangesFor(parse_range_header(headers.get("Range")), headers.get("If-Range"), etag)
+        responseHeaders = list(immutableHeaders(etag).items()) + [("Content-Type", "video/mp4")]
+        if ranges is None:
+            status, begin, end = 200, 0, size
+        else:
+            ranges = resolveRanges(ranges, size)
+            # Unsatisfiable and multipart ranges are rare enough to leave to Flask
+            if len(ranges) != 1:
+                return False
+            status, (begin, end) = 206, ranges[0]
+            responseHeaders.append(("Content-Range", f"bytes {begin}-{end - 1}/{size}"))
+        responseHeaders.append(("Content-Length", end - begin))
+
+        await send({"type": "http.response.start", "status": status, "headers": asgiHeaders(responseHeaders)})
+        sent = 0
+        file = await asyncio.to_thread(open, path, "rb")
+        try:
+            await asyncio.to_thread(file.seek, begin)
+            while sent < end - begin:
+                chunk = await asyncio.to_thread(file.read, min(CHUNK_SIZE, end - begin - sent))
+                if not chunk:
+                    break
+                sent += len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            await asyncio.to_thread(file.close)
+        await send({"type": "http.response.body", "body": b""})
+        self.observe(scope, "/clips/<clipid>", start, sent, "getClipById")
+        return True
+
+    async def receiveChunk(self, scope, receive, send, uploadId, index):
+        """Appends one chunk of a resumable upload, or returns False before reading the body so Flask answers instead."""
+        start = time.perf_counter()
+        headers = requestHeaders(scope)
+        offset = headers.get("Upload-Offset", type=int)
+        checksum = headers.get("X-Chunk-Checksum")
+        if offset is None or checksum is None:
+            return False
+
+        async with self.session() as session:
+            upload = await session.get(UploadSession, uploadId)
+            if upload is None or index != upload.nextChunk or offset != upload.offset:
+                return False
+            if checkSession(headers.get("Authorization", ""), upload.authorId) is not None:
+                return False
+            try:
+                admission.limit("author", upload.authorId, "addUploadChunk")
+            except Rejected as rejection:
+                await sendRejection(send, rejection)
+                return True
+
+            try:
+                written, digest = await appendChunkAsync(requestBody(receive), upload.getPartPath(), upload.offset,
+                    min(self.flaskApp.config["MAX_CHUNK_SIZE"], upload.size - upload.offset), Mp4Parser() if index == 0 else None)
+            except ChunkTooLarge:
+                await sendJson(send, 413, {"status": "the chunk is too large"})
+                return True
+            except InvalidMp4:
+                await sendJson(send, 400, {"status": "the file had the wrong format"})
+                return True
+            except Exception:
+                # The part file holds the chunks before this one, so it is cut back to them rather than removed
+                await asyncio.to_thread(truncateUpload, upload.getPartPath(), upload.offset)
+                raise
+
+            if written == 0:
+                await sendJson(send, 400, {"status": "the chunk was empty"})
+                return True
+            if digest != checksum.lower():
+                await asyncio.to_thread(truncateUpload, upload.getPartPath(), upload.offset)
+                await sendJson(send, 400, {"status": "the chunk checksum did not match"})
+                return True
+
+            upload.offset += written
+            upload.nextChunk += 1
+            await session.commit()
+
+        await sendJson(send, 200, upload.progress())
+        self.observe(scope, "/uploads/<uploadid>/chunks/<int:index>", start)
+        return True
+
+    async def signIn(self, scope, receive, send, register):
+        """
+        Logs in or registers like the Flask routes, awaiting the password hash so no thread but the hasher's is
+        held while it runs. Requests whose body is not credentials as JSON strings are passed on to Flask.
+        """
+        start = time.perf_counter()
+        received = b""
+        async for data in requestBody(receive):
+            received += data
+            if len(received) > MAX_CREDENTIALS_SIZE:
+                await sendJson(send, 413, {"status": "the request is too large"})
+                return
+        try:
+            credentials = json.loads(received) if isJson(requestHeaders(scope)) else None
+        except ValueError:
+            credentials = None
+        if not isinstance(credentials, dict) or not all(isinstance(credentials.get(name), str) for name in ("username", "password")):
+            await self.callFlask(scope, receive, send, admitted=True, received=received)
+            return
+        try:
+            if register:
+                status, body = await self.register(credentials["username"], credentials["password"])
+            else:
+                status, body = await self.login(credentials["username"], credentials["password"])
+        except HasherBusy:
+            await sendJson(send, 503, {"status": "too many logins at once, try again"}, {"Retry-After": "1"})
+            return
+        await sendJson(send, status, body)
+        self.observe(scope, "/register" if register else "/login", start)
+
+    async def login(self, username, password):
+        async with self.session() as session:
+            user = (await session.execute(select(User).filter_by(username=username))).scalars().first()
+        if not await passwordHasher.verifyAsync(password, None if user is None else user.password):
+            return 404, {"status": "not a valid login"}
+
+        # Passwords stored before hashing, or hashed at a lower cost, are rehashed while the password is at hand
+        if needsRehash(user.password, passwordHasher.cost):
+            try:
+                rehashed = await passwordHasher.hashAsync(password)
+                async with self.session() as session:
+                    await session.execute(update(User).where(User.id == user.id).values(password=rehashed))
+                    await session.commit()
+            except HasherBusy:
+                pass
+        return 200, {"id": user.id, "token": sessionTokens.issue(user.id)}
+
+    async def register(self, username, password):
+        async with self.session() as session:
+            taken = (await session.execute(select(User.id).filter_by(username=username))).first() is not None
+        if taken:
+            return 400, {"status": "unsuccessful registration: user with username already exists"}
+        if len(username) > 20:
+            return 400, {"status": "unsuccessful registration: username too long"}
+        if len(password) > 40:
+            return 400, {"status": "unsuccessful registration: password too long"}
+
+        user = User(username=username, password=await passwordHasher.hashAsync(password))
+        async with self.session() as session:
+            session.add(user)
+            try:
+                await session.commit()
+            except IntegrityError:
+                # Someone registered the same name while the password was hashed
+                return 400, {"status": "unsuccessful registration: user with username already exists"}
+        return 200, {"id": user.id, "token": sessionTokens.issue(user.id)}
+
+    def openCommentStream(self, clipId, since, loop):
+        with self.flaskApp.app_context():
+            return openCommentStream(clipId, since, loop)
+
+    async def streamComments(self, scope, receive, send, clipId):
+        """
+        Sends a clip's comments as Server-Sent Events like the Flask route, waiting for them on the event loop
+        rather than on a thread. Returns False for a missing clip so Flask answers instead.
+        """
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        since = requestHeaders(scope).get("Last-Event-ID") or \
+            parse_qs(scope["query_string"].decode("latin-1")).get("since", [""])[0]
+        opened = await asyncio.to_thread(self.openCommentStream, clipId, since, loop)
+        if opened is None:
+            return False
+        subscription, missed = opened
+        deadline = loop.time() + self.flaskApp.config["COMMENT_STREAM_DURATION"]
+        keepalive = self.flaskApp.config["COMMENT_STREAM_KEEPALIVE"]
+        sent = {record["id"] for record in missed}
+        disconnected = asyncio.ensure_future(disconnection(receive))
+        try:
+            await send({"type": "http.response.start", "status": 200, "headers": asgiHeaders(
+                [("Content-Type", "text/event-stream; charset=utf-8")] + list(COMMENT_STREAM_HEADERS.items()))})
+            events = "retry: 1000\n\n" + "".join(commentEvent(record) for record in missed)
+            while True:
+                if events:
+                    await send({"type": "http.response.body", "body": events.encode(), "more_body": True})
+                if loop.time() >= deadline:
+                    break
+                message = asyncio.ensure_future(subscription.get(min(keepalive, max(deadline - loop.time(), 0))))
+                await asyncio.wait({message, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    message.cancel()
+                    return True
+                events = newCommentEvent(message.result(), sent)
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.cancel()
+            # Unsubscribing from Redis is a round trip
+            await asyncio.to_thread(subscription.close)
+        self.observe(scope, "/comments/<clipid>/stream", start)
+        return True
+
+    async def callFlask(self, scope, receive, send, admitted=False, received=None):
+        # The whole body is collected before a thread is taken, so a slow upload only costs the thread
+        # for as long as the Flask view runs. received is the body if it has been read already.
+        body = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        length = 0
+        if received is not None:
+            length = len(received)
+            body.write(received)
+        else:
+            async for data in requestBody(receive):
+                length += len(data)
+                if length > self.flaskApp.config["MAX_CONTENT_LENGTH"]:
+                    body.close()
+                    await sendJson(send, 413, {"status": "the request is too large"})
+                    return
+                await asyncio.to_thread(body.write, data)
+        body.seek(0)
+
+        started = {}
+
+        def startResponse(status, headers, excInfo=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = headers
+
+        try:
+            environ = wsgiEnviron(scope, body, length)
+            environ[ADMITTED_ENVIRON_KEY] = admitted
+            result = await asyncio.to_thread(self.flaskApp, environ, startResponse)
+            try:
+                iterator = iter(result)
+                chunk = await asyncio.to_thread(next, iterator, None)
+                await send({"type": "http.response.start", "status": started["status"],
+                            "headers": asgiHeaders(started["headers"])})
+                while chunk is not None:
+                    if chunk:
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                    chunk = await asyncio.to_thread(next, iterator, None)
+                await send({"type": "http.response.body", "body": b""})
+            finally:
+                if hasattr(result, "close"):
+                    await asyncio.to_thread(result.close)
+        finally:
+            body.close()
+
+asgiApp = AsgiApplication(app)
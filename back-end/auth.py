@@ -0,0 +1,126 @@
+from concurrent.futures import ThreadPoolExecutor
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+import asyncio, base64, hashlib, hmac, os, threading, time, uuid
+
+HASH_PREFIX = "$scrypt$"
+SALT_SIZE = 16
+HASH_SIZE = 32
+# scrypt's block size and parallelism. The cost (log2 of N) is the setting to tune: each step doubles both the
+# time a hash takes and the memory it needs, 128 * BLOCK_SIZE * 2**cost bytes.
+BLOCK_SIZE = 8
+PARALLELISM = 1
+
+def encodeBytes(data):
+    return base64.b64encode(data).decode().rstrip("=")
+
+def decodeBytes(text):
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+def scrypt(password, salt, cost, blockSize, parallelism):
+    return hashlib.scrypt(password.encode(), salt=salt, n=2 ** cost, r=blockSize, p=parallelism,
+        maxmem=128 * blockSize * (2 ** cost + parallelism + 2) + 2 ** 20, dklen=HASH_SIZE)
+
+def hashPassword(password, cost):
+    """Hashes a password into a self-describing string: $scrypt$ln=<cost>,r=<block size>,p=<parallelism>$<salt>$<hash>"""
+    salt = os.urandom(SALT_SIZE)
+    digest = scrypt(password, salt, cost, BLOCK_SIZE, PARALLELISM)
+    return f"{HASH_PREFIX}ln={cost},r={BLOCK_SIZE},p={PARALLELISM}${encodeBytes(salt)}${encodeBytes(digest)}"
+
+def hashParameters(stored):
+    parameters, salt, digest = stored[len(HASH_PREFIX):].split("$")
+    values = dict(parameter.split("=") for parameter in parameters.split(","))
+    return int(values["ln"]), int(values["r"]), int(values["p"]), decodeBytes(salt), decodeBytes(digest)
+
+def verifyPassword(password, stored):
+    # Rows from before passwords were hashed hold the password itself
+    if not stored.startswith(HASH_PREFIX):
+        return hmac.compare_digest(password.encode(), stored.encode())
+    cost, blockSize, parallelism, salt, digest = hashParameters(stored)
+    return hmac.compare_digest(scrypt(password, salt, cost, blockSize, parallelism), digest)
+
+def needsRehash(stored, cost):
+    return not stored.startswith(HASH_PREFIX) or hashParameters(stored)[:3] != (cost, BLOCK_SIZE, PARALLELISM)
+
+class HasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords on a pool of its own threads. Each hash takes tens of milliseconds of CPU and
+    megabytes of memory on purpose, so only workers run at once and at most backlog more wait for them. Past
+    that HasherBusy is raised rather than letting a burst of logins queue up every request thread.
+
+    hash and verify wait for the result on the calling thread, as a WSGI worker has to. hashAsync and
+    verifyAsync await it instead, so under asgi.py a login holds no thread but the pool's while it is hashed.
+    """
+    def __init__(self, cost, workers, backlog):
+        self.cost = cost
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="password")
+        self.slots = threading.BoundedSemaphore(workers + backlog)
+        # Checked when the username does not exist, so a login takes as long either way
+        self.decoy = hashPassword(uuid.uuid4().hex, cost)
+
+    def run(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            return self.pool.submit(function, *args).result()
+        finally:
+            self.slots.release()
+
+    async def runAsync(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            return await asyncio.wrap_future(self.pool.submit(function, *args))
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self.run(hashPassword, password, self.cost)
+
+    def verify(self, password, stored):
+        return self.run(verifyPassword, password, self.decoy if stored is None else stored) and stored is not None
+
+    async def hashAsync(self, password):
+        return await self.runAsync(hashPassword, password, self.cost)
+
+    async def verifyAsync(self, password, stored):
+        return await self.runAsync(verifyPassword, password, self.decoy if stored is None else stored) and stored is not None
+
+class SessionTokens:
+    """
+    Stateless session tokens: the user id and a token id, signed with the secret key and timestamped. Checking
+    one costs an HMAC and a lookup in revoked, without touching the database. revoked is a cache backend, so
+    revocations live as long as the token would have, or until the LRU pushes them out.
+    """
+    def __init__(self, secretKey, ttl, revoked):
+        self.serializer = URLSafeTimedSerializer(secretKey, salt="session")
+        self.ttl = ttl
+        self.revoked = revoked
+
+    def issue(self, userId):
+        return self.serializer.dumps({"id": userId, "jti": uuid.uuid4().hex})
+
+    def read(self, token):
+        # Returns the token's payload and the time it was issued, or None if it is not a valid token any more
+        try:
+            payload, issuedAt = self.serializer.loads(token, max_age=self.ttl, return_timestamp=True)
+        except (BadSignature, SignatureExpired):
+            return None
+        if self.revoked.get(f"revoked:{payload['jti']}") is not None:
+            return None
+        return payload, issuedAt
+
+    def verify(self, token):
+        session = self.read(token)
+        return None if session is None else session[0]["id"]
+
+    def revoke(self, token):
+        session = self.read(token)
+        if session is None:
+            return False
+        payload, issuedAt = session
+        remaining = self.ttl - (time.time() - issuedAt.timestamp())
+        self.revoked.set(f"revoked:{payload['jti']}", "1", ttl=max(1, int(remaining) + 1))
+        return True
@@ -0,0 +1,81 @@
+"""
+Measures what authentication costs: logins per second at a password hash cost, with more clients than hashing
+threads, and the time a session token check adds to every write. Run it from the back-end folder:
+
+    python auth_benchmark.py --costs 12,14,16 --threads 16
+"""
+from unittest import mock
+from application import app, db, sessionTokens, User
+from auth import PasswordHasher, hashPassword
+from benchmark import percentile
+from concurrent.futures import ThreadPoolExecutor
+import os, shutil, tempfile, time, click
+
+def measureLogins(cost, users, logins, threads, workers, backlog):
+    hasher = PasswordHasher(cost, workers, backlog)
+    with mock.patch("application.passwordHasher", hasher):
+        db.session.query(User).delete()
+        password = hashPassword("benchmark", cost)
+        db.session.add_all(User(username=f"user{id}", password=password) for id in range(1, users + 1))
+        db.session.commit()
+
+        def login(index):
+            # Every fourth login has the wrong password, which costs the same hash
+            with app.test_client() as client:
+                start = time.perf_counter()
+                response = client.post("/login", json={"username": f"user{index % users + 1}",
+                    "password": "benchmark" if index % 4 else "wrong"})
+                return (time.perf_counter() - start) * 1000, response.status_code
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as clients:
+            results = list(clients.map(login, range(logins)))
+        seconds = time.perf_counter() - start
+    hasher.pool.shutdown()
+
+    latencies = sorted(latency for latency, status in results if status != 503)
+    return {"logins/s": round(len(latencies) / seconds, 1), "p50": round(percentile(latencies, 50), 1),
+            "p95": round(percentile(latencies, 95), 1), "busy": sum(status == 503 for _, status in results)}
+
+def measureTokenCheck(checks):
+    token = sessionTokens.issue(1)
+    start = time.perf_counter()
+    for _ in range(checks):
+        sessionTokens.verify(token)
+    verifyMicroseconds = (time.perf_counter() - start) / checks * 1e6
+
+    # What a server-side session would cost instead: a primary key read of its row
+    start = time.perf_counter()
+    for _ in range(checks):
+        db.session.query(User).get(1)
+        db.session.expire_all()
+    lookupMicroseconds = (time.perf_counter() - start) / checks * 1e6
+    return round(verifyMicroseconds, 1), round(lookupMicroseconds, 1)
+
+@click.command()
+@click.option("--costs", default="12,14,16", help="Comma separated scrypt costs (log2 of N) to measure.")
+@click.option("--users", default=100)
+@click.option("--logins", default=200, help="Logins to send at each cost.")
+@click.option("--threads", default=16, help="Clients logging in at the same time.")
+@click.option("--workers", default=os.cpu_count() or 2, help="Password hashing threads.")
+@click.option("--backlog", default=64, help="Logins that may wait for a hashing thread before getting 503.")
+@click.option("--checks", default=20000, help="Token checks to time.")
+def authBenchmark(costs, users, logins, threads, workers, backlog, checks):
+    directory = tempfile.mkdtemp()
+    with app.app_context():
+        app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{os.path.join(directory, 'auth.db')}"
+        db.create_all()
+        try:
+            print(f"{'cost':>5}{'logins/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'busy':>6}")
+            for cost in [int(cost) for cost in costs.split(",")]:
+                result = measureLogins(cost, users, logins, threads, workers, backlog)
+                print(f"{cost:>5}{result['logins/s']:>10}{result['p50']:>9}{result['p95']:>9}{result['busy']:>6}")
+            verifyMicroseconds, lookupMicroseconds = measureTokenCheck(checks)
+            print(f"Token check: {verifyMicroseconds} us per request (a session row lookup takes {lookupMicroseconds} us)")
+        finally:
+            db.session.remove()
+            db.engine.dispose()
+            shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    authBenchmark()
@@ -0,0 +1,236 @@
+"""
+Load-tests the HTTP routes against a synthetic database and reports latency percentiles, throughput and
+SQL statements per route. Run it from the back-end folder:
+
+    python benchmark.py --clips 100000 --follows 1000000
+    python benchmark.py --save-baseline benchmark-baseline.json
+    python benchmark.py --baseline benchmark-baseline.json   # exits with 1 if a route regressed
+"""
+from sqlalchemy import event
+from application import app, db, responseCache, storage, recountCounters, rebuildTimelines, followers, User, Clip, Comment
+from cache import NoCache
+from mp4_fixtures import buildMp4
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import bisect, io, itertools, json, math, os, random, shutil, sys, tempfile, threading, time, uuid, click
+
+BATCH_SIZE = 10000
+FIRST_DATE = datetime(2021, 1, 1)
+# What PUT /clips uploads: small, but an MP4 the upload parser accepts
+BENCHMARK_CLIP = buildMp4(frames=30, frameSize=100)
+# A route only counts as slower once its p95 grew by the threshold and by at least this many milliseconds,
+# so fast routes do not fail the run on scheduling noise between the client threads
+MINIMUM_REGRESSION_MS = 5.0
+
+def popularityWeights(count):
+    # A few users get most of the follows, like on any real social site
+    return list(itertools.accumulate(1 / rank for rank in range(1, count + 1)))
+
+def pickPopular(rng, cumulativeWeights):
+    return bisect.bisect_left(cumulativeWeights, rng.random() * cumulativeWeights[-1]) + 1
+
+def randomDate(rng):
+    return FIRST_DATE + timedelta(seconds=rng.randrange(365 * 24 * 60 * 60))
+
+def insertInBatches(table, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            db.session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+
+def followRows(rng, users, follows):
+    weights = popularityWeights(users)
+    for followerId in range(1, users + 1):
+        count = min(follows // users + (1 if followerId <= follows % users else 0), users - 1)
+        if count > users // 2:
+            followedIds = rng.sample([id for id in range(1, users + 1) if id != followerId], count)
+        else:
+            followedIds = set()
+            while len(followedIds) < count:
+                followedId = pickPopular(rng, weights)
+                if followedId != followerId:
+                    followedIds.add(followedId)
+        for followedId in sorted(followedIds):
+            yield {"followerId": followerId, "followedId": followedId}
+
+def generateData(rng, users, clips, comments, follows):
+    """
+    Fills the current database with users, clips, comments and follows drawn from rng, so the same seed always
+    gives the same data. The rows skip the routes, so counters and timelines are rebuilt afterwards.
+    """
+    insertInBatches(User.__table__, ({"id": id, "username": f"user{id}", "password": "benchmark"}
+        for id in range(1, users + 1)))
+    insertInBatches(Clip.__table__, ({"id": id, "clipUuid": str(uuid.UUID(int=rng.getrandbits(128))),
+        "authorId": rng.randint(1, users), "dateOfCreation": randomDate(rng), "title": f"clip {id}",
+        "description": "", "processingStatus": "ready"} for id in range(1, clips + 1)))
+    insertInBatches(Comment.__table__, ({"id": id, "comment": "nice clip", "authorId": rng.randint(1, users),
+        "clipId": rng.randint(1, clips), "dateOfCreation": randomDate(rng)} for id in range(1, comments + 1)))
+    insertInBatches(followers, followRows(rng, users, follows))
+    db.session.commit()
+
+    recountCounters()
+    User.query.filter(User.followerCount > app.config["FANOUT_FOLLOWER_LIMIT"]).update({User.fanOutOnRead: True})
+    db.session.commit()
+    rebuildTimelines()
+
+# (name, weight, request) where request(rng, users, clips) returns the test client method, path and arguments
+REQUEST_MIX = [
+    ("GET /clips", 20, lambda rng, users, clips: ("get", "/clips?limit=20", {})),
+    ("GET /follow/clips/<userid>", 20, lambda rng, users, clips: ("get", f"/follow/clips/{rng.randint(1, users)}?limit=20", {})),
+    ("GET /clips/info/<clipid>", 20, lambda rng, users, clips: ("get", f"/clips/info/{rng.randint(1, clips)}", {})),
+    ("GET /comments/<clipid>", 10, lambda rng, users, clips: ("get", f"/comments/{rng.randint(1, clips)}", {})),
+    ("GET /user/<userid>", 8, lambda rng, users, clips: ("get", f"/user/{rng.randint(1, users)}", {})),
+    ("GET /follow/<followerId>/<followeeId>", 5, lambda rng, users, clips:
+        ("get", f"/follow/{rng.randint(1, users)}/{rng.randint(1, users)}", {})),
+    ("PUT /comments/<clipid>", 7, lambda rng, users, clips:
+        ("put", f"/comments/{rng.randint(1, clips)}", {"json": {"authorId": rng.randint(1, users), "comment": "nice"}})),
+    ("PUT /follow/<followerId>/<followeeId>", 4, lambda rng, users, clips:
+        ("put", f"/follow/{rng.randint(1, users)}/{rng.randint(1, users)}", {})),
+    ("DELETE /follow/<followerId>/<followeeId>", 3, lambda rng, users, clips:
+        ("delete", f"/follow/{rng.randint(1, users)}/{rng.randint(1, users)}", {})),
+    ("PUT /clips", 3, lambda rng, users, clips: ("put", "/clips", {"data": {"file": (io.BytesIO(BENCHMARK_CLIP),
+        "benchmark.mp4"), "authorId": rng.randint(1, users), "title": "benchmark"}})),
+]
+
+def percentile(sortedValues, percent):
+    # Nearest rank, so the result is always a latency that was actually measured
+    return sortedValues[max(0, math.ceil(percent / 100 * len(sortedValues)) - 1)]
+
+def runMix(rng, requests, threads, users, clips):
+    """Sends requests drawn from REQUEST_MIX from several threads and returns each one's (name, seconds, status, statements)."""
+    names = [name for name, weight, request in REQUEST_MIX]
+    weights = [weight for name, weight, request in REQUEST_MIX]
+    builders = {name: request for name, weight, request in REQUEST_MIX}
+    plan = [(name, builders[name](rng, users, clips)) for name in rng.choices(names, weights, k=requests)]
+
+    counter = threading.local()
+
+    def countStatement(conn, cursor, statement, parameters, context, executemany):
+        counter.statements = getattr(counter, "statements", 0) + 1
+
+    def send(part):
+        client = app.test_client()
+        results = []
+        for name, (method, path, arguments) in part:
+            counter.statements = 0
+            start = time.perf_counter()
+            response = getattr(client, method)(path, **arguments)
+            response.get_data()
+            results.append((name, time.perf_counter() - start, response.status_code, counter.statements))
+        return results
+
+    event.listen(db.engine, "before_cursor_execute", countStatement)
+    try:
+        with ThreadPoolExecutor(threads) as executor:
+            parts = executor.map(send, [plan[thread::threads] for thread in range(threads)])
+            return [result for part in parts for result in part]
+    finally:
+        event.remove(db.engine, "before_cursor_execute", countStatement)
+
+def summarize(results, seconds):
+    routes = {}
+    for name, weight, request in REQUEST_MIX:
+        measured = [result for result in results if result[0] == name]
+        if not measured:
+            continue
+        latencies = sorted(elapsed * 1000 for _, elapsed, _, _ in measured)
+        routes[name] = {"requests": len(measured),
+                        "errors": sum(1 for _, _, status, _ in measured if status >= 500),
+                        "p50": round(percentile(latencies, 50), 3),
+                        "p95": round(percentile(latencies, 95), 3),
+                        "p99": round(percentile(latencies, 99), 3),
+                        "throughput": round(len(measured) / seconds, 1),
+                        "statements": round(sum(statements for _, _, _, statements in measured) / len(measured), 2)}
+    return {"requests": len(results), "seconds": round(seconds, 3), "throughput": round(len(results) / seconds, 1),
+            "routes": routes}
+
+def findRegressions(report, baseline, threshold):
+    """Lists the routes whose p95 or statement count grew past the baseline."""
+    regressions = []
+    for name, route in report["routes"].items():
+        before = baseline["routes"].get(name)
+        if before is None:
+            continue
+        if route["p95"] > before["p95"] * (1 + threshold) and route["p95"] - before["p95"] > MINIMUM_REGRESSION_MS:
+            regressions.append(f"{name}: p95 {before['p95']}ms -> {route['p95']}ms")
+        if route["statements"] > before["statements"]:
+            regressions.append(f"{name}: {before['statements']} -> {route['statements']} statements per request")
+    return regressions
+
+def printReport(report):
+    print(f"{'route':<44}{'requests':>9}{'errors':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}{'stmts':>7}")
+    for name, route in report["routes"].items():
+        print(f"{name:<44}{route['requests']:>9}{route['errors']:>7}{route['p50']:>9}{route['p95']:>9}"
+              f"{route['p99']:>9}{route['throughput']:>9}{route['statements']:>7}")
+    print(f"{report['requests']} requests in {report['seconds']}s, {report['throughput']} req/s")
+
+@click.command()
+@click.option("--seed", default=1, help="Seed for both the data and the request mix.")
+@click.option("--users", default=1000)
+@click.option("--clips", default=10000)
+@click.option("--comments", default=20000)
+@click.option("--follows", default=50000)
+@click.option("--requests", default=2000, help="Requests to send in total.")
+@click.option("--threads", default=4, help="Clients sending requests at the same time.")
+@click.option("--cache/--no-cache", default=False, help="Measure with the response cache, which hides the database.")
+@click.option("--data", default="benchmark-data", help="Folder where generated databases are kept for the next run.")
+@click.option("--output", help="Write the report to this JSON file.")
+@click.option("--baseline", help="Compare against this report and exit with 1 if a route regressed.")
+@click.option("--save-baseline", help="Write the report to this JSON file as the new baseline.")
+@click.option("--threshold", default=0.2, help="How much slower than the baseline p95 a route may get.")
+def benchmark(seed, users, clips, comments, follows, requests, threads, cache, data, output, baseline, save_baseline, threshold):
+    # Generating a large database takes minutes, so each size is kept and copied for every run,
+    # which also undoes whatever the write routes changed last time
+    os.makedirs(data, exist_ok=True)
+    dataPath = os.path.abspath(os.path.join(data, f"seed{seed}-{users}u-{clips}c-{comments}m-{follows}f.db"))
+    workDirectory = tempfile.mkdtemp()
+    runPath = os.path.join(workDirectory, "benchmark.db")
+
+    if not cache:
+        responseCache.backend = NoCache()
+
+    with app.app_context():
+        if not os.path.exists(dataPath):
+            print(f"Generating {dataPath}")
+            app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{dataPath}"
+            db.create_all()
+            generateData(random.Random(seed), users, clips, comments, follows)
+            db.session.remove()
+            db.engine.dispose()
+
+        shutil.copyfile(dataPath, runPath)
+        app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{runPath}"
+        # Uploaded clips are kept with the copy of the database, and removed along with it
+        app.config["CLIP_DIRECTORY"] = storage.directory = os.path.join(workDirectory, "clips")
+        try:
+            start = time.perf_counter()
+            results = runMix(random.Random(seed), requests, threads, users, clips)
+            report = summarize(results, time.perf_counter() - start)
+        finally:
+            db.session.remove()
+            db.engine.dispose()
+            shutil.rmtree(workDirectory)
+
+    report["config"] = {"seed": seed, "users": users, "clips": clips, "comments": comments, "follows": follows,
+                        "requests": requests, "threads": threads, "cache": cache}
+    printReport(report)
+
+    for path in (output, save_baseline):
+        if path:
+            with open(path, "w") as file:
+                json.dump(report, file, indent=2)
+
+    if baseline:
+        with open(baseline) as file:
+            regressions = findRegressions(report, json.load(file), threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,106 @@
+import asyncio, queue, threading
+
+class Subscription:
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.messages = queue.Queue()
+
+    def put(self, message):
+        self.messages.put(message)
+
+    def get(self, timeout):
+        """Waits up to timeout seconds for the next message, and returns None if none came."""
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+class AsyncSubscription(Subscription):
+    """A subscription read on an event loop, so waiting for a message takes no thread."""
+    def __init__(self, broker, channel, loop):
+        super().__init__(broker, channel)
+        self.loop = loop
+        self.messages = asyncio.Queue()
+
+    def put(self, message):
+        # Publishers run on other threads. A loop that has closed has no one left to read the message.
+        try:
+            self.loop.call_soon_threadsafe(self.messages.put_nowait, message)
+        except RuntimeError:
+            pass
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self.messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+class LocalBroker:
+    """Publishes messages to the subscribers of a channel within this process."""
+    def __init__(self):
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, channel, loop=None):
+        """Subscribes to channel, for reading on loop's thread if given (see AsyncSubscription) and on any thread if not."""
+        subscription = Subscription(self, channel) if loop is None else AsyncSubscription(self, channel, loop)
+        with self.lock:
+            self.subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.subscriptions.get(subscription.channel, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self.subscriptions.pop(subscription.channel, None)
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscribers = list(self.subscriptions.get(channel, ()))
+        for subscription in subscribers:
+            subscription.put(message)
+
+    def subscriberCount(self, channel):
+        with self.lock:
+            return len(self.subscriptions.get(channel, ()))
+
+class RedisBroker(LocalBroker):
+    """
+    Publishes through Redis, so subscribers in every server process receive each message. One listener thread
+    per process holds the Redis subscriptions and hands messages to the local subscribers.
+    """
+    def __init__(self, client, prefix="hypeclips:"):
+        super().__init__()
+        self.client = client
+        self.prefix = prefix
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.listener = None
+
+    def subscribe(self, channel, loop=None):
+        subscription = super().subscribe(channel, loop)
+        self.pubsub.subscribe(**{self.prefix + channel: self.deliver})
+        if self.listener is None:
+            self.listener = self.pubsub.run_in_thread(sleep_time=1, daemon=True)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        super().unsubscribe(subscription)
+        if self.subscriberCount(subscription.channel) == 0:
+            self.pubsub.unsubscribe(self.prefix + subscription.channel)
+
+    def deliver(self, message):
+        super().publish(message["channel"].decode()[len(self.prefix):], message["data"].decode())
+
+    def publish(self, channel, message):
+        self.client.publish(self.prefix + channel, message)
+
+def createBroker(name, redisUrl):
+    if name == "redis":
+        import redis
+        return RedisBroker(redis.Redis.from_url(redisUrl))
+    return LocalBroker()
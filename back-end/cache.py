@@ -0,0 +1,200 @@
+from collections import OrderedDict
+from flask import Response
+import base64, json, threading, time, uuid
+
+class LocalCache:
+    """An in-process LRU cache where every entry can also expire after a TTL."""
+    def __init__(self, maxEntries=10000):
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expiresAt = entry
+            if expiresAt is not None and expiresAt <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def getMany(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (value, None if ttl is None else time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class RedisCache:
+    """Shares cached responses between processes through anything with the redis-py get/mget/set/delete API."""
+    def __init__(self, client, prefix="hypeclips:"):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else value.decode()
+
+    def getMany(self, keys):
+        return [None if value is None else value.decode() for value in self.client.mget([self.prefix + key for key in keys])]
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value.encode(), ex=None if ttl is None else int(ttl))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(f"{self.prefix}*"):
+            self.client.delete(key)
+
+class InMemoryRedis:
+    """Stands in for a Redis server in tests, implementing the part of the redis-py client RedisCache and RedisTokenBuckets use."""
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expiresAt = self.values.get(key, (None, None))
+            if expiresAt is not None and expiresAt <= time.monotonic():
+                del self.values[key]
+                return None
+            return value
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        with self.lock:
+            self.values[key] = (value, None if ex is None else time.monotonic() + ex)
+
+    def delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+    def incr(self, key):
+        with self.lock:
+            value, expiresAt = self.values.get(key, (0, None))
+            if expiresAt is not None and expiresAt <= time.monotonic():
+                value, expiresAt = 0, None
+            self.values[key] = (int(value) + 1, expiresAt)
+            return int(value) + 1
+
+    def expire(self, key, seconds):
+        with self.lock:
+            if key in self.values:
+                self.values[key] = (self.values[key][0], time.monotonic() + seconds)
+
+    def scan_iter(self, pattern):
+        with self.lock:
+            return [key for key in self.values if key.startswith(pattern.rstrip("*"))]
+
+class NoCache:
+    def get(self, key):
+        return None
+
+    def getMany(self, keys):
+        return [None for key in keys]
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+def createCacheBackend(name, maxEntries, redisUrl, prefix="hypeclips:"):
+    if name == "local":
+        return LocalCache(maxEntries)
+    if name == "redis":
+        import redis
+        return RedisCache(redis.Redis.from_url(redisUrl), prefix)
+    return NoCache()
+
+class ResponseCache:
+    """
+    Caches whole responses, each one depending on a set of tags such as "clip:5". Every tag has a version token,
+    and an entry is only served while the tokens it was built under are still current. Writes replace the tokens
+    of the tags they touch, so every entry built from the old data is skipped from then on.
+
+    Tokens are read before the response is built. A write that lands during the build therefore leaves the new
+    entry stale on arrival rather than serving it. A token that gets evicted is simply replaced with a fresh one.
+    """
+    def __init__(self, backend, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.invalidations = 0
+
+    def count(self, endpoint, outcome):
+        with self.lock:
+            counters = self.counters.setdefault(endpoint, {"hits": 0, "misses": 0})
+            counters[outcome] += 1
+
+    def tagVersions(self, tags):
+        tokens = self.backend.getMany([f"tag:{tag}" for tag in tags])
+        versions = {}
+        for tag, token in zip(tags, tokens):
+            if token is None:
+                token = uuid.uuid4().hex
+                self.backend.set(f"tag:{tag}", token)
+            versions[tag] = token
+        return versions
+
+    def respond(self, key, tags, endpoint, build):
+        versions = self.tagVersions(tags)
+
+        cached = self.backend.get(f"response:{key}")
+        if cached is not None:
+            entry = json.loads(cached)
+            if entry["versions"] == versions:
+                self.count(endpoint, "hits")
+                body = entry["body"] if "body" in entry else base64.b64decode(entry["binary"])
+                return Response(body, status=entry["status"], mimetype=entry["mimetype"])
+
+        self.count(endpoint, "misses")
+        response = build()
+        if response.status_code == 200 and not response.is_streamed:
+            # Text is kept as it is and anything else, such as MessagePack, in base64
+            data = response.get_data()
+            try:
+                body = {"body": data.decode()}
+            except UnicodeDecodeError:
+                body = {"binary": base64.b64encode(data).decode()}
+            self.backend.set(f"response:{key}", json.dumps({**body, "status": response.status_code,
+                "mimetype": response.mimetype, "versions": versions}), self.ttl)
+        return response
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.backend.set(f"tag:{tag}", uuid.uuid4().hex)
+        with self.lock:
+            self.invalidations += len(tags)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"hits": sum(counters["hits"] for counters in self.counters.values()),
+                    "misses": sum(counters["misses"] for counters in self.counters.values()),
+                    "invalidations": self.invalidations,
+                    "endpoints": {endpoint: dict(counters) for endpoint, counters in self.counters.items()}}
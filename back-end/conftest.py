@@ -0,0 +1,12 @@
+import os
+# The tests run in one process, so any key will do
+os.environ.setdefault("SECRET_KEY", "test secret key")
+
+from application import responseCache
+import pytest
+
+@pytest.fixture(autouse=True)
+def clearResponseCache():
+    # Tests write straight to the database, which skips the invalidation the routes do
+    responseCache.clear()
+    yield
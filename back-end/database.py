@@ -0,0 +1,71 @@
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+import sqlite3
+
+# Postgres codes for a serialization failure and a deadlock, both of which are safe to retry
+RETRYABLE_PGCODES = {"40001", "40P01"}
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg", "mysql": "mysql+aiomysql"}
+
+class Database(SQLAlchemy):
+    """
+    Builds the engine from the DATABASE_* settings. A SQLite file gets a real connection pool instead of
+    Flask-SQLAlchemy's NullPool, so the pragmas set on connect are paid once per pooled connection. An in-memory
+    SQLite database keeps its single shared connection, since a second one would be an empty database.
+    """
+    def apply_driver_hacks(self, app, sa_url, options):
+        inMemory = sa_url.drivername.startswith("sqlite") and sa_url.database in (None, "", ":memory:")
+        if not inMemory:
+            options.setdefault("pool_size", app.config["DATABASE_POOL_SIZE"])
+            options.setdefault("max_overflow", app.config["DATABASE_MAX_OVERFLOW"])
+            options.setdefault("pool_timeout", app.config["DATABASE_POOL_TIMEOUT"])
+            options.setdefault("pool_recycle", app.config["DATABASE_POOL_RECYCLE"])
+        options.setdefault("pool_pre_ping", app.config["DATABASE_POOL_PRE_PING"])
+
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+
+        if sa_url.drivername.startswith("sqlite") and not inMemory:
+            options["poolclass"] = QueuePool
+            # Pooled connections move between threads, but only ever belong to one at a time
+            options.setdefault("connect_args", {})["check_same_thread"] = False
+        return sa_url, options
+
+def setSqlitePragmas(app, dbapiConnection):
+    cursor = dbapiConnection.cursor()
+    # WAL lets readers carry on while a writer commits, and with it NORMAL only syncs at checkpoints
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(app.config['SQLITE_BUSY_TIMEOUT'])}")
+    cursor.execute(f"PRAGMA mmap_size={int(app.config['SQLITE_MMAP_SIZE'])}")
+    cursor.close()
+
+def configureSqlite(app):
+    @event.listens_for(Engine, "connect")
+    def setPragmasOnConnect(dbapiConnection, connectionRecord):
+        if isinstance(dbapiConnection, sqlite3.Connection):
+            setSqlitePragmas(app, dbapiConnection)
+
+def createAsyncEngine(app, url):
+    """
+    Makes an asyncio engine for the database the Flask app uses, through the async driver of its backend
+    (aiosqlite, asyncpg or aiomysql, which have to be installed). It has the same pool settings and pragmas.
+    """
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        raise ValueError("an in-memory SQLite database cannot be shared with an async engine")
+    # aiosqlite would otherwise get a NullPool, like pysqlite does in Flask-SQLAlchemy
+    engine = create_async_engine(url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()]),
+        poolclass=AsyncAdaptedQueuePool, pool_size=app.config["DATABASE_POOL_SIZE"], max_overflow=app.config["DATABASE_MAX_OVERFLOW"],
+        pool_timeout=app.config["DATABASE_POOL_TIMEOUT"], pool_recycle=app.config["DATABASE_POOL_RECYCLE"],
+        pool_pre_ping=app.config["DATABASE_POOL_PRE_PING"])
+    if url.get_backend_name() == "sqlite":
+        event.listen(engine.sync_engine, "connect",
+            lambda dbapiConnection, connectionRecord: setSqlitePragmas(app, dbapiConnection))
+    return engine
+
+def isLockError(error):
+    # error is a sqlalchemy.exc.OperationalError, wrapping the driver's own exception
+    if "database is locked" in str(error.orig) or "database table is locked" in str(error.orig):
+        return True
+    return getattr(error.orig, "pgcode", None) in RETRYABLE_PGCODES
@@ -0,0 +1,203 @@
+"""
+The follow graph of the whole site, held in memory for the questions SQL answers slowly: mutual follows and
+"who to follow" suggestions two hops away.
+"""
+from array import array
+from collections import Counter
+import bisect, heapq, threading, time
+
+# Edges of followed users' own follows that one suggestion may count. Users who follow thousands of people would
+# otherwise make a suggestion cost millions of steps.
+MAX_SUGGESTION_WORK = 200000
+
+class Adjacency:
+    """
+    One direction of the graph in CSR form: the neighbours of user id u are targets[offsets[u]:offsets[u + 1]],
+    sorted, in one flat array of 32-bit ids. That is 4 bytes per edge and 8 per user id, with no object per edge.
+    """
+    def __init__(self, offsets, targets):
+        self.offsets = offsets
+        self.targets = targets
+
+    @staticmethod
+    def fromSortedPairs(pairs, size):
+        # pairs are (user, neighbour) sorted by both, as an index read gives them, and size is past every user id
+        offsets = array("q", [0])
+        targets = array("i")
+        for user, neighbour in pairs:
+            while len(offsets) <= user:
+                offsets.append(len(targets))
+            targets.append(neighbour)
+        while len(offsets) <= size:
+            offsets.append(len(targets))
+        return Adjacency(offsets, targets)
+
+    def bounds(self, user):
+        if user < 0 or user + 1 >= len(self.offsets):
+            return 0, 0
+        return self.offsets[user], self.offsets[user + 1]
+
+    def degree(self, user):
+        start, end = self.bounds(user)
+        return end - start
+
+    def contains(self, user, neighbour):
+        start, end = self.bounds(user)
+        index = bisect.bisect_left(self.targets, neighbour, start, end)
+        return index < end and self.targets[index] == neighbour
+
+    def neighbours(self, user):
+        start, end = self.bounds(user)
+        return self.targets[start:end]
+
+    def memoryUsage(self):
+        return self.offsets.itemsize * len(self.offsets) + self.targets.itemsize * len(self.targets)
+
+class FollowGraph:
+    """
+    Who follows whom, as CSR adjacency in both directions. Follows and unfollows since the arrays were built sit
+    in per-user sets on top of them, which the next rebuild folds in.
+    """
+    def __init__(self, following, followers):
+        self.following = following
+        self.followers = followers
+        # user -> ids added to or removed from their row, for both directions
+        self.added = ({}, {})
+        self.removed = ({}, {})
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def build(followingPairs, followerPairs, size):
+        """Builds from (follower, followed) pairs sorted by follower, and (followed, follower) pairs sorted by followed."""
+        return FollowGraph(Adjacency.fromSortedPairs(followingPairs, size), Adjacency.fromSortedPairs(followerPairs, size))
+
+    def change(self, direction, user, neighbour, adding):
+        added, removed = self.added[direction], self.removed[direction]
+        (removed if adding else added).get(user, set()).discard(neighbour)
+        base = (self.following, self.followers)[direction].contains(user, neighbour)
+        if adding and not base:
+            added.setdefault(user, set()).add(neighbour)
+        elif not adding and base:
+            removed.setdefault(user, set()).add(neighbour)
+
+    def follow(self, follower, followed):
+        with self.lock:
+            self.change(0, follower, followed, True)
+            self.change(1, followed, follower, True)
+
+    def unfollow(self, follower, followed):
+        with self.lock:
+            self.change(0, follower, followed, False)
+            self.change(1, followed, follower, False)
+
+    def row(self, direction, user):
+        # A user's current neighbours in one direction, sorted
+        neighbours = (self.following, self.followers)[direction].neighbours(user)
+        added, removed = self.added[direction].get(user), self.removed[direction].get(user)
+        if not added and not removed:
+            return neighbours
+        return sorted(set(neighbours).difference(removed or ()).union(added or ()))
+
+    def isFollowing(self, follower, followed):
+        if followed in self.added[0].get(follower, ()):
+            return True
+        if followed in self.removed[0].get(follower, ()):
+            return False
+        return self.following.contains(follower, followed)
+
+    def followedBy(self, user):
+        return self.row(0, user)
+
+    def followersOf(self, user):
+        return self.row(1, user)
+
+    def followerCount(self, user):
+        return self.followers.degree(user) + len(self.added[1].get(user, ())) - len(self.removed[1].get(user, ()))
+
+    def mutuals(self, user):
+        """Users who follow user and are followed back, sorted by id."""
+        following = self.followedBy(user)
+        return [other for other in self.followersOf(user) if contains(following, other)]
+
+    def suggestions(self, user, count):
+        """
+        The count users followed by the most of the people user follows, with how many of them follow each one.
+        Ties go to the user with more followers.
+        """
+        following = self.followedBy(user)
+        candidates = Counter()
+        work = 0
+        for followed in following:
+            # Counter.update over an array slice runs in C, one step per edge
+            neighbours = self.followedBy(followed)[:MAX_SUGGESTION_WORK - work]
+            candidates.update(neighbours)
+            work += len(neighbours)
+            if work >= MAX_SUGGESTION_WORK:
+                break
+        candidates.pop(user, None)
+        for followed in following:
+            candidates.pop(followed, None)
+        return heapq.nlargest(count, candidates.items(),
+            key=lambda item: (item[1], self.followerCount(item[0]), -item[0]))
+
+    def edgeCount(self):
+        return len(self.following.targets) + sum(map(len, self.added[0].values())) - sum(map(len, self.removed[0].values()))
+
+    def memoryUsage(self):
+        # The arrays only: the overlay is small between rebuilds
+        return self.following.memoryUsage() + self.followers.memoryUsage()
+
+def contains(sortedIds, id):
+    index = bisect.bisect_left(sortedIds, id)
+    return index < len(sortedIds) and sortedIds[index] == id
+
+class FollowGraphIndex:
+    """
+    The FollowGraph of this process. load() builds it from the database on first use, and again in a background
+    thread once it is refresh seconds old, to take in follows made by other processes or straight in the database.
+    Follows made through this process are applied at once, and replayed on a graph that was being rebuilt meanwhile.
+    """
+    def __init__(self, load, refresh):
+        self.load = load
+        self.refresh = refresh
+        self.graph = None
+        self.builtAt = None
+        self.lock = threading.Lock()
+        self.rebuilding = None
+
+    def get(self):
+        with self.lock:
+            if self.graph is None:
+                self.graph, self.builtAt = self.load(), time.monotonic()
+            elif self.rebuilding is None and time.monotonic() - self.builtAt >= self.refresh:
+                self.rebuilding = []
+                threading.Thread(target=self.rebuild, name="follow-graph", daemon=True).start()
+            return self.graph
+
+    def rebuild(self):
+        try:
+            graph = self.load()
+        except Exception:
+            # load logs its errors. The current graph is kept and the next refresh tries again.
+            with self.lock:
+                self.rebuilding = None
+                self.builtAt = time.monotonic()
+            return
+        with self.lock:
+            for change in self.rebuilding:
+                change(graph)
+            self.graph, self.builtAt, self.rebuilding = graph, time.monotonic(), None
+
+    def apply(self, change):
+        # Nothing to keep current before the graph is first built, since that reads the database as it is then
+        with self.lock:
+            if self.graph is not None:
+                change(self.graph)
+            if self.rebuilding is not None:
+                self.rebuilding.append(change)
+
+    def follow(self, follower, followed):
+        self.apply(lambda graph: graph.follow(follower, followed))
+
+    def unfollow(self, follower, followed):
+        self.apply(lambda graph: graph.unfollow(follower, followed))
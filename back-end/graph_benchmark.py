@@ -0,0 +1,58 @@
+"""
+Measures the in-memory follow graph on a synthetic site: how long it takes to build, the bytes it holds per
+million follows, and how long isFollowing, mutuals and suggestions take. Run it from the back-end folder:
+
+    python graph_benchmark.py --users 1000000 --follows-per-user 50
+"""
+from graph import FollowGraph
+import random, time, click
+
+def percentile(samples, fraction):
+    return sorted(samples)[int(fraction * (len(samples) - 1))]
+
+def timed(run, samples):
+    times = []
+    for argument in samples:
+        start = time.perf_counter()
+        run(argument)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+@click.command()
+@click.option("--users", default=100000)
+@click.option("--follows-per-user", default=50, help="Average follows per user, drawn from a skewed distribution so a few users are followed by many.")
+@click.option("--samples", default=1000, help="Lookups timed for each operation.")
+@click.option("--seed", default=0)
+def graphBenchmark(users, follows_per_user, samples, seed):
+    random.seed(seed)
+    start = time.perf_counter()
+    edges = set()
+    for follower in range(1, users + 1):
+        for _ in range(random.randint(0, 2 * follows_per_user)):
+            # Popularity falls off with the id, as it does with follower counts on a real site
+            followed = min(int(random.paretovariate(0.8)), users)
+            if followed != follower:
+                edges.add((follower, followed))
+    following = sorted(edges)
+    followedBy = sorted((followed, follower) for follower, followed in edges)
+    print(f"{users} users, {len(edges)} follows generated in {time.perf_counter() - start:.1f} s")
+
+    start = time.perf_counter()
+    graph = FollowGraph.build(following, followedBy, users + 1)
+    buildSeconds = time.perf_counter() - start
+    del following, followedBy
+    memory = graph.memoryUsage()
+    print(f"build: {buildSeconds:.2f} s, {memory / 2 ** 20:.1f} MB, "
+          f"{memory / max(len(edges), 1) * 10 ** 6 / 2 ** 20:.1f} MB per million follows")
+
+    sampled = [random.randint(1, users) for _ in range(samples)]
+    pairs = [(random.randint(1, users), min(int(random.paretovariate(0.8)), users)) for _ in range(samples)]
+    for name, run, arguments in [("isFollowing", lambda pair: graph.isFollowing(*pair), pairs),
+                                 ("mutuals", graph.mutuals, sampled),
+                                 ("suggestions", lambda user: graph.suggestions(user, 10), sampled)]:
+        times = timed(run, arguments)
+        print(f"{name:>12}  p50 {percentile(times, 0.5):8.3f} ms  p95 {percentile(times, 0.95):8.3f} ms  "
+              f"max {max(times):8.3f} ms")
+
+if __name__ == "__main__":
+    graphBenchmark()
@@ -0,0 +1,187 @@
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from collections import Counter
+import contextlib, os, re, sys, threading, time
+
+# Upper bounds in seconds of the request latency histogram buckets, as in the Prometheus client defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Routes whose bodies are clip or thumbnail bytes
+STREAMING_ENDPOINTS = {"getClipById", "getClipThumbnail"}
+
+def normalizeStatement(statement):
+    # Strips the values out of a statement so every run of the same query is logged and counted the same way
+    statement = re.sub(r"'(?:[^']|'')*'", "?", statement)
+    statement = re.sub(r"\b\d+(?:\.\d+)?\b", "?", statement)
+    # IN lists and multi-row VALUES differ in length from one call to the next
+    statement = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?...)", statement)
+    return re.sub(r"\s+", " ", statement).strip()
+
+class Metrics:
+    """Request latency histograms and counters, rendered in the Prometheus text format."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.bytesSent = Counter()
+        self.slowQueries = Counter()
+
+    def observeRequest(self, method, route, seconds, statements, sqlSeconds):
+        with self.lock:
+            series = self.requests.setdefault((method, route), {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0,
+                "count": 0, "statements": 0, "sqlSeconds": 0.0})
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    series["buckets"][index] += 1
+                    break
+            series["sum"] += seconds
+            series["count"] += 1
+            series["statements"] += statements
+            series["sqlSeconds"] += sqlSeconds
+
+    def addBytesSent(self, endpoint, count):
+        with self.lock:
+            self.bytesSent[endpoint] += count
+
+    def countSlowQuery(self, statement):
+        with self.lock:
+            self.slowQueries[statement] += 1
+
+    def render(self):
+        lines = ["# TYPE hypeclips_request_duration_seconds histogram"]
+        with self.lock:
+            for (method, route), series in sorted(self.requests.items()):
+                labels = f'method="{method}",route="{route}"'
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, series["buckets"]):
+                    cumulative += count
+                    lines.append(f'hypeclips_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'hypeclips_request_duration_seconds_bucket{{{labels},le="+Inf"}} {series["count"]}')
+                lines.append(f"hypeclips_request_duration_seconds_sum{{{labels}}} {series['sum']}")
+                lines.append(f"hypeclips_request_duration_seconds_count{{{labels}}} {series['count']}")
+            lines.append("# TYPE hypeclips_sql_statements_total counter")
+            for (method, route), series in sorted(self.requests.items()):
+                lines.append(f'hypeclips_sql_statements_total{{method="{method}",route="{route}"}} {series["statements"]}')
+            lines.append("# TYPE hypeclips_sql_seconds_total counter")
+            for (method, route), series in sorted(self.requests.items()):
+                lines.append(f'hypeclips_sql_seconds_total{{method="{method}",route="{route}"}} {series["sqlSeconds"]}')
+            lines.append("# TYPE hypeclips_bytes_sent_total counter")
+            for endpoint, count in sorted(self.bytesSent.items()):
+                lines.append(f'hypeclips_bytes_sent_total{{endpoint="{endpoint}"}} {count}')
+            lines.append("# TYPE hypeclips_slow_queries_total counter")
+            lines.append(f"hypeclips_slow_queries_total {sum(self.slowQueries.values())}")
+        return "\n".join(lines) + "\n"
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread from a second thread every interval seconds. The samples come out in the
+    folded format (one "outer;inner count" line per distinct stack) that flamegraph.pl and speedscope read.
+    """
+    def __init__(self, threadId, interval):
+        self.threadId = threadId
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.threadId)
+            stack = []
+            while frame is not None:
+                stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+@contextlib.contextmanager
+def timed(name):
+    """Adds the time spent in the block to this request's Server-Timing entry called name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context() and "timings" in g:
+            g.timings[name] = g.timings.get(name, 0.0) + time.perf_counter() - start
+
+def serverTiming(timings, statements, sqlSeconds, seconds):
+    entries = [f'db;dur={sqlSeconds * 1000:.2f};desc="{statements} statements"']
+    entries += [f"{name};dur={elapsed * 1000:.2f}" for name, elapsed in timings.items()]
+    entries.append(f"total;dur={seconds * 1000:.2f}")
+    return ", ".join(entries)
+
+def instrumentApp(app, metrics):
+    """
+    Records the statements, time and Server-Timing of every request while INSTRUMENTATION is on, and profiles
+    every request while PROFILE_REQUESTS is on. Both are read per request, so they can be switched at run time.
+    """
+    @event.listens_for(Engine, "before_cursor_execute")
+    def startStatementTimer(conn, cursor, statement, parameters, context, executemany):
+        if app.config["INSTRUMENTATION"]:
+            conn.info["statementStart"] = time.perf_counter()
+
+    @event.listens_for(Engine, "after_cursor_execute")
+    def stopStatementTimer(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop("statementStart", None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        if has_request_context() and "sqlStatements" in g:
+            g.sqlStatements += 1
+            g.sqlSeconds += elapsed
+        if elapsed * 1000 >= app.config["SLOW_QUERY_MS"]:
+            normalized = normalizeStatement(statement)
+            metrics.countSlowQuery(normalized)
+            app.logger.warning(f"Slow query ({elapsed * 1000:.1f}ms): {normalized}")
+
+    @app.before_request
+    def startRequest():
+        if app.config["INSTRUMENTATION"]:
+            g.requestStart = time.perf_counter()
+            g.sqlStatements = 0
+            g.sqlSeconds = 0.0
+            g.timings = {}
+        if app.config["PROFILE_REQUESTS"]:
+            g.profileStart = time.perf_counter()
+            g.profiler = SamplingProfiler(threading.get_ident(), app.config["PROFILE_INTERVAL_MS"] / 1000)
+            g.profiler.start()
+
+    @app.after_request
+    def finishRequest(response):
+        if "requestStart" in g:
+            seconds = time.perf_counter() - g.requestStart
+            route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            metrics.observeRequest(request.method, route, seconds, g.sqlStatements, g.sqlSeconds)
+            # Bodies handed to the front proxy have no length here and are counted in its logs instead
+            if request.endpoint in STREAMING_ENDPOINTS and response.status_code in (200, 206) and response.content_length:
+                metrics.addBytesSent(request.endpoint, response.content_length)
+            response.headers["Server-Timing"] = serverTiming(g.timings, g.sqlStatements, g.sqlSeconds, seconds)
+        if "profiler" in g:
+            stopProfiler(app)
+        return response
+
+    @app.teardown_request
+    def stopProfilerAfterError(error):
+        if "profiler" in g:
+            stopProfiler(app)
+
+def stopProfiler(app):
+    profiler = g.pop("profiler")
+    profiler.stop()
+    milliseconds = (time.perf_counter() - g.profileStart) * 1000
+    if milliseconds < app.config["PROFILE_THRESHOLD_MS"] or not profiler.samples:
+        return
+    os.makedirs(app.config["PROFILE_DIRECTORY"], exist_ok=True)
+    path = os.path.join(app.config["PROFILE_DIRECTORY"],
+        f"{time.time_ns()}-{request.endpoint or 'unmatched'}-{int(milliseconds)}ms.folded")
+    with open(path, "w") as file:
+        file.write(profiler.folded())
@@ -0,0 +1,420 @@
+"""
+A streaming parser for MP4 (ISO base media file format) uploads. It reads box headers as the bytes arrive, skips
+the media data without keeping it, and parses only the moov box: duration, resolution, codecs and a keyframe
+index mapping seconds to byte offsets. Nothing is decoded.
+"""
+from array import array
+from contextlib import contextmanager
+from itertools import accumulate
+import bisect, io, os, struct, sys
+
+# The moov box is kept in memory to be parsed. Even hours of video need a few tens of MB.
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+# Boxes whose payload the parser keeps. Everything else, mdat above all, is only counted.
+KEPT_BOXES = {b"ftyp", b"moov"}
+# Containers walked into when looking for tracks and their sample tables
+CONTAINER_BOXES = {b"trak", b"mdia", b"minf", b"stbl", b"edts", b"dinf"}
+# Without a sync sample table every sample is a keyframe, and the index keeps one of them per this many seconds,
+# up to as many entries as a month of video needs
+MIN_SEEK_SPACING = 1.0
+MAX_SPACED_KEYFRAMES = 31 * 24 * 3600
+# Each index entry is the keyframe's time in milliseconds and its byte offset in the file
+SEEK_ENTRY = struct.Struct("<IQ")
+VISUAL_SAMPLE_ENTRY_SIZE = 78
+AUDIO_SAMPLE_ENTRY_SIZE = 28
+READ_SIZE = 64 * 1024
+
+class InvalidMp4(ValueError):
+    pass
+
+@contextmanager
+def malformed(boxName):
+    # Tables that contradict each other show up as out of range reads, which mean the file is not a usable MP4
+    try:
+        yield
+    except InvalidMp4:
+        raise
+    except (struct.error, IndexError, ValueError) as error:
+        raise InvalidMp4(f"the {boxName} box is malformed") from error
+
+def uint32Array(data):
+    # Sample tables are big-endian 32-bit integers, read in one go rather than one struct call each
+    values = array("I", bytes(data))
+    if values.itemsize != 4:
+        values = array("L", bytes(data))
+    if sys.byteorder == "little":
+        values.byteswap()
+    return values
+
+def iterBoxes(data, start, end):
+    """Yields (type, payload start, payload end) of the boxes laid end to end in data[start:end]."""
+    while start + 8 <= end:
+        size, boxType = struct.unpack_from(">I4s", data, start)
+        headerSize = 8
+        if size == 1:
+            size, = struct.unpack_from(">Q", data, start + 8)
+            headerSize = 16
+        elif size == 0:
+            size = end - start
+        if size < headerSize or start + size > end:
+            raise InvalidMp4(f"the {boxType.decode('latin-1')} box does not fit in its parent")
+        yield boxType, start + headerSize, start + size
+        start += size
+
+def fullBoxVersion(data, start):
+    return data[start]
+
+def parseTimes(data, start):
+    # mvhd and mdhd: the timescale and duration, with 64-bit times in version 1
+    if fullBoxVersion(data, start) == 1:
+        return struct.unpack_from(">IQ", data, start + 20)
+    return struct.unpack_from(">II", data, start + 12)
+
+def parseTrackHeader(data, start):
+    # Width and height are 16.16 fixed point, after the times, the matrix and a few reserved fields
+    offset = start + (88 if fullBoxVersion(data, start) == 1 else 76)
+    width, height = struct.unpack_from(">II", data, offset)
+    return width >> 16, height >> 16
+
+def parseEsdsCodec(data, start, end):
+    # Walks the MPEG-4 descriptors for the object type, and the audio object type of AAC (e.g. mp4a.40.2)
+    position = start + 4
+    objectType = audioType = None
+    while position + 2 <= end:
+        tag = data[position]
+        position += 1
+        length = 0
+        for _ in range(4):
+            byte = data[position]
+            position += 1
+            length = length << 7 | byte & 0x7F
+            if not byte & 0x80:
+                break
+        if tag == 3:
+            flags = data[position + 2]
+            position += 3 + (2 if flags & 0x80 else 0) + (2 if flags & 0x20 else 0)
+            if flags & 0x40:
+                position += 1 + data[position]
+        elif tag == 4:
+            objectType = data[position]
+            position += 13
+        elif tag == 5:
+            if length:
+                audioType = data[position] >> 3
+            break
+        else:
+            position += length
+    if objectType is None:
+        return "mp4a"
+    return f"mp4a.{objectType:x}" + (f".{audioType}" if audioType else "")
+
+def parseSampleDescription(data, start, end):
+    # The codec of the first sample entry, in the form MIME types use (RFC 6381), e.g. avc1.64001f
+    for entryType, entryStart, entryEnd in iterBoxes(data, start + 8, end):
+        codec = entryType.decode("latin-1")
+        childrenStart = entryStart + (VISUAL_SAMPLE_ENTRY_SIZE if codec in ("avc1", "avc3", "hvc1", "hev1", "mp4v", "av01")
+                                      else AUDIO_SAMPLE_ENTRY_SIZE)
+        for childType, childStart, childEnd in iterBoxes(data, childrenStart, entryEnd):
+            if childType == b"avcC" and childEnd - childStart >= 4:
+                return f"{codec}.{data[childStart + 1]:02x}{data[childStart + 2]:02x}{data[childStart + 3]:02x}"
+            if childType == b"esds":
+                return parseEsdsCodec(data, childStart, childEnd)
+        return codec
+    return None
+
+def checkTableLength(boxType, length, available):
+    if length > available:
+        raise InvalidMp4(f"the {boxType.decode()} table is longer than its box")
+
+def readTable(data, start, end, boxType, width):
+    # The entry count, then count rows of width 32-bit integers
+    count, = struct.unpack_from(">I", data, start + 4)
+    length = count * width * 4
+    checkTableLength(boxType, length, end - start - 8)
+    return uint32Array(data[start + 8:start + 8 + length])
+
+def parseTrack(data, start, end, track):
+    for boxType, boxStart, boxEnd in iterBoxes(data, start, end):
+        if boxType in CONTAINER_BOXES:
+            parseTrack(data, boxStart, boxEnd, track)
+        elif boxType == b"tkhd":
+            track["width"], track["height"] = parseTrackHeader(data, boxStart)
+        elif boxType == b"mdhd":
+            track["timescale"], track["duration"] = parseTimes(data, boxStart)
+        elif boxType == b"hdlr":
+            track["handler"] = bytes(data[boxStart + 8:boxStart + 12])
+        elif boxType == b"stsd":
+            track["codec"] = parseSampleDescription(data, boxStart, boxEnd)
+        elif boxType in (b"stts", b"stss", b"stsc", b"stco"):
+            track[boxType.decode()] = readTable(data, boxStart, boxEnd, boxType, {b"stts": 2, b"stsc": 3}.get(boxType, 1))
+        elif boxType == b"co64":
+            count, = struct.unpack_from(">I", data, boxStart + 4)
+            checkTableLength(boxType, count * 8, boxEnd - boxStart - 8)
+            track["stco"] = struct.unpack_from(f">{count}Q", data, boxStart + 8)
+        elif boxType == b"stsz":
+            # A constant sample size is kept as it is, since the count alone can claim billions of samples
+            sampleSize, count = struct.unpack_from(">II", data, boxStart + 4)
+            track["sampleSize"], track["sampleCount"] = sampleSize, count
+            if not sampleSize:
+                track["stsz"] = readTable(data, boxStart + 4, boxEnd, boxType, 1)
+    return track
+
+def keyframeIndex(track, fileSize):
+    """
+    Packs (milliseconds, byte offset) of every keyframe of a track, from its sample tables. Raises InvalidMp4 if
+    the samples add up to more bytes than the file has.
+    """
+    sampleSize, sampleCount = track.get("sampleSize"), track.get("sampleCount")
+    chunkOffsets = track.get("stco")
+    if not sampleCount or not chunkOffsets or not track.get("stts") or not track.get("stsc") or not track.get("timescale"):
+        return b""
+    if sampleSize:
+        sizeSums = None
+        mediaSize = sampleSize * sampleCount
+    else:
+        sizeSums = array("Q", [0])
+        sizeSums.extend(accumulate(track["stsz"]))
+        mediaSize = sizeSums[-1]
+    if mediaSize > fileSize:
+        raise InvalidMp4("the sample table describes more data than the file holds")
+
+    # Decode time of every run of equally long samples, to find a sample's time by bisecting
+    stts = track["stts"]
+    runStarts, runTimes, sample, time = [], [], 0, 0
+    for index in range(0, len(stts), 2):
+        runStarts.append(sample)
+        runTimes.append(time)
+        sample += stts[index]
+        time += stts[index] * stts[index + 1]
+
+    # First sample of every chunk, from the runs of chunks with the same number of samples. There are never more
+    # chunks than chunk offsets, whatever the runs claim.
+    stsc = track["stsc"]
+    chunkFirstSamples, sample = [], 0
+    for index in range(0, len(stsc), 3):
+        firstChunk, samplesPerChunk = stsc[index], stsc[index + 1]
+        lastChunk = stsc[index + 3] - 1 if index + 3 < len(stsc) else len(chunkOffsets)
+        for _ in range(firstChunk, lastChunk + 1):
+            if len(chunkFirstSamples) == len(chunkOffsets):
+                break
+            chunkFirstSamples.append(sample)
+            sample += samplesPerChunk
+    if not chunkFirstSamples:
+        return b""
+
+    keyframes = [number - 1 for number in track["stss"]] if "stss" in track else \
+        spacedSamples(stts, track["timescale"], sampleCount)
+    entries, lastTime = [], None
+    for keyframe in keyframes:
+        if keyframe >= sampleCount:
+            break
+        if keyframe < 0:
+            continue
+        run = bisect.bisect_right(runStarts, keyframe) - 1
+        seconds = (runTimes[run] + (keyframe - runStarts[run]) * stts[run * 2 + 1]) / track["timescale"]
+        if "stss" not in track and lastTime is not None and seconds - lastTime < MIN_SEEK_SPACING:
+            continue
+        chunk = bisect.bisect_right(chunkFirstSamples, keyframe) - 1
+        if chunk >= len(chunkOffsets):
+            break
+        firstSample = chunkFirstSamples[chunk]
+        withinChunk = (keyframe - firstSample) * sampleSize if sampleSize else sizeSums[keyframe] - sizeSums[firstSample]
+        entries.append(SEEK_ENTRY.pack(round(seconds * 1000), chunkOffsets[chunk] + withinChunk))
+        lastTime = seconds
+    return b"".join(entries)
+
+def spacedSamples(stts, timescale, sampleCount):
+    # Steps through each run of equally long samples MIN_SEEK_SPACING at a time, rather than visiting every sample
+    # of a track that may claim billions of them
+    sample = yielded = 0
+    for index in range(0, len(stts), 2):
+        count, delta = stts[index], stts[index + 1]
+        step = -(-round(MIN_SEEK_SPACING * timescale) // delta) if delta else count
+        for keyframe in range(sample, min(sample + count, sampleCount), max(step, 1)):
+            if yielded == MAX_SPACED_KEYFRAMES:
+                return
+            yielded += 1
+            yield keyframe
+        sample += count
+
+def parseMovie(data):
+    """
+    Returns what the moov box says about the movie, and the track to index keyframes of, or None. The index waits
+    for the whole file, whose size bounds the samples the tables may claim.
+    """
+    tracks = []
+    movieTimescale = movieDuration = None
+    fragmented = False
+    with malformed("moov"):
+        for boxType, start, end in iterBoxes(data, 0, len(data)):
+            if boxType == b"mvhd":
+                movieTimescale, movieDuration = parseTimes(data, start)
+            elif boxType == b"trak":
+                tracks.append(parseTrack(data, start, end, {}))
+            elif boxType == b"mvex":
+                fragmented = True
+    if not movieTimescale:
+        raise InvalidMp4("the moov box has no movie header")
+
+    video = next((track for track in tracks if track.get("handler") == b"vide"), None)
+    duration = movieDuration / movieTimescale
+    if not duration and video is not None and video.get("timescale"):
+        duration = video.get("duration", 0) / video["timescale"]
+    # Video first, the way browsers expect the codecs parameter of a MIME type
+    ordered = sorted(tracks, key=lambda track: track.get("handler") != b"vide")
+    return {
+        "duration": duration,
+        "width": video.get("width") if video else None,
+        "height": video.get("height") if video else None,
+        "codec": ",".join(track["codec"] for track in ordered
+                          if track.get("codec") and track.get("handler") in (b"vide", b"soun")) or None,
+        "fragmented": fragmented,
+    }, None if fragmented else video
+
+class Mp4Parser:
+    """
+    Parses an MP4 from its bytes, fed in order as they arrive. Raises InvalidMp4 as soon as the bytes cannot be an
+    MP4, which is after the first box header for most other formats. finish() returns what was found:
+    duration, width, height, codec, moovOffset, mdatOffset, fragmented and the packed seekIndex.
+    """
+    def __init__(self, maxMoovSize=MAX_MOOV_SIZE):
+        self.maxMoovSize = maxMoovSize
+        self.offset = 0
+        self.header = bytearray()
+        self.skip = 0
+        self.box = None
+        self.boxSize = None
+        self.payload = bytearray()
+        self.boxes = 0
+        self.brand = None
+        self.movie = None
+        self.seekTrack = None
+        self.moovOffset = None
+        self.mdatOffset = None
+
+    def startBox(self, boxType, size, headerSize, offset):
+        """Takes a box header. Returns how many payload bytes follow, None if they run to the end of the file."""
+        if self.boxes == 0 and boxType != b"ftyp":
+            raise InvalidMp4("the file does not start with an ftyp box")
+        if not all(32 <= character < 127 for character in boxType):
+            raise InvalidMp4("a box has a type that is not text")
+        if size != 0 and size < headerSize:
+            raise InvalidMp4(f"the {boxType.decode('latin-1')} box is too small")
+        self.boxes += 1
+        if boxType in KEPT_BOXES and size - headerSize > self.maxMoovSize:
+            raise InvalidMp4(f"the {boxType.decode('latin-1')} box is too large")
+        if boxType == b"moov":
+            if self.movie is not None:
+                raise InvalidMp4("the file has more than one moov box")
+            self.moovOffset = offset
+        elif boxType == b"mdat" and self.mdatOffset is None:
+            self.mdatOffset = offset
+        return None if size == 0 else size - headerSize
+
+    def endBox(self, boxType, payload):
+        if boxType == b"ftyp":
+            if len(payload) < 8:
+                raise InvalidMp4("the ftyp box is too small")
+            self.brand = bytes(payload[:4]).decode("latin-1")
+        elif boxType == b"moov":
+            self.movie, self.seekTrack = parseMovie(memoryview(payload))
+
+    def feed(self, data):
+        view = memoryview(data)
+        position = 0
+        while position < len(view):
+            if self.skip:
+                step = min(self.skip, len(view) - position)
+                self.skip -= step
+                position += step
+                self.offset += step
+            elif self.box is not None:
+                step = len(view) - position if self.boxSize is None else min(self.boxSize - len(self.payload), len(view) - position)
+                self.payload += view[position:position + step]
+                position += step
+                self.offset += step
+                if self.boxSize is None and len(self.payload) > self.maxMoovSize:
+                    raise InvalidMp4("the moov box is too large")
+                if len(self.payload) == self.boxSize:
+                    self.endBox(self.box, self.payload)
+                    self.box = None
+                    self.payload = bytearray()
+            else:
+                needed = 16 if len(self.header) >= 4 and self.header[:4] == b"\x00\x00\x00\x01" else 8
+                step = min(needed - len(self.header), len(view) - position)
+                self.header += view[position:position + step]
+                position += step
+                self.offset += step
+                if len(self.header) == 8 and self.header[:4] == b"\x00\x00\x00\x01":
+                    continue
+                if len(self.header) < needed:
+                    continue
+                size, boxType = struct.unpack_from(">I4s", self.header)
+                if size == 1:
+                    size, = struct.unpack_from(">Q", self.header, 8)
+                remaining = self.startBox(boxType, size, len(self.header), self.offset - len(self.header))
+                self.header = bytearray()
+                if boxType in KEPT_BOXES:
+                    self.box, self.boxSize = boxType, remaining
+                    if remaining == 0:
+                        self.endBox(boxType, b"")
+                        self.box = None
+                else:
+                    self.skip = float("inf") if remaining is None else remaining
+
+    def finish(self):
+        if self.box is not None and self.boxSize is None:
+            self.endBox(self.box, self.payload)
+        elif self.box is not None or self.header or (self.skip and self.skip != float("inf")):
+            raise InvalidMp4("the file ends in the middle of a box")
+        if self.brand is None:
+            raise InvalidMp4("the file does not start with an ftyp box")
+        if self.movie is None:
+            raise InvalidMp4("the file has no moov box")
+        seekIndex = b""
+        if self.seekTrack is not None:
+            with malformed("moov"):
+                seekIndex = keyframeIndex(self.seekTrack, self.offset)
+        return {**self.movie, "seekIndex": seekIndex, "brand": self.brand, "moovOffset": self.moovOffset, "mdatOffset": self.mdatOffset}
+
+def parseFile(path, maxMoovSize=MAX_MOOV_SIZE):
+    """Parses an MP4 on disk, seeking over the media data instead of reading it."""
+    parser = Mp4Parser(maxMoovSize)
+    size = os.path.getsize(path)
+    with open(path, "rb") as file:
+        offset = 0
+        while offset < size:
+            header = file.read(8)
+            if len(header) < 8:
+                raise InvalidMp4("the file ends in the middle of a box")
+            boxSize, boxType = struct.unpack(">I4s", header)
+            if boxSize == 1:
+                extended = file.read(8)
+                if len(extended) < 8:
+                    raise InvalidMp4("the file ends in the middle of a box")
+                header += extended
+                boxSize, = struct.unpack(">Q", extended)
+            remaining = parser.startBox(boxType, boxSize, len(header), offset)
+            if remaining is None:
+                remaining = size - offset - len(header)
+            if offset + len(header) + remaining > size:
+                raise InvalidMp4("the file ends in the middle of a box")
+            # A box that runs to the end of the file only has its size now, and must not be read whole if it is huge
+            if boxType in KEPT_BOXES and remaining > parser.maxMoovSize:
+                raise InvalidMp4(f"the {boxType.decode('latin-1')} box is too large")
+            if boxType in KEPT_BOXES:
+                parser.endBox(boxType, file.read(remaining))
+            else:
+                file.seek(remaining, io.SEEK_CUR)
+            offset += len(header) + remaining
+            parser.offset = offset
+    return parser.finish()
+
+def seekEntry(seekIndex, seconds):
+    """Returns (seconds, byte offset) of the last keyframe at or before seconds, or the first one if none is."""
+    if not seekIndex:
+        return None
+    times = [milliseconds for milliseconds, _ in SEEK_ENTRY.iter_unpack(seekIndex)]
+    index = max(bisect.bisect_right(times, round(seconds * 1000)) - 1, 0)
+    milliseconds, offset = SEEK_ENTRY.unpack_from(seekIndex, index * SEEK_ENTRY.size)
+    return milliseconds / 1000, offset
@@ -0,0 +1,57 @@
+"""
+Measures what parsing uploads as MP4 costs: bytes per second through Mp4Parser.feed next to plain reads and the
+SHA-256 every upload already pays for, and how long parseFile takes to seek through a finished upload. Writes a
+synthetic MP4 of the given size first. Run it from the back-end folder:
+
+    python mp4_benchmark.py --size-gb 4 --frame-size 100000
+"""
+from mp4 import READ_SIZE, Mp4Parser, SEEK_ENTRY, parseFile
+from mp4_fixtures import writeMp4
+import hashlib, os, tempfile, time, click
+
+def throughput(path, consume):
+    # Reads the file the way uploads arrive, READ_SIZE bytes at a time, handing every piece to consume
+    start = time.perf_counter()
+    with open(path, "rb") as file:
+        while True:
+            data = file.read(READ_SIZE)
+            if not data:
+                break
+            consume(data)
+    seconds = time.perf_counter() - start
+    return os.path.getsize(path) / seconds / 2 ** 20, seconds
+
+@click.command()
+@click.option("--size-gb", default=2.0, help="Size of the synthetic clip.")
+@click.option("--frame-size", default=100000, help="Bytes per video frame, which sets how many samples the moov box indexes.")
+@click.option("--keyframe-interval", default=60)
+@click.option("--faststart/--no-faststart", default=True, help="Whether the moov box comes before the media data.")
+def mp4Benchmark(size_gb, frame_size, keyframe_interval, faststart):
+    frames = int(size_gb * 2 ** 30 / frame_size)
+    handle, path = tempfile.mkstemp(suffix=".mp4")
+    try:
+        with os.fdopen(handle, "wb") as file:
+            writeMp4(file, width=1920, height=1080, frames=frames, frameSize=frame_size,
+                keyframeInterval=keyframe_interval, faststart=faststart)
+        print(f"{os.path.getsize(path) / 2 ** 30:.2f} GB, {frames} frames, moov {'first' if faststart else 'last'}")
+
+        readRate, _ = throughput(path, lambda data: None)
+        digest = hashlib.sha256()
+        hashRate, _ = throughput(path, digest.update)
+        parser = Mp4Parser()
+        parseRate, _ = throughput(path, parser.feed)
+        info = parser.finish()
+        print(f"{'read':>8}{readRate:>10.0f} MB/s")
+        print(f"{'sha256':>8}{hashRate:>10.0f} MB/s")
+        print(f"{'feed':>8}{parseRate:>10.0f} MB/s")
+
+        start = time.perf_counter()
+        parseFile(path)
+        print(f"parseFile: {(time.perf_counter() - start) * 1000:.1f} ms, "
+              f"{len(info['seekIndex']) // SEEK_ENTRY.size} keyframes in a {len(info['seekIndex'])} byte index, "
+              f"{info['duration']:.0f} s of video")
+    finally:
+        os.remove(path)
+
+if __name__ == "__main__":
+    mp4Benchmark()
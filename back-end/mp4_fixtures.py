@@ -0,0 +1,76 @@
+"""
+Writes small, well-formed MP4 files for tests and benchmarks. Players cannot decode them, but every box the parser
+in mp4.py reads is there.
+"""
+import io, struct
+
+def box(boxType, *parts):
+    payload = b"".join(parts)
+    return struct.pack(">I4s", 8 + len(payload), boxType) + payload
+
+def fullBox(boxType, version, *parts):
+    return box(boxType, struct.pack(">I", version << 24), *parts)
+
+def movieBox(width, height, timescale, frameDuration, sizes, keyframeInterval, chunkOffsets, samplesPerChunk, co64):
+    frames = len(sizes)
+    duration = frames * frameDuration
+    matrix = struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    visualEntry = box(b"avc1", b"\x00" * 6, struct.pack(">H", 1), b"\x00" * 16, struct.pack(">HH", width, height),
+        struct.pack(">III", 0x480000, 0x480000, 0), struct.pack(">H", 1), b"\x00" * 32, struct.pack(">Hh", 0x18, -1),
+        box(b"avcC", bytes([1, 0x64, 0x00, 0x1F, 0xFF, 0xE0, 0x00])))
+    keyframes = range(1, frames + 1, keyframeInterval)
+    sampleTable = box(b"stbl",
+        fullBox(b"stsd", 0, struct.pack(">I", 1), visualEntry),
+        fullBox(b"stts", 0, struct.pack(">III", 1, frames, frameDuration)),
+        fullBox(b"stss", 0, struct.pack(f">I{len(keyframes)}I", len(keyframes), *keyframes)),
+        fullBox(b"stsc", 0, struct.pack(">IIII", 1, 1, samplesPerChunk, 1)),
+        fullBox(b"stsz", 0, struct.pack(f">II{frames}I", 0, frames, *sizes)),
+        fullBox(b"co64", 0, struct.pack(f">I{len(chunkOffsets)}Q", len(chunkOffsets), *chunkOffsets)) if co64 else
+        fullBox(b"stco", 0, struct.pack(f">I{len(chunkOffsets)}I", len(chunkOffsets), *chunkOffsets)))
+    return box(b"moov",
+        fullBox(b"mvhd", 0, struct.pack(">IIII", 0, 0, timescale, duration), struct.pack(">IH", 0x10000, 0x100),
+            b"\x00" * 10, matrix, b"\x00" * 24, struct.pack(">I", 2)),
+        box(b"trak",
+            fullBox(b"tkhd", 0, struct.pack(">IIIII", 0, 0, 1, 0, duration), b"\x00" * 8, struct.pack(">HHHH", 0, 0, 0, 0),
+                matrix, struct.pack(">II", width << 16, height << 16)),
+            box(b"mdia",
+                fullBox(b"mdhd", 0, struct.pack(">IIIIHH", 0, 0, timescale, duration, 0x55C4, 0)),
+                fullBox(b"hdlr", 0, struct.pack(">I4s", 0, b"vide"), b"\x00" * 12, b"VideoHandler\x00"),
+                box(b"minf", fullBox(b"vmhd", 1, b"\x00" * 8), sampleTable))))
+
+def writeMp4(file, width=640, height=360, frames=300, timescale=30000, frameDuration=1001, frameSize=2000,
+             keyframeInterval=60, samplesPerChunk=30, faststart=True):
+    """
+    Writes a minimal but well-formed H.264 MP4 with frames of frameSize zero bytes, for tests and benchmarks.
+    Players cannot decode it, but every box the parser reads is there.
+    """
+    sizes = [frameSize] * frames
+    fileType = box(b"ftyp", b"isom", struct.pack(">I", 0x200), b"isomiso2avc1mp41")
+    mediaSize = frameSize * frames
+    co64 = mediaSize + len(fileType) + 1024 * 1024 >= 2 ** 32
+    chunkCount = -(-frames // samplesPerChunk)
+
+    def layout(mediaStart):
+        offsets = [mediaStart + chunk * samplesPerChunk * frameSize for chunk in range(chunkCount)]
+        return movieBox(width, height, timescale, frameDuration, sizes, keyframeInterval, offsets, samplesPerChunk, co64)
+
+    mediaHeader = struct.pack(">I4sQ", 1, b"mdat", 16 + mediaSize)
+    if faststart:
+        moovSize = len(layout(0))
+        file.write(fileType)
+        file.write(layout(len(fileType) + moovSize + len(mediaHeader)))
+    else:
+        file.write(fileType)
+    file.write(mediaHeader)
+    zeros = bytes(min(mediaSize, 1024 * 1024))
+    remaining = mediaSize
+    while remaining:
+        file.write(zeros[:min(remaining, len(zeros))])
+        remaining -= min(remaining, len(zeros))
+    if not faststart:
+        file.write(layout(len(fileType) + len(mediaHeader)))
+
+def buildMp4(**options):
+    file = io.BytesIO()
+    writeMp4(file, **options)
+    return file.getvalue()
@@ -0,0 +1,107 @@
+"""
+Measures GET /search against growing numbers of clips, to show that a search costs as much as the clips it
+matches rather than the size of the table. Run it from the back-end folder:
+
+    python search_benchmark.py --sizes 10000,100000,1000000
+"""
+from application import app, db, responseCache, searchQuery, User, Clip
+from benchmark import insertInBatches, percentile, randomDate
+from cache import NoCache
+import itertools, os, random, time, uuid, click
+
+SYLLABLES = [consonant + vowel for consonant in "bdfgklmnprstvz" for vowel in "aeiou"]
+# Titles are short and descriptions a bit longer, with words drawn from the vocabulary by popularity
+TITLE_WORDS = (2, 4)
+DESCRIPTION_WORDS = (0, 12)
+
+def vocabularyWord(index):
+    # A made-up word per index: 70 one-syllable words, then 4900 two-syllable ones, and so on
+    syllables = []
+    while True:
+        index, syllable = divmod(index, len(SYLLABLES))
+        syllables.append(SYLLABLES[syllable])
+        if index == 0:
+            return "".join(syllables)
+        index -= 1
+
+def vocabularySize(clips):
+    # New words keep turning up as a site grows (Heaps' law), so the vocabulary grows with the square root
+    return max(1000, int(50 * clips ** 0.5))
+
+def zipfWeights(count):
+    return list(itertools.accumulate(1 / rank for rank in range(1, count + 1)))
+
+def randomText(rng, words, weights, counts):
+    return " ".join(rng.choices(words, cum_weights=weights, k=rng.randint(*counts)))
+
+def generateClips(rng, users, clips):
+    words = [vocabularyWord(index) for index in range(vocabularySize(clips))]
+    weights = zipfWeights(len(words))
+    insertInBatches(User.__table__, ({"id": id, "username": f"{vocabularyWord(id)}{id}", "password": "benchmark"}
+        for id in range(1, users + 1)))
+    insertInBatches(Clip.__table__, ({"id": id, "clipUuid": str(uuid.UUID(int=rng.getrandbits(128))),
+        "authorId": rng.randint(1, users), "dateOfCreation": randomDate(rng),
+        "title": randomText(rng, words, weights, TITLE_WORDS)[:20],
+        "description": randomText(rng, words, weights, DESCRIPTION_WORDS), "processingStatus": "ready"}
+        for id in range(1, clips + 1)))
+    db.session.commit()
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO clip_search (clip_search) VALUES ('optimize')")
+
+# (name, query(rng, words, weights)) for the kinds of searches people type
+QUERY_MIX = [
+    ("one word", lambda rng, words, weights: rng.choices(words, cum_weights=weights)[0]),
+    ("two words", lambda rng, words, weights: " ".join(rng.choices(words, cum_weights=weights, k=2))),
+    ("prefix", lambda rng, words, weights: rng.choices(words, cum_weights=weights)[0][:3]),
+    ("rare word", lambda rng, words, weights: rng.choice(words[len(words) // 2:])),
+]
+
+def measureSize(rng, clips, queries):
+    words = [vocabularyWord(index) for index in range(vocabularySize(clips))]
+    weights = zipfWeights(len(words))
+    client = app.test_client()
+    results = {}
+    for name, query in QUERY_MIX:
+        latencies = []
+        matches = []
+        for _ in range(queries):
+            text = query(rng, words, weights)
+            start = time.perf_counter()
+            response = client.get("/search", query_string={"q": text, "limit": 20})
+            response.get_data()
+            latencies.append((time.perf_counter() - start) * 1000)
+            with db.engine.connect() as connection:
+                matches.append(connection.exec_driver_sql("SELECT COUNT(*) FROM clip_search WHERE clip_search MATCH ?",
+                    (searchQuery(text),)).scalar())
+        latencies.sort()
+        results[name] = {"p50": round(percentile(latencies, 50), 3), "p95": round(percentile(latencies, 95), 3),
+                         "matches": round(sum(matches) / len(matches), 1)}
+    return results
+
+@click.command()
+@click.option("--seed", default=1)
+@click.option("--sizes", default="10000,100000,1000000", help="Comma separated clip counts to measure.")
+@click.option("--users", default=10000)
+@click.option("--queries", default=200, help="Searches of each kind per size.")
+@click.option("--data", default="benchmark-data", help="Folder where generated databases are kept for the next run.")
+def searchBenchmark(seed, sizes, users, queries, data):
+    responseCache.backend = NoCache()
+    os.makedirs(data, exist_ok=True)
+    print(f"{'clips':>10}  {'search':<12}{'p50 ms':>9}{'p95 ms':>9}{'matches':>10}")
+    for clips in [int(size) for size in sizes.split(",")]:
+        dataPath = os.path.abspath(os.path.join(data, f"search-seed{seed}-{users}u-{clips}c.db"))
+        with app.app_context():
+            app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{dataPath}"
+            try:
+                if not os.path.exists(dataPath):
+                    print(f"Generating {dataPath}")
+                    db.create_all()
+                    generateClips(random.Random(seed), users, clips)
+                for name, result in measureSize(random.Random(seed), clips, queries).items():
+                    print(f"{clips:>10}  {name:<12}{result['p50']:>9}{result['p95']:>9}{result['matches']:>10}")
+            finally:
+                db.session.remove()
+                db.engine.dispose()
+
+if __name__ == "__main__":
+    searchBenchmark()
@@ -0,0 +1,128 @@
+"""
+How API responses are encoded and compressed. Views return dicts and lists, and SerializingFlask turns them into
+JSON, or MessagePack for clients that ask for it in Accept. Bodies over a size threshold are then compressed with
+the best encoding the client accepts. orjson, msgpack, brotli and zstandard are all optional: without them JSON
+comes from the standard library, and only the representations and encodings that are installed are offered.
+"""
+from datetime import date, datetime
+from flask import Flask, request
+import gzip, json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Levels that suit bodies compressed once per request: most of the size saving for little CPU
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+# Bodies that are worth compressing. Clip and thumbnail bytes are compressed already, and event streams are sent
+# a piece at a time.
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/msgpack", "text/plain", "text/html"}
+
+def encodeValue(value):
+    # Dates keep the "2021-01-01 12:00:00.123456" form the API has always sent, rather than orjson's ISO 8601
+    if isinstance(value, datetime):
+        return str(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} cannot be serialized")
+
+class JsonRepresentation:
+    name = "json"
+    mimetype = "application/json"
+
+    def dumps(self, data):
+        if orjson is not None:
+            return orjson.dumps(data, default=encodeValue, option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+        return json.dumps(data, default=encodeValue, separators=(",", ":")).encode()
+
+class MsgpackRepresentation:
+    name = "msgpack"
+    mimetype = "application/msgpack"
+
+    def dumps(self, data):
+        return msgpack.packb(data, default=encodeValue, use_bin_type=True)
+
+# For JSON written outside responses, such as comment events
+JSON = JsonRepresentation()
+
+def availableRepresentations():
+    # JSON comes first, so it is what a client that accepts anything gets
+    return [JsonRepresentation()] + ([MsgpackRepresentation()] if msgpack is not None else [])
+
+def availableEncodings():
+    """The content codings this process can write, best first, each a function from bytes to bytes."""
+    encodings = {}
+    if zstandard is not None:
+        encodings["zstd"] = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress
+    if brotli is not None:
+        encodings["br"] = lambda data: brotli.compress(data, quality=BROTLI_QUALITY)
+    encodings["gzip"] = lambda data: gzip.compress(data, compresslevel=GZIP_LEVEL)
+    return encodings
+
+def negotiateRepresentation(accept, representations):
+    # accept is a werkzeug MIMEAccept. "application/x-msgpack" is what older MessagePack clients send.
+    aliases = {"application/x-msgpack": "application/msgpack"}
+    offered = [representation.mimetype for representation in representations] + \
+        [alias for alias, mimetype in aliases.items() if any(r.mimetype == mimetype for r in representations)]
+    match = accept.best_match(offered, default=representations[0].mimetype)
+    match = aliases.get(match, match)
+    return next(representation for representation in representations if representation.mimetype == match)
+
+def negotiateEncoding(acceptEncoding, encodings):
+    """The best of encodings the Accept-Encoding header allows, or None to send the body as it is."""
+    best, bestQuality = None, 0
+    for name in encodings:
+        quality = acceptEncoding.quality(name)
+        if quality > bestQuality:
+            best, bestQuality = name, quality
+    return best
+
+class SerializingFlask(Flask):
+    """A Flask app whose views can return dicts and lists, in any representation in self.representations."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.representations = availableRepresentations()
+        self.encodings = availableEncodings()
+
+    def representation(self):
+        return negotiateRepresentation(request.accept_mimetypes, self.representations)
+
+    def serialize(self, data):
+        representation = self.representation()
+        return self.response_class(representation.dumps(data), mimetype=representation.mimetype)
+
+    def make_response(self, rv):
+        if isinstance(rv, tuple) and isinstance(rv[0], (dict, list)):
+            rv = (self.serialize(rv[0]),) + rv[1:]
+        elif isinstance(rv, (dict, list)):
+            rv = self.serialize(rv)
+        return super().make_response(rv)
+
+def compressResponse(response, acceptEncoding, encodings, minimumSize):
+    """Compresses response in place with the best encoding acceptEncoding allows, if it is worth compressing."""
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or response.is_streamed or response.direct_passthrough:
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.status_code != 200 or "Content-Encoding" in response.headers or response.content_length < minimumSize:
+        return response
+    encoding = negotiateEncoding(acceptEncoding, encodings)
+    if encoding is None:
+        return response
+    response.set_data(encodings[encoding](response.get_data()))
+    response.headers["Content-Encoding"] = encoding
+    return response
@@ -0,0 +1,65 @@
+"""
+Measures API response encoding on synthetic payloads shaped like the real ones: clip id lists, pages of clip
+summaries and comment lists. Prints the time to serialize each with the standard library json, orjson and
+MessagePack, and the bytes on the wire with each content coding, for whichever of those are installed. Run it
+from the back-end folder:
+
+    python serialization_benchmark.py --ids 100000 --page-size 50
+"""
+from serialization import GZIP_LEVEL, BROTLI_QUALITY, ZSTD_LEVEL, encodeValue, orjson, msgpack, brotli, zstandard
+from datetime import datetime, timedelta
+import gzip, json, random, time, uuid, click
+
+def payloads(rng, ids, pageSize, comments):
+    start = datetime(2021, 1, 1)
+    clipIds = sorted(rng.sample(range(1, ids * 10), ids), reverse=True)
+    page = [{"id": id, "title": f"clip {id}", "description": "A clip of something that happened",
+             "author": f"user{rng.randint(1, 10000)}", "date": start + timedelta(seconds=id),
+             "clipUuid": str(uuid.UUID(int=rng.getrandbits(128), version=4)), "views": rng.randint(0, 10 ** 6),
+             "comments": rng.randint(0, 1000), "duration": rng.uniform(1, 60)} for id in clipIds[:pageSize]]
+    commentList = [{"id": id, "comment": "Nice clip" * rng.randint(1, 10), "author": f"user{rng.randint(1, 10000)}",
+                    "date": start + timedelta(seconds=id)} for id in range(1, comments + 1)]
+    return [("ids (100)", clipIds[:100]), (f"ids ({ids})", clipIds), (f"clip page ({pageSize})", page),
+            (f"comments ({comments})", commentList)]
+
+def serializers():
+    yield "json", lambda data: json.dumps(data, default=encodeValue, separators=(",", ":")).encode()
+    if orjson is not None:
+        yield "orjson", lambda data: orjson.dumps(data, default=encodeValue,
+                                                  option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+    if msgpack is not None:
+        yield "msgpack", lambda data: msgpack.packb(data, default=encodeValue, use_bin_type=True)
+
+def encodings():
+    yield "identity", lambda data: data
+    yield "gzip", lambda data: gzip.compress(data, compresslevel=GZIP_LEVEL)
+    if brotli is not None:
+        yield "br", lambda data: brotli.compress(data, quality=BROTLI_QUALITY)
+    if zstandard is not None:
+        yield "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress
+
+def timed(run, data, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = run(data)
+    return result, (time.perf_counter() - start) / repeat * 1000
+
+@click.command()
+@click.option("--ids", default=10000, help="Length of the long clip id list.")
+@click.option("--page-size", default=50)
+@click.option("--comments", default=1000)
+@click.option("--repeat", default=20, help="Times each payload is encoded, averaged.")
+@click.option("--seed", default=0)
+def serializationBenchmark(ids, page_size, comments, repeat, seed):
+    for name, data in payloads(random.Random(seed), ids, page_size, comments):
+        print(name)
+        for serializerName, serialize in serializers():
+            body, milliseconds = timed(serialize, data, repeat)
+            sizes = []
+            for encodingName, encode in encodings():
+                encoded, encodeMilliseconds = timed(encode, body, repeat)
+                sizes.append(f"{encodingName} {len(encoded):>9} B {encodeMilliseconds:7.3f} ms")
+            print(f"  {serializerName:>8} {milliseconds:8.3f} ms  " + "  ".join(sizes))
+
+if __name__ == "__main__":
+    serializationBenchmark()
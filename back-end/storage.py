@@ -0,0 +1,258 @@
+from urllib.parse import quote, urlsplit
+from datetime import datetime, timezone
+from xml.etree import ElementTree
+import hashlib, hmac, http.client, os, re, shutil, tempfile
+
+READ_SIZE = 64 * 1024
+# An upload or rendition file left by the flat layout that came before sharding, e.g. <uuid>-720p.mp4
+FLAT_CLIP_FILE = re.compile(r"^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(?:-(\w+))?\.mp4$")
+UUID_PATTERN = r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+# The keys this app writes, by kind. Anything else in storage is left alone.
+KEY_PATTERNS = [
+    ("blob", re.compile(r"^blobs/[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})\.mp4$")),
+    ("upload", re.compile(rf"^[0-9a-f]{{2}}/[0-9a-f]{{2}}/({UUID_PATTERN})\.mp4$")),
+    ("rendition", re.compile(rf"^[0-9a-f]{{2}}/[0-9a-f]{{2}}/({UUID_PATTERN})-(\w+)\.mp4$")),
+    ("thumbnail", re.compile(rf"^thumbnails/[0-9a-f]{{2}}/({UUID_PATTERN})-(\w+)\.jpg$")),
+]
+S3_NAMESPACE = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+
+def clipKey(clipUuid, name=None):
+    # Two levels of two hex characters split the clips over 65536 directories, which keeps each one to a few
+    # thousand entries even with hundreds of millions of files
+    fileName = f"{clipUuid}.mp4" if name is None else f"{clipUuid}-{name}.mp4"
+    return f"{clipUuid[:2]}/{clipUuid[2:4]}/{fileName}"
+
+def blobKey(digest):
+    # An upload stored once under the SHA-256 of its bytes, however many clips use it
+    return f"blobs/{digest[:2]}/{digest[2:4]}/{digest}.mp4"
+
+def parseKey(key):
+    """Returns (kind, uuid or digest, name or None) for a key this app writes, or None for any other key."""
+    for kind, pattern in KEY_PATTERNS:
+        match = pattern.match(key)
+        if match:
+            return kind, match.group(1), match.group(2) if pattern.groups > 1 else None
+    return None
+
+def keyPath(directory, key):
+    return os.path.join(directory, *key.split("/"))
+
+class LocalStorage:
+    """Keeps clip files under one directory, at the path their key names."""
+    redirects = False
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return keyPath(self.directory, key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def putFile(self, sourcePath, key):
+        # Moves a finished local file into storage
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(sourcePath, path)
+
+    def takeFile(self, key, destinationPath):
+        os.replace(self.path(key), destinationPath)
+
+    def delete(self, key):
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+    def url(self, key):
+        return None
+
+    def workspace(self, keys):
+        # The files are already where the encoders can read and write them
+        return self.directory
+
+    def releaseWorkspace(self, directory, keys):
+        pass
+
+    def listKeys(self):
+        """Yields (key, size, modification time) of every file under the directory."""
+        for root, directories, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield "/".join(os.path.relpath(path, self.directory).split(os.sep)), stat.st_size, stat.st_mtime
+
+def signingKey(secretKey, date, region, service="s3"):
+    key = f"AWS4{secretKey}".encode()
+    for part in (date, region, service, "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    return key
+
+def canonicalQuery(parameters):
+    return "&".join(f"{quote(name, safe='-_.~')}={quote(value, safe='-_.~')}" for name, value in sorted(parameters.items()))
+
+def signatureV4(secretKey, region, amzDate, canonicalRequest):
+    """Signs a canonical request as described in the AWS Signature Version 4 documentation."""
+    scope = f"{amzDate[:8]}/{region}/s3/aws4_request"
+    stringToSign = "\n".join(["AWS4-HMAC-SHA256", amzDate, scope, hashlib.sha256(canonicalRequest.encode()).hexdigest()])
+    return hmac.new(signingKey(secretKey, amzDate[:8], region), stringToSign.encode(), hashlib.sha256).hexdigest()
+
+def presignedQuery(method, host, path, accessKey, secretKey, region, amzDate, expires):
+    parameters = {"X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+                  "X-Amz-Credential": f"{accessKey}/{amzDate[:8]}/{region}/s3/aws4_request",
+                  "X-Amz-Date": amzDate, "X-Amz-Expires": str(expires), "X-Amz-SignedHeaders": "host"}
+    canonicalRequest = "\n".join([method, quote(path, safe="/-_.~"), canonicalQuery(parameters), f"host:{host}\n",
+                                  "host", "UNSIGNED-PAYLOAD"])
+    parameters["X-Amz-Signature"] = signatureV4(secretKey, region, amzDate, canonicalRequest)
+    return canonicalQuery(parameters)
+
+def authorizationHeader(method, path, headers, accessKey, secretKey, region, amzDate, query=None):
+    # headers must hold every header to sign, including host, x-amz-date and x-amz-content-sha256
+    names = sorted(name.lower() for name in headers)
+    values = {name.lower(): " ".join(str(value).split()) for name, value in headers.items()}
+    canonicalRequest = "\n".join([method, quote(path, safe="/-_.~"), canonicalQuery(query or {}),
+                                  "".join(f"{name}:{values[name]}\n" for name in names), ";".join(names),
+                                  values["x-amz-content-sha256"]])
+    signature = signatureV4(secretKey, region, amzDate, canonicalRequest)
+    return (f"AWS4-HMAC-SHA256 Credential={accessKey}/{amzDate[:8]}/{region}/s3/aws4_request,"
+            f"SignedHeaders={';'.join(names)},Signature={signature}")
+
+class StorageError(Exception):
+    pass
+
+class S3Storage:
+    """
+    Keeps clip files as objects in a bucket of any S3-compatible service (AWS S3, MinIO, Ceph...), addressed
+    path-style as <endpoint>/<bucket>/<key>. Clips are served by redirecting to a presigned URL, so their bytes
+    never pass through the app. Encoding needs local files, so the process-clips worker downloads each upload
+    into a scratch workspace and uploads what it made.
+    """
+    redirects = True
+
+    def __init__(self, endpoint, bucket, accessKey, secretKey, region="us-east-1", urlExpiry=3600, scratchDirectory=None):
+        endpoint = urlsplit(endpoint)
+        self.secure = endpoint.scheme == "https"
+        self.host = endpoint.netloc
+        self.basePath = endpoint.path.rstrip("/")
+        self.bucket = bucket
+        self.accessKey = accessKey
+        self.secretKey = secretKey
+        self.region = region
+        self.urlExpiry = urlExpiry
+        self.scratchDirectory = scratchDirectory
+
+    def objectPath(self, key):
+        return f"{self.basePath}/{self.bucket}/{key}"
+
+    def request(self, method, key, body=None, headers=None, query=None):
+        amzDate = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+        signedHeaders = {"host": self.host, "x-amz-date": amzDate, "x-amz-content-sha256": "UNSIGNED-PAYLOAD", **(headers or {})}
+        signedHeaders["Authorization"] = authorizationHeader(method, self.objectPath(key), signedHeaders,
+            self.accessKey, self.secretKey, self.region, amzDate, query)
+        connection = (http.client.HTTPSConnection if self.secure else http.client.HTTPConnection)(self.host)
+        target = quote(self.objectPath(key), safe="/-_.~") + (f"?{canonicalQuery(query)}" if query else "")
+        connection.request(method, target, body=body, headers=signedHeaders)
+        return connection, connection.getresponse()
+
+    def call(self, method, key, expected, body=None, headers=None):
+        connection, response = self.request(method, key, body, headers)
+        try:
+            response.read()
+            if response.status not in expected:
+                raise StorageError(f"{method} {key} answered {response.status}")
+            return response.status
+        finally:
+            connection.close()
+
+    def exists(self, key):
+        return self.call("HEAD", key, (200, 404)) == 200
+
+    def putFile(self, sourcePath, key):
+        with open(sourcePath, "rb") as file:
+            self.call("PUT", key, (200,), file, {"Content-Length": str(os.path.getsize(sourcePath))})
+        os.remove(sourcePath)
+
+    def download(self, key, destinationPath):
+        connection, response = self.request("GET", key)
+        try:
+            if response.status != 200:
+                raise StorageError(f"GET {key} answered {response.status}")
+            with open(destinationPath, "wb") as file:
+                while True:
+                    data = response.read(READ_SIZE)
+                    if not data:
+                        break
+                    file.write(data)
+        finally:
+            connection.close()
+
+    def takeFile(self, key, destinationPath):
+        self.download(key, destinationPath)
+        self.delete(key)
+
+    def delete(self, key):
+        # S3 answers 204 whether or not the object existed
+        self.call("DELETE", key, (200, 204, 404))
+
+    def url(self, key):
+        query = presignedQuery("GET", self.host, self.objectPath(key), self.accessKey, self.secretKey, self.region,
+            datetime.utcnow().strftime("%Y%m%dT%H%M%SZ"), self.urlExpiry)
+        return f"{'https' if self.secure else 'http'}://{self.host}{quote(self.objectPath(key), safe='/-_.~')}?{query}"
+
+    def workspace(self, keys):
+        """Downloads keys into a new scratch directory, at the same paths they have in storage."""
+        directory = tempfile.mkdtemp(dir=self.scratchDirectory)
+        for key in keys:
+            path = keyPath(directory, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.download(key, path)
+        return directory
+
+    def releaseWorkspace(self, directory, keys):
+        """Uploads whichever of keys were written in the workspace, then removes it."""
+        try:
+            for key in keys:
+                path = keyPath(directory, key)
+                if os.path.exists(path):
+                    self.putFile(path, key)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def listKeys(self):
+        """Yields (key, size, modification time) of every object in the bucket, a page of ListObjectsV2 at a time."""
+        query = {"list-type": "2"}
+        while True:
+            connection, response = self.request("GET", "", query=query)
+            try:
+                body = response.read()
+                if response.status != 200:
+                    raise StorageError(f"listing {self.bucket} answered {response.status}")
+            finally:
+                connection.close()
+            result = ElementTree.fromstring(body)
+            for item in result.iter(f"{S3_NAMESPACE}Contents"):
+                modified = datetime.strptime(item.findtext(f"{S3_NAMESPACE}LastModified")[:19], "%Y-%m-%dT%H:%M:%S")
+                yield (item.findtext(f"{S3_NAMESPACE}Key"), int(item.findtext(f"{S3_NAMESPACE}Size")),
+                       modified.replace(tzinfo=timezone.utc).timestamp())
+            if result.findtext(f"{S3_NAMESPACE}IsTruncated") != "true":
+                break
+            query = {"list-type": "2", "continuation-token": result.findtext(f"{S3_NAMESPACE}NextContinuationToken")}
+
+def createStorage(name, directory, endpoint=None, bucket=None, accessKey=None, secretKey=None, region=None, urlExpiry=3600):
+    if name == "s3":
+        return S3Storage(endpoint, bucket, accessKey, secretKey, region, urlExpiry, directory)
+    return LocalStorage(directory)
+
+def migrateFlatLayout(directory):
+    """Moves uploads and renditions from the top of directory into their sharded paths, and returns how many moved."""
+    storage = LocalStorage(directory)
+    moved = 0
+    for entry in os.scandir(directory):
+        match = FLAT_CLIP_FILE.match(entry.name)
+        if match is None or not entry.is_file():
+            continue
+        storage.putFile(entry.path, clipKey(match.group(1), match.group(2)))
+        moved += 1
+    return moved
@@ -0,0 +1,108 @@
+from flask import Response, current_app, request
+from werkzeug.http import parse_if_range_header
+from werkzeug.wsgi import wrap_file
+import os, uuid
+
+CHUNK_SIZE = 64 * 1024
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# More ranges than this in one request is treated as abuse and answered with the whole file instead
+MAX_RANGES = 16
+
+def readRange(path, start, stop):
+    with open(path, "rb") as file:
+        file.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def resolveRanges(ranges, size):
+    # Turns the parsed Range header into absolute [start, stop) pairs within the file. Werkzeug has already
+    # rejected ranges that overlap or are out of order, so these never need merging.
+    resolved = []
+    for begin, end in ranges:
+        if begin < 0:
+            start, stop = max(size + begin, 0), size
+        else:
+            start, stop = begin, size if end is None else min(end, size)
+        if start < stop:
+            resolved.append((start, stop))
+    return resolved
+
+def rangesFor(parsedRange, ifRange, etag):
+    # A missing or malformed Range header is ignored, which means the whole file is sent
+    if parsedRange is None or parsedRange.units != "bytes" or len(parsedRange.ranges) > MAX_RANGES:
+        return None
+    # A stale If-Range means the client's partial copy is of a different file, so it gets the whole thing
+    if ifRange is not None and parse_if_range_header(ifRange).etag != etag:
+        return None
+    return parsedRange.ranges
+
+def requestedRanges(etag):
+    return rangesFor(request.range, request.headers.get("If-Range"), etag)
+
+def immutableHeaders(etag):
+    return {"ETag": f'"{etag}"', "Cache-Control": IMMUTABLE_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+
+def multipartRanges(path, ranges, size, mimetype, boundary):
+    for start, stop in ranges:
+        yield (f"--{boundary}\r\nContent-Type: {mimetype}\r\n"
+               f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n").encode()
+        yield from readRange(path, start, stop)
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+def multipartLength(ranges, size, mimetype, boundary):
+    length = len(f"--{boundary}--\r\n")
+    for start, stop in ranges:
+        length += len(f"--{boundary}\r\nContent-Type: {mimetype}\r\n"
+                      f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n")
+        length += stop - start + len("\r\n")
+    return length
+
+def sendImmutableFile(path, etag, mimetype, relativePath):
+    """
+    Sends a file whose contents never change once written, so it can be cached forever under a strong ETag.
+    Handles If-None-Match, If-Range and single, suffix and multiple byte ranges. When SENDFILE_MODE is set the
+    body is left to the front proxy, which then also takes care of ranges.
+    """
+    headers = immutableHeaders(etag)
+
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+
+    sendfileMode = current_app.config.get("SENDFILE_MODE")
+    if sendfileMode == "x-accel-redirect":
+        headers["X-Accel-Redirect"] = f"{current_app.config['SENDFILE_ACCEL_PREFIX'].rstrip('/')}/{relativePath}"
+        return Response(status=200, headers=headers, mimetype=mimetype)
+    if sendfileMode == "x-sendfile":
+        headers["X-Sendfile"] = path
+        return Response(status=200, headers=headers, mimetype=mimetype)
+
+    size = os.path.getsize(path)
+    ranges = requestedRanges(etag)
+
+    if ranges is None:
+        headers["Content-Length"] = str(size)
+        body = wrap_file(request.environ, open(path, "rb"), CHUNK_SIZE)
+        return Response(body, status=200, headers=headers, mimetype=mimetype, direct_passthrough=True)
+
+    ranges = resolveRanges(ranges, size)
+    if not ranges:
+        headers["Content-Range"] = f"bytes */{size}"
+        return Response(status=416, headers=headers)
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        headers["Content-Length"] = str(stop - start)
+        return Response(readRange(path, start, stop), status=206, headers=headers, mimetype=mimetype,
+                        direct_passthrough=True)
+
+    boundary = uuid.uuid4().hex
+    headers["Content-Length"] = str(multipartLength(ranges, size, mimetype, boundary))
+    return Response(multipartRanges(path, ranges, size, mimetype, boundary), status=206, headers=headers,
+                    content_type=f"multipart/byteranges; boundary={boundary}", direct_passthrough=True)
@@ -0,0 +1,85 @@
+from admission import AdmissionControl, Lane, Rejected, RedisTokenBuckets, TokenBuckets, queuedSeconds
+from cache import InMemoryRedis
+import threading, pytest
+
+def makeAdmission(limit=1, clientRate=0, queueBudget=0.05):
+    return AdmissionControl([Lane("lists", limit)], {"getClipIds": "lists"}, TokenBuckets(),
+        {"client": (clientRate, 2), "author": (0, 1)}, queueBudget)
+
+class TestTokenBuckets:
+    def testBurstThenRate(self):
+        buckets = TokenBuckets()
+
+        assert [buckets.take("client:a", 2, 3, now=100) for _ in range(3)] == [0, 0, 0]
+        assert buckets.take("client:a", 2, 3, now=100) == pytest.approx(0.5)
+        assert buckets.take("client:b", 2, 3, now=100) == 0
+        assert buckets.take("client:a", 2, 3, now=100.5) == 0
+        assert buckets.take("client:a", 2, 3, now=100.5) == pytest.approx(0.5)
+
+    def testLeastRecentlyUsedBucketsAreDropped(self):
+        buckets = TokenBuckets(maxEntries=2)
+        for key in ["a", "b", "c"]:
+            buckets.take(key, 1, 1, now=0)
+
+        assert list(buckets.buckets) == ["b", "c"]
+        assert buckets.take("a", 1, 1, now=0) == 0
+
+    def testSharedWindows(self):
+        buckets = RedisTokenBuckets(InMemoryRedis())
+
+        assert [buckets.take("client:a", 2, 4, now=1000) for _ in range(4)] == [0, 0, 0, 0]
+        assert buckets.take("client:a", 2, 4, now=1001) == pytest.approx(1)
+        assert buckets.take("client:a", 2, 4, now=1002) == 0
+
+class TestLanes:
+    def testWaitsOnlyAsLongAsTheBudget(self):
+        lane = Lane("uploads", 1)
+        assert lane.acquire(0)
+
+        assert not lane.acquire(0.01)
+        releaser = threading.Timer(0.02, lane.release)
+        releaser.start()
+        assert lane.acquire(1)
+        releaser.join()
+        assert (lane.active, lane.waiting) == (1, 0)
+
+    def testQueuedSeconds(self):
+        assert queuedSeconds("t=1609459200.5", now=1609459201) == pytest.approx(0.5)
+        assert queuedSeconds("t=1609459200500", now=1609459201) == pytest.approx(0.5)
+        assert queuedSeconds("1609459200500000", now=1609459201) == pytest.approx(0.5)
+        assert queuedSeconds("t=1609459202", now=1609459201) == 0
+        assert queuedSeconds(None) == queuedSeconds("soon") == 0
+
+class TestAdmissionControl:
+    def testFullLaneRejects(self):
+        admission = makeAdmission()
+        lane = admission.admit("getClipIds", "a")
+
+        with pytest.raises(Rejected) as rejection:
+            admission.admit("getClipIds", "b")
+        assert (rejection.value.status, rejection.value.retryAfter) == (503, 1)
+        assert admission.admit("getUser", "b") is None
+        admission.release(lane)
+        admission.release(admission.admit("getClipIds", "b"))
+
+        assert admission.stats() == {"lanes": {"lists": {"limit": 1, "active": 0, "waiting": 0}},
+                                     "rejections": {"lane_full": {"getClipIds": 1}}}
+
+    def testClientRateAndQueueTime(self):
+        admission = makeAdmission(clientRate=1)
+        admission.admit("getUser", "a")
+        admission.admit("getUser", "a")
+
+        with pytest.raises(Rejected) as rejection:
+            admission.admit("getUser", "a")
+        assert rejection.value.status == 429
+        with pytest.raises(Rejected) as rejection:
+            admission.admit("getUser", "b", "t=1609459200")
+        assert rejection.value.status == 503
+        assert 'hypeclips_rejected_requests_total{reason="client_rate",endpoint="getUser"} 1' in admission.render()
+
+    def testUnreachableSharedBackendLetsRequestsThrough(self):
+        admission = makeAdmission(clientRate=1)
+        admission.buckets = RedisTokenBuckets(None)
+
+        assert admission.admit("getUser", "a") is None
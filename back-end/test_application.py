@@ -1,7 +1,25 @@
 from flask_testing import TestCase
-from application import app, db, User, Clip, Comment
-from datetime import datetime
-import os, io, uuid
+from application import app, db, responseCache, sessionTokens, storage, collectGarbage, encodeCursor, flushViewCounts, loadFollowGraph, followers, processPendingClips, rebuildTimelines, recountCounters, User, Clip, Comment, UploadSession, Rendition, TimelineEntry, ClipTombstone, Blob, HourlyClipViews, DailyClipViews
+from transcoding import StubEncoder, getRenditionPath
+from thumbnails import getThumbnailKey, getThumbnailPath, makeThumbnail
+from storage import LocalStorage, blobKey, clipKey
+from auth import verifyPassword
+from mp4_fixtures import buildMp4
+from views import ViewCounter
+from graph import FollowGraphIndex
+from admission import AdmissionControl, Lane, TokenBuckets
+from serialization import JsonRepresentation
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from datetime import datetime, timedelta
+from unittest import mock
+import os, io, uuid, gzip, hashlib, json, msgpack, shutil, tempfile, threading, time
+
+def mp4Clip(frames=4):
+    # A few bytes of well-formed MP4 for uploads to be accepted. Each number of frames gives a different file.
+    return buildMp4(frames=frames, frameSize=4, keyframeInterval=2)
+
+TEST_CLIP = mp4Clip()
 
 class BaseTestCase(TestCase):
     """
@@ -45,6 +63,18 @@ class UserLogin(BaseTestCase):
 
         assert response.status_code == 200
         assert response.json['id'] == 1
+        assert sessionTokens.verify(response.json["token"]) == 1
+
+    def testLoginHashesLegacyPassword(self):
+        db.session.add(self.createUser())
+        db.session.commit()
+
+        self.client.post("/login", json=dict(username="bob", password="pass123"))
+
+        password = User.query.get(1).password
+        assert password.startswith("$scrypt$")
+        assert self.client.post("/login", json=dict(username="bob", password="pass123")).status_code == 200
+        assert User.query.get(1).password == password
 
     def testInvalidLoginWrongUsername(self):
         db.session.add(self.createUser())
@@ -73,8 +103,9 @@ class UserRegister(BaseTestCase):
         user = User.query.get(1)
 
         assert user.username == "bob"
-        assert user.password == "pass123"
+        assert user.password.startswith("$scrypt$") and verifyPassword("pass123", user.password)
         assert response.json['id'] == 1
+        assert sessionTokens.verify(response.json["token"]) == 1
 
     def testInvalidRegistrationAlreadyRegistered(self):
         db.session.add(self.createUser())
@@ -105,9 +136,82 @@ class UserRegister(BaseTestCase):
         assert response.status_code == 400
         assert response.json["status"] == "unsuccessful registration: password too long"
 
+class Logout(BaseTestCase):
+    def testLogoutRevokesToken(self):
+        token = self.client.post("/register", json=dict(username="bob", password="pass123")).json["token"]
+
+        response = self.client.post("/logout", headers={"Authorization": f"Bearer {token}"})
+
+        assert response.status_code == 200
+        assert sessionTokens.verify(token) is None
+        assert self.client.post("/logout", headers={"Authorization": f"Bearer {token}"}).status_code == 401
+
+    def testLogoutWithoutToken(self):
+        assert self.client.post("/logout").status_code == 401
+
+class SessionChecks(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(self.createUser())
+        db.session.add(User(username="alice", password="pass123"))
+        db.session.commit()
+        self.token = sessionTokens.issue(1)
+
+    def tearDown(self):
+        app.config["AUTH_REQUIRED"] = False
+        super().tearDown()
+
+    def comment(self, authorId, headers=None):
+        db.session.add(self.createClip(1, 1))
+        db.session.commit()
+        return self.client.put("/comments/1", json={"authorId": authorId, "comment": "nice"}, headers=headers or {})
+
+    def testOwnTokenIsAccepted(self):
+        assert self.comment(1, {"Authorization": f"Bearer {self.token}"}).status_code == 200
+
+    def testTokenOfAnotherUserIsRejected(self):
+        response = self.comment(2, {"Authorization": f"Bearer {self.token}"})
+
+        assert response.status_code == 403
+        assert response.json["status"] == "the session token belongs to another user"
+
+    def testTamperedTokenIsRejectedWhenRequired(self):
+        app.config["AUTH_REQUIRED"] = True
+
+        response = self.client.put("/follow/1/2", headers={"Authorization": f"Bearer {self.token[:-2]}xx"})
+
+        assert response.status_code == 401
+        assert response.json["status"] == "the session token is not valid"
+        assert not User.query.get(1).isFollowing(User.query.get(2))
+
+    def testUnverifiableTokenIsAnonymousWhenNotRequired(self):
+        # Such as a token signed by a server process with another key
+        response = self.client.put("/follow/1/2", headers={"Authorization": f"Bearer {self.token[:-2]}xx"})
+
+        assert response.status_code == 200
+        assert User.query.get(1).isFollowing(User.query.get(2))
+
+    def testMissingTokenOnlyFailsWhenRequired(self):
+        assert self.client.put("/follow/1/2").status_code == 200
+        app.config["AUTH_REQUIRED"] = True
+
+        response = self.client.delete("/follow/1/2")
+
+        assert response.status_code == 401
+        assert response.json["status"] == "a session token is needed"
+
+    def testDeletingAnotherUsersClip(self):
+        db.session.add(self.createClip(1, 2))
+        db.session.commit()
+
+        response = self.client.delete("/clips/1", headers={"Authorization": f"Bearer {self.token}"})
+
+        assert response.status_code == 403
+        assert Clip.query.get(1) is not None
+
 class AddClips(BaseTestCase):
     def testValidAddedClip(self):
-        response = self.client.put("/clips", data={"file": (io.BytesIO(b"this is a test"), "test.mp4"), "authorId": 52, "title": "Bob sick league clip!"})
+        response = self.client.put("/clips", data={"file": (io.BytesIO(TEST_CLIP), "test.mp4"), "authorId": 52, "title": "Bob sick league clip!"})
 
         assert response.status_code == 200
         clip = Clip.query.get(1)
@@ -120,7 +224,45 @@ class AddClips(BaseTestCase):
         except ValueError:
             assert False
 
-        os.remove(Clip.getClipPath(clip.clipUuid))
+        os.remove(storage.path(clip.sourceKey()))
+
+    def testDetailsAreReadFromTheUpload(self):
+        response = self.client.put("/clips", data={"file": (io.BytesIO(TEST_CLIP), "test.mp4"), "authorId": 52, "title": "Bob sick league clip!"})
+
+        clip = Clip.query.get(response.json["id"])
+        assert (clip.width, clip.height, clip.codec) == (640, 360, "avc1.64001f")
+        assert round(clip.duration, 3) == 0.133
+        assert clip.moovOffset == 32
+        assert len(clip.seekIndex) == 24
+
+        os.remove(storage.path(clip.sourceKey()))
+
+    def testUploadThatIsNotAnMp4(self):
+        response = self.client.put("/clips", data={"file": (io.BytesIO(b"this is a test"), "test.mp4"), "authorId": 52, "title": "Bob sick league clip!"})
+
+        assert response.status_code == 400
+        assert response.json["status"] == "the file had the wrong format"
+        assert Clip.query.count() == 0
+        assert not [name for name in os.listdir(Clip.getClipsDirectory()) if name.endswith(".part")]
+
+    def testSampleTableLargerThanTheFile(self):
+        data = bytearray(TEST_CLIP)
+        sampleTable = data.index(b"stsz") + 8
+        data[sampleTable:sampleTable + 8] = (4).to_bytes(4, "big") + (400000000).to_bytes(4, "big")
+
+        response = self.client.put("/clips", data={"file": (io.BytesIO(bytes(data)), "test.mp4"), "authorId": 52, "title": "Bob sick league clip!"})
+
+        assert response.status_code == 400
+        assert response.json["status"] == "the file had the wrong format"
+        assert not [name for name in os.listdir(Clip.getClipsDirectory()) if name.endswith(".part")]
+
+    def testPartFileIsRemovedWhenTheUploadFails(self):
+        with mock.patch("application.fanOutClip", side_effect=RuntimeError("the database went away")):
+            with self.assertRaises(RuntimeError):
+                self.client.put("/clips", data={"file": (io.BytesIO(TEST_CLIP), "test.mp4"), "authorId": 52, "title": "Bob sick league clip!"})
+
+        assert Clip.query.count() == 0
+        assert not [name for _, _, names in os.walk(Clip.getClipsDirectory()) for name in names]
 
     def testNoFilePartAdded(self):
         response = self.client.put("clips")
@@ -209,8 +351,13 @@ class DeleteClip(BaseTestCase):
         response = self.client.delete("/clips/5")
 
         assert response.status_code == 200
-        assert os.path.isfile(Clip.getClipPath(clipUuid)) == False
         assert self.client.delete("/clips/5").status_code == 404
+        # The file goes once the garbage collector gets to the tombstone
+        assert os.path.isfile(clipPath)
+        assert ClipTombstone.query.filter_by(clipUuid=clipUuid).count() == 1
+        assert collectGarbage() == 1
+        assert os.path.isfile(Clip.getClipPath(clipUuid)) == False
+        assert ClipTombstone.query.count() == 0
 
     def testDeleteClipWithComments_commentsAlsoDeleted(self):
         clipUuid = str(uuid.uuid4())
@@ -227,6 +374,7 @@ class DeleteClip(BaseTestCase):
         # This fails unless comments are also deleted upon clip deletion, due to the following error:
         # sqlalchemy.exc.IntegrityError: (sqlite3.IntegrityError) NOT NULL constraint failed: comment.clipId
         response = self.client.delete("/clips/5")
+        collectGarbage()
 
         assert response.status_code == 200
         assert os.path.isfile(Clip.getClipPath(clipUuid)) == False
@@ -274,12 +422,17 @@ class GetClipInformation(BaseTestCase):
         response = self.client.get("/clips/info/5")
 
         assert response.status_code == 200
-        assert len(response.json) == 5
+        assert len(response.json) == 11
         assert response.json["title"] == "CSGO ACE"
         assert response.json["description"] == "asdfgg"
         assert response.json["date"] == str(datetime.min)
         assert response.json["author"] == "bob"
         assert response.json["authorId"] == 1
+        assert response.json["status"] == "pending"
+        assert response.json["duration"] is None
+        assert response.json["codec"] is None
+        assert (response.json["views"], response.json["plays"]) == (0, 0)
+        assert response.json["renditions"] == []
 
     def testGetNonexistantClipInformation(self):
         response = self.client.get("/clips/info/5")
@@ -499,6 +652,18 @@ class Follow(BaseTestCase):
         assert response.status_code == 400
         assert response.json["status"] == "You can't follow/unfollow yourself"
 
+    def testFollowerCountIsNotServedFromCache(self):
+        db.session.add(self.createUser())
+        db.session.add(User(id=2, username="tempuser", password="asdf"))
+        db.session.commit()
+        assert self.client.get("/user/2").json["numFollowers"] == 0
+
+        self.client.put("/follow/1/2")
+        assert self.client.get("/user/2").json["numFollowers"] == 1
+
+        self.client.delete("/follow/1/2")
+        assert self.client.get("/user/2").json["numFollowers"] == 0
+
 class Unfollow(BaseTestCase):
     def testUnfollowValid(self):
         follower = self.createUser()
@@ -567,6 +732,8 @@ class GetFollowFeed(BaseTestCase):
         db.session.add(self.createClip(id=155, authorId=2, title="VALORANT NINJA DEFUSE", dateOfCreation=datetime.max))
         db.session.add(self.createClip(id=15515, authorId=5, title="ROBLOX HIGHLIGHTS WOW"))  # this is just to test that it doesn't return unneccessary clips.
         db.session.commit()
+        # The clips were added straight to the database rather than through addClips, so build the timelines by hand
+        rebuildTimelines()
 
         response = self.client.get(f"/follow/clips/{follower.id}")
 
@@ -623,3 +790,1532 @@ class GetUser(BaseTestCase):
         response = self.client.get("/user/1")
 
         assert response.status_code == 404
+
+class GetClipPages(BaseTestCase):
+    def addClips(self, authorId, count):
+        for i in range(1, count + 1):
+            db.session.add(self.createClip(id=i, authorId=authorId, title=f"clip {i}", dateOfCreation=datetime(2021, 1, i)))
+
+    def testFirstPageIsHydrated(self):
+        db.session.add(self.createUser())
+        self.addClips(1, 3)
+        db.session.add(Comment(comment="Nice", authorId=1, clipId=3))
+        db.session.add(Comment(comment="thanks", authorId=1, clipId=3))
+        db.session.commit()
+
+        response = self.client.get("/clips?limit=2")
+
+        assert response.status_code == 200
+        assert [clip["id"] for clip in response.json["clips"]] == [3, 2]
+        assert response.json["clips"][0]["title"] == "clip 3"
+        assert response.json["clips"][0]["author"] == "bob"
+        assert response.json["clips"][0]["authorId"] == 1
+        assert response.json["clips"][0]["date"] == str(datetime(2021, 1, 3))
+        assert response.json["clips"][0]["numComments"] == 2
+        assert response.json["clips"][1]["numComments"] == 0
+        assert response.json["nextCursor"] is not None
+
+    def testFollowingTheCursorVisitsEveryClipOnce(self):
+        db.session.add(self.createUser())
+        self.addClips(1, 5)
+        # Same timestamp as clip 3, so the id tie-breaker decides the order
+        db.session.add(self.createClip(id=6, authorId=1, dateOfCreation=datetime(2021, 1, 3)))
+        db.session.commit()
+
+        seen = []
+        response = self.client.get("/clips?limit=2")
+        while True:
+            assert response.status_code == 200
+            seen += [clip["id"] for clip in response.json["clips"]]
+            if response.json["nextCursor"] is None:
+                break
+            response = self.client.get(f"/clips?limit=2&cursor={response.json['nextCursor']}")
+
+        assert seen == [5, 4, 6, 3, 2, 1]
+
+    def testAuthorPage(self):
+        db.session.add(self.createUser())
+        db.session.add(User(id=2, username="tempuser", password="asdf"))
+        self.addClips(1, 2)
+        db.session.add(self.createClip(id=15515, authorId=2, title="ROBLOX HIGHLIGHTS WOW"))
+        db.session.commit()
+
+        response = self.client.get("/1/clips?limit=10")
+
+        assert response.status_code == 200
+        assert [clip["id"] for clip in response.json["clips"]] == [2, 1]
+        assert response.json["nextCursor"] is None
+
+    def testFollowFeedPage(self):
+        follower = self.createUser()
+        followee = User(id=2, username="tempuser", password="asdf")
+        db.session.add(follower)
+        db.session.add(followee)
+        follower.followed.append(followee)
+        self.addClips(2, 3)
+        db.session.add(self.createClip(id=15515, authorId=1, title="ROBLOX HIGHLIGHTS WOW"))
+        db.session.commit()
+        rebuildTimelines()
+
+        response = self.client.get(f"/follow/clips/{follower.id}?limit=2")
+        assert [clip["id"] for clip in response.json["clips"]] == [3, 2]
+        assert response.json["clips"][0]["author"] == "tempuser"
+
+        response = self.client.get(f"/follow/clips/{follower.id}?limit=2&cursor={response.json['nextCursor']}")
+        assert [clip["id"] for clip in response.json["clips"]] == [1]
+        assert response.json["nextCursor"] is None
+
+    def testInvalidCursor(self):
+        response = self.client.get("/clips?cursor=garbage")
+
+        assert response.status_code == 400
+        assert response.json["status"] == "invalid cursor"
+
+    def testInvalidLimit(self):
+        response = self.client.get("/clips?limit=0")
+
+        assert response.status_code == 400
+        assert response.json["status"] == "limit must be a positive integer"
+
+class StreamClip(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.clipUuid = str(uuid.uuid4())
+        db.session.add(self.createClip(id=5, authorId=7, title="HIKO ARE YOU KIDDING ME", clipUuid=self.clipUuid))
+        db.session.commit()
+        self.clipPath = Clip.getClipPath(self.clipUuid)
+
+        testClip = open(self.clipPath, "wb")
+        testClip.write(b"0123456789")
+        testClip.close()
+
+    def tearDown(self):
+        app.config["SENDFILE_MODE"] = None
+        os.remove(self.clipPath)
+        super().tearDown()
+
+    def testFullResponseHeaders(self):
+        response = self.client.get("/clips/5")
+
+        assert response.status_code == 200
+        assert response.data == b"0123456789"
+        assert response.headers["ETag"] == f'"{self.clipUuid}"'
+        assert response.headers["Accept-Ranges"] == "bytes"
+        assert "immutable" in response.headers["Cache-Control"]
+        assert response.headers["Content-Length"] == "10"
+        assert response.mimetype == "video/mp4"
+        response.close()
+
+    def testRevalidationReturnsNotModified(self):
+        response = self.client.get("/clips/5", headers={"If-None-Match": f'"{self.clipUuid}"'})
+
+        assert response.status_code == 304
+        assert response.data == b""
+        assert response.headers["ETag"] == f'"{self.clipUuid}"'
+
+    def testSingleRange(self):
+        response = self.client.get("/clips/5", headers={"Range": "bytes=2-4"})
+
+        assert response.status_code == 206
+        assert response.data == b"234"
+        assert response.headers["Content-Range"] == "bytes 2-4/10"
+        assert response.headers["Content-Length"] == "3"
+
+    def testOpenEndedAndOversizedRanges(self):
+        assert self.client.get("/clips/5", headers={"Range": "bytes=7-"}).data == b"789"
+
+        response = self.client.get("/clips/5", headers={"Range": "bytes=8-100"})
+
+        assert response.data == b"89"
+        assert response.headers["Content-Range"] == "bytes 8-9/10"
+
+    def testSuffixRange(self):
+        response = self.client.get("/clips/5", headers={"Range": "bytes=-3"})
+
+        assert response.status_code == 206
+        assert response.data == b"789"
+        assert response.headers["Content-Range"] == "bytes 7-9/10"
+
+    def testMultipleRanges(self):
+        response = self.client.get("/clips/5", headers={"Range": "bytes=0-1,-2"})
+
+        assert response.status_code == 206
+        assert response.mimetype == "multipart/byteranges"
+        boundary = response.mimetype_params["boundary"]
+        assert response.data == (f"--{boundary}\r\nContent-Type: video/mp4\r\nContent-Range: bytes 0-1/10\r\n\r\n01\r\n"
+                                 f"--{boundary}\r\nContent-Type: video/mp4\r\nContent-Range: bytes 8-9/10\r\n\r\n89\r\n"
+                                 f"--{boundary}--\r\n").encode()
+        assert response.headers["Content-Length"] == str(len(response.data))
+
+    def testOverlappingRangesAreIgnored(self):
+        response = self.client.get("/clips/5", headers={"Range": "bytes=0-3,2-5"})
+
+        assert response.status_code == 200
+        assert response.data == b"0123456789"
+        response.close()
+
+    def testUnsatisfiableRange(self):
+        response = self.client.get("/clips/5", headers={"Range": "bytes=20-30"})
+
+        assert response.status_code == 416
+        assert response.headers["Content-Range"] == "bytes */10"
+
+    def testStaleIfRangeSendsWholeFile(self):
+        response = self.client.get("/clips/5", headers={"Range": "bytes=2-4", "If-Range": '"some-other-clip"'})
+
+        assert response.status_code == 200
+        assert response.data == b"0123456789"
+        response.close()
+
+    def testMatchingIfRangeSendsRange(self):
+        response = self.client.get("/clips/5", headers={"Range": "bytes=2-4", "If-Range": f'"{self.clipUuid}"'})
+
+        assert response.status_code == 206
+        assert response.data == b"234"
+
+    def testAccelRedirectOffload(self):
+        app.config["SENDFILE_MODE"] = "x-accel-redirect"
+
+        response = self.client.get("/clips/5")
+
+        assert response.status_code == 200
+        assert response.data == b""
+        assert response.headers["X-Accel-Redirect"] == f"/protected-clips/{self.clipUuid[:2]}/{self.clipUuid[2:4]}/{self.clipUuid}.mp4"
+        assert response.headers["ETag"] == f'"{self.clipUuid}"'
+
+    def testSendfileOffload(self):
+        app.config["SENDFILE_MODE"] = "x-sendfile"
+
+        response = self.client.get("/clips/5")
+
+        assert response.status_code == 200
+        assert response.headers["X-Sendfile"] == self.clipPath
+
+class ResumableUpload(BaseTestCase):
+    def createUpload(self, size):
+        return self.client.post("/uploads", json=dict(authorId=52, title="Bob sick league clip!", size=size))
+
+    def sendChunk(self, uploadId, index, offset, data, checksum=None):
+        headers = {"Upload-Offset": str(offset), "X-Chunk-Checksum": checksum or hashlib.sha256(data).hexdigest()}
+        return self.client.put(f"/uploads/{uploadId}/chunks/{index}", data=data, headers=headers)
+
+    def testCompleteUpload(self):
+        uploadId = self.createUpload(len(TEST_CLIP)).json["uploadId"]
+
+        assert self.sendChunk(uploadId, 0, 0, TEST_CLIP[:7]).json["offset"] == 7
+        response = self.sendChunk(uploadId, 1, 7, TEST_CLIP[7:])
+        assert response.json["offset"] == len(TEST_CLIP)
+        assert response.json["nextChunk"] == 2
+
+        response = self.client.post(f"/uploads/{uploadId}/finalize")
+
+        assert response.status_code == 200
+        clip = Clip.query.get(response.json["id"])
+        assert clip.authorId == 52
+        assert clip.title == "Bob sick league clip!"
+        assert open(storage.path(clip.sourceKey()), "rb").read() == TEST_CLIP
+        assert UploadSession.query.get(uploadId) is None
+        assert not os.path.exists(os.path.join(Clip.getClipsDirectory(), f"{uploadId}.part"))
+
+        os.remove(storage.path(clip.sourceKey()))
+
+    def testResumeAfterDroppedChunk(self):
+        uploadId = self.createUpload(len(TEST_CLIP)).json["uploadId"]
+        self.sendChunk(uploadId, 0, 0, TEST_CLIP[:7])
+
+        # The client lost the response and resends the first chunk, so the server tells it where to continue
+        response = self.sendChunk(uploadId, 0, 0, TEST_CLIP[:7])
+        assert response.status_code == 409
+        assert response.json["offset"] == 7
+        assert response.json["nextChunk"] == 1
+
+        assert self.client.get(f"/uploads/{uploadId}").json["offset"] == 7
+        assert self.sendChunk(uploadId, 1, 7, TEST_CLIP[7:]).status_code == 200
+        clip = Clip.query.get(self.client.post(f"/uploads/{uploadId}/finalize").json["id"])
+        assert open(storage.path(clip.sourceKey()), "rb").read() == TEST_CLIP
+
+        os.remove(storage.path(clip.sourceKey()))
+
+    def testChecksumMismatchIsDiscarded(self):
+        uploadId = self.createUpload(len(TEST_CLIP)).json["uploadId"]
+
+        response = self.sendChunk(uploadId, 0, 0, TEST_CLIP[:7], checksum=hashlib.sha256(b"something else").hexdigest())
+
+        assert response.status_code == 400
+        assert response.json["status"] == "the chunk checksum did not match"
+        assert self.client.get(f"/uploads/{uploadId}").json["offset"] == 0
+        assert os.path.getsize(os.path.join(Clip.getClipsDirectory(), f"{uploadId}.part")) == 0
+
+        self.client.delete(f"/uploads/{uploadId}")
+
+    def testFirstChunkThatIsNotAnMp4(self):
+        uploadId = self.createUpload(14).json["uploadId"]
+
+        response = self.sendChunk(uploadId, 0, 0, b"this is a test")
+
+        assert response.status_code == 400
+        assert response.json["status"] == "the file had the wrong format"
+        assert os.path.getsize(os.path.join(Clip.getClipsDirectory(), f"{uploadId}.part")) == 0
+
+        self.client.delete(f"/uploads/{uploadId}")
+
+    def testFinalizeRejectsTruncatedMp4(self):
+        uploadId = self.createUpload(len(TEST_CLIP) - 3).json["uploadId"]
+        self.sendChunk(uploadId, 0, 0, TEST_CLIP[:-3])
+
+        response = self.client.post(f"/uploads/{uploadId}/finalize")
+
+        assert response.status_code == 400
+        assert response.json["status"] == "the file had the wrong format"
+        assert UploadSession.query.get(uploadId) is None
+        assert not os.path.exists(os.path.join(Clip.getClipsDirectory(), f"{uploadId}.part"))
+        assert Clip.query.count() == 0
+
+    def testFinalizeDropsTheUploadWhenParsingFails(self):
+        uploadId = self.createUpload(len(TEST_CLIP)).json["uploadId"]
+        self.sendChunk(uploadId, 0, 0, TEST_CLIP)
+
+        with mock.patch("application.parseFile", side_effect=MemoryError()):
+            with self.assertRaises(MemoryError):
+                self.client.post(f"/uploads/{uploadId}/finalize")
+
+        assert UploadSession.query.get(uploadId) is None
+        assert not os.path.exists(os.path.join(Clip.getClipsDirectory(), f"{uploadId}.part"))
+
+    def testChunkPastDeclaredSize(self):
+        uploadId = self.createUpload(4).json["uploadId"]
+
+        response = self.sendChunk(uploadId, 0, 0, TEST_CLIP)
+
+        assert response.status_code == 413
+        assert self.client.get(f"/uploads/{uploadId}").json["offset"] == 0
+
+        self.client.delete(f"/uploads/{uploadId}")
+
+    def testFinalizeIncompleteUpload(self):
+        uploadId = self.createUpload(len(TEST_CLIP)).json["uploadId"]
+        self.sendChunk(uploadId, 0, 0, TEST_CLIP[:7])
+
+        response = self.client.post(f"/uploads/{uploadId}/finalize")
+
+        assert response.status_code == 409
+        assert response.json["status"] == "the upload is incomplete"
+        assert Clip.query.count() == 0
+
+        self.client.delete(f"/uploads/{uploadId}")
+
+    def testUploadTooLarge(self):
+        response = self.createUpload(app.config["MAX_UPLOAD_SIZE"] + 1)
+
+        assert response.status_code == 413
+        assert response.json["status"] == "the file is too large"
+
+    def testMissingChecksum(self):
+        uploadId = self.createUpload(len(TEST_CLIP)).json["uploadId"]
+
+        response = self.client.put(f"/uploads/{uploadId}/chunks/0", data=TEST_CLIP[:7], headers={"Upload-Offset": "0"})
+
+        assert response.status_code == 400
+        assert response.json["status"] == "no chunk checksum included"
+
+        self.client.delete(f"/uploads/{uploadId}")
+
+    def testAbortUpload(self):
+        uploadId = self.createUpload(len(TEST_CLIP)).json["uploadId"]
+        self.sendChunk(uploadId, 0, 0, TEST_CLIP[:7])
+
+        assert self.client.delete(f"/uploads/{uploadId}").status_code == 200
+
+        assert not os.path.exists(os.path.join(Clip.getClipsDirectory(), f"{uploadId}.part"))
+        assert self.client.get(f"/uploads/{uploadId}").status_code == 404
+
+class SeekClip(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(self.createUser())
+        db.session.commit()
+        self.data = buildMp4(frames=90, frameSize=100, keyframeInterval=30)
+        self.mediaStart = self.data.index(b"mdat") + 12
+        response = self.client.put("/clips", data={"file": (io.BytesIO(self.data), "test.mp4"), "authorId": 1, "title": "CSGO ACE"})
+        self.clipId = response.json["id"]
+
+    def tearDown(self):
+        self.client.delete(f"/clips/{self.clipId}")
+        collectGarbage()
+        super().tearDown()
+
+    def testKeyframeBeforeTheTime(self):
+        response = self.client.get(f"/clips/{self.clipId}/seek?t=1.5")
+
+        assert response.status_code == 200
+        assert response.json == {"time": 1.001, "offset": self.mediaStart + 30 * 100}
+        assert self.client.get(f"/clips/{self.clipId}/seek?t=0").json["offset"] == self.mediaStart
+
+    def testRenditionsHaveTheirOwnIndex(self):
+        processPendingClips(StubEncoder(width=1920, height=1080), workers=0)
+
+        assert Rendition.query.filter_by(clipId=self.clipId, name="360p").first().seekIndex is not None
+        response = self.client.get(f"/clips/{self.clipId}/seek?t=2.5&rendition=360p")
+        assert response.json == {"time": 2.002, "offset": self.mediaStart + 60 * 100}
+
+    def testBadRequests(self):
+        assert self.client.get(f"/clips/{self.clipId}/seek").status_code == 400
+        assert self.client.get(f"/clips/{self.clipId}/seek?t=-1").status_code == 400
+        assert self.client.get(f"/clips/{self.clipId}/seek?t=1&rendition=4k").status_code == 404
+        assert self.client.get(f"/clips/{self.clipId + 1}/seek?t=1").status_code == 404
+
+    def testClipWithoutIndex(self):
+        db.session.add(self.createClip(id=self.clipId + 1, authorId=1))
+        db.session.commit()
+
+        response = self.client.get(f"/clips/{self.clipId + 1}/seek?t=1")
+
+        assert response.status_code == 404
+        assert response.json["status"] == "the clip has no seek index"
+
+class ClipFilesTestCase(BaseTestCase):
+    """Adds clip 5 with an upload on disk, and removes everything processing made for it afterwards."""
+    def setUp(self):
+        super().setUp()
+        self.clipUuid = str(uuid.uuid4())
+        db.session.add(self.createUser())
+        db.session.add(self.createClip(id=5, authorId=1, title="CSGO ACE", clipUuid=self.clipUuid))
+        db.session.commit()
+        testClip = open(Clip.getClipPath(self.clipUuid), "wb")
+        testClip.write(b"0123456789")
+        testClip.close()
+
+    def tearDown(self):
+        for kind in ["poster", "sprite"]:
+            path = getThumbnailPath(Clip.getClipsDirectory(), self.clipUuid, kind)
+            if os.path.exists(path):
+                os.remove(path)
+        for name in ["original", "360p", "720p"]:
+            path = getRenditionPath(Clip.getClipsDirectory(), self.clipUuid, name)
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.exists(Clip.getClipPath(self.clipUuid)):
+            os.remove(Clip.getClipPath(self.clipUuid))
+        super().tearDown()
+
+class ProcessClips(ClipFilesTestCase):
+    def testProcessingMakesRenditionLadder(self):
+        assert processPendingClips(StubEncoder(width=1920, height=1080), workers=0) == 1
+
+        clip = Clip.query.get(5)
+        assert clip.processingStatus == "ready"
+        assert (clip.width, clip.height, clip.duration) == (1920, 1080, 10.0)
+        renditions = {rendition.name: rendition for rendition in clip.renditions}
+        assert sorted(renditions) == ["360p", "720p", "original"]
+        assert (renditions["360p"].width, renditions["360p"].height) == (640, 360)
+        assert os.path.isfile(getRenditionPath(Clip.getClipsDirectory(), self.clipUuid, "720p"))
+
+        response = self.client.get("/clips/info/5")
+        assert response.json["status"] == "ready"
+        assert sorted(response.json["renditions"]) == ["360p", "720p", "original"]
+
+    def testSmallSourceIsNotUpscaled(self):
+        processPendingClips(StubEncoder(width=640, height=360), workers=0)
+
+        assert [rendition.name for rendition in Clip.query.get(5).renditions] == ["original"]
+
+    def testRenditionSelectedByQueryParameter(self):
+        processPendingClips(StubEncoder(), workers=0)
+
+        response = self.client.get("/clips/5?rendition=360p")
+
+        assert response.status_code == 200
+        assert response.data == b"0123456789"
+        assert response.headers["ETag"] == f'"{self.clipUuid}-360p"'
+        response.close()
+
+        response = self.client.get("/clips/5")
+        assert response.headers["ETag"] == f'"{self.clipUuid}-original"'
+        response.close()
+
+    def testUnknownRendition(self):
+        processPendingClips(StubEncoder(), workers=0)
+
+        response = self.client.get("/clips/5?rendition=4k")
+
+        assert response.status_code == 404
+        assert response.json["status"] == "rendition does not exist"
+
+    def testFailedProcessingIsReported(self):
+        os.remove(Clip.getClipPath(self.clipUuid))
+
+        processPendingClips(StubEncoder(), workers=0)
+
+        assert self.client.get("/clips/info/5").json["status"] == "failed"
+        assert processPendingClips(StubEncoder(), workers=0) == 0
+
+    def testProcessPool(self):
+        assert processPendingClips(StubEncoder(), workers=1) == 1
+
+        assert Clip.query.get(5).processingStatus == "ready"
+
+    def testDeleteRemovesRenditions(self):
+        processPendingClips(StubEncoder(), workers=0)
+
+        self.client.delete("/clips/5")
+        collectGarbage()
+
+        assert not os.path.exists(getRenditionPath(Clip.getClipsDirectory(), self.clipUuid, "360p"))
+        assert not os.path.exists(getRenditionPath(Clip.getClipsDirectory(), self.clipUuid, "original"))
+        assert Rendition.query.count() == 0
+
+    def testProcessingMakesThumbnails(self):
+        processPendingClips(StubEncoder(), workers=0)
+
+        assert open(getThumbnailPath(Clip.getClipsDirectory(), self.clipUuid, "poster"), "rb").read() == b"stub poster"
+        assert open(getThumbnailPath(Clip.getClipsDirectory(), self.clipUuid, "sprite"), "rb").read() == b"stub sprite"
+
+class ViewCounts(ClipFilesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.viewCounter = ViewCounter(flushViewCounts, 60, 1000, 30, 3600)
+        self.patch = mock.patch("application.viewCounter", self.viewCounter)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        super().tearDown()
+
+    def info(self):
+        response = self.client.get("/clips/info/5")
+        return response.json["views"], response.json["plays"]
+
+    def testPlaybackIsCountedWhenFlushed(self):
+        self.client.get("/clips/5")
+        self.client.get("/clips/5", headers={"Range": "bytes=2-4"})
+        self.client.get("/clips/5", headers={"Range": "bytes=0-"})
+        self.client.get("/clips/5", headers={"User-Agent": "another player"})
+        assert self.info() == (0, 0)
+
+        assert self.viewCounter.flush() == 1
+
+        assert self.info() == (2, 2)
+        response = self.client.get("/clips/5/views?by=hour")
+        assert response.json["counts"] == [{"hour": HourlyClipViews.query.one().hour.isoformat(), "views": 2, "plays": 2}]
+        assert self.client.get("/clips/5/views").json["counts"][0]["plays"] == 2
+        assert self.client.get("/clips/5/views?by=week").status_code == 400
+
+    def testFlushesAddUp(self):
+        self.client.get("/clips/5")
+        self.viewCounter.flush()
+        self.client.get("/clips/5", headers={"User-Agent": "another player"})
+        self.viewCounter.flush()
+
+        assert self.info() == (2, 2)
+        assert DailyClipViews.query.one().views == 2
+
+    def testFailedFlushIsRetried(self):
+        self.client.get("/clips/5")
+
+        with mock.patch("application.upsertCounts", side_effect=OperationalError("", {}, Exception("database is locked"))):
+            with self.assertRaises(OperationalError):
+                self.viewCounter.flush()
+        assert self.info() == (0, 0)
+
+        self.viewCounter.flush()
+        assert self.info() == (1, 1)
+        assert HourlyClipViews.query.count() == DailyClipViews.query.count() == 1
+
+    def testDeletedClipIsNotCounted(self):
+        self.client.get("/clips/5")
+        self.client.delete("/clips/5")
+        collectGarbage()
+
+        self.viewCounter.flush()
+
+        assert HourlyClipViews.query.count() == 0
+
+    def testRecountAndRetention(self):
+        old = datetime.utcnow() - timedelta(days=60)
+        db.session.add(HourlyClipViews(clipId=5, hour=old, views=3, plays=4))
+        db.session.add(DailyClipViews(clipId=5, day=old.date(), views=3, plays=4))
+        db.session.commit()
+
+        recountCounters()
+        collectGarbage()
+
+        assert self.info() == (3, 4)
+        assert HourlyClipViews.query.count() == 0
+        assert DailyClipViews.query.count() == 1
+
+class ClipThumbnail(ClipFilesTestCase):
+    def setUp(self):
+        super().setUp()
+        app.config["CLIP_ENCODER"] = "stub"
+
+    def tearDown(self):
+        app.config["CLIP_ENCODER"] = "ffmpeg"
+        super().tearDown()
+
+    def testPoster(self):
+        processPendingClips(StubEncoder(), workers=0)
+
+        response = self.client.get("/clips/5/thumbnail")
+
+        assert response.status_code == 200
+        assert response.data == b"stub poster"
+        assert response.mimetype == "image/jpeg"
+        assert response.headers["ETag"] == f'"{self.clipUuid}-poster"'
+        assert "immutable" in response.headers["Cache-Control"]
+        response.close()
+
+    def testSprite(self):
+        response = self.client.get("/clips/5/thumbnail?kind=sprite")
+
+        assert response.status_code == 200
+        assert response.data == b"stub sprite"
+        response.close()
+
+    def testMissingThumbnailIsRegenerated(self):
+        processPendingClips(StubEncoder(), workers=0)
+        os.remove(getThumbnailPath(Clip.getClipsDirectory(), self.clipUuid, "poster"))
+
+        response = self.client.get("/clips/5/thumbnail")
+
+        assert response.status_code == 200
+        assert response.data == b"stub poster"
+        assert os.path.isfile(getThumbnailPath(Clip.getClipsDirectory(), self.clipUuid, "poster"))
+        response.close()
+
+    def testConcurrentRegenerationsDoNotShareAFile(self):
+        arrived = threading.Barrier(2, timeout=5)
+        destinations = []
+
+        class SlowEncoder(StubEncoder):
+            def extractPoster(self, source, destination, seconds, width):
+                destinations.append(destination)
+                with open(destination, "wb") as image:
+                    image.write(b"stub ")
+                    arrived.wait()
+                    image.write(b"poster")
+
+        paths = []
+        threads = [threading.Thread(target=lambda: paths.append(makeThumbnail(SlowEncoder(),
+            Clip.getClipPath(self.clipUuid), Clip.getClipsDirectory(), self.clipUuid, "poster", 10.0))) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(set(destinations)) == 2 and len(paths) == 2
+        with open(paths[0], "rb") as image:
+            assert image.read() == b"stub poster"
+        assert not any(name.endswith(".tmp") for name in os.listdir(os.path.dirname(paths[0])))
+
+    def testThumbnailForMissingClipFile(self):
+        os.remove(Clip.getClipPath(self.clipUuid))
+
+        response = self.client.get("/clips/5/thumbnail")
+
+        assert response.status_code == 404
+        assert response.json["status"] == "thumbnail is not available"
+
+    def testUnknownKind(self):
+        response = self.client.get("/clips/5/thumbnail?kind=gif")
+
+        assert response.status_code == 404
+        assert response.json["status"] == "thumbnail kind does not exist"
+
+    def testDeleteRemovesThumbnails(self):
+        processPendingClips(StubEncoder(), workers=0)
+
+        self.client.delete("/clips/5")
+        collectGarbage()
+
+        assert not os.path.exists(getThumbnailPath(Clip.getClipsDirectory(), self.clipUuid, "poster"))
+
+class FollowTimeline(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(self.createUser())
+        db.session.add(User(id=2, username="tempuser", password="asdf"))
+        db.session.add(User(id=3, username="thirduser", password="asdf"))
+        db.session.commit()
+
+    def tearDown(self):
+        for clip in Clip.query.all():
+            if os.path.exists(storage.path(clip.sourceKey())):
+                os.remove(storage.path(clip.sourceKey()))
+        app.config["TIMELINE_LENGTH"] = 1000
+        app.config["FANOUT_FOLLOWER_LIMIT"] = 5000
+        super().tearDown()
+
+    def uploadClip(self, authorId, title="Bob sick league clip!"):
+        response = self.client.put("/clips", data={"file": (io.BytesIO(TEST_CLIP), "test.mp4"), "authorId": authorId, "title": title})
+        return response.json["id"]
+
+    def feed(self, userId):
+        return self.client.get(f"/follow/clips/{userId}").json
+
+    def testNewClipIsPushedToFollowers(self):
+        self.client.put("/follow/1/2")
+        self.client.put("/follow/3/2")
+
+        clipId = self.uploadClip(2)
+
+        assert self.feed(1) == [clipId]
+        assert self.feed(3) == [clipId]
+        assert {entry.userId for entry in TimelineEntry.query.filter_by(clipId=clipId)} == {1, 3}
+
+    def testFollowBackfillsAndUnfollowPrunes(self):
+        first = self.uploadClip(2)
+        second = self.uploadClip(2)
+        other = self.uploadClip(3)
+
+        self.client.put("/follow/1/2")
+        assert self.feed(1) == [second, first]
+
+        self.client.put("/follow/1/3")
+        assert self.feed(1) == [other, second, first]
+
+        self.client.delete("/follow/1/2")
+        assert self.feed(1) == [other]
+
+    def testDeleteRemovesTimelineEntries(self):
+        self.client.put("/follow/1/2")
+        clipId = self.uploadClip(2)
+
+        self.client.delete(f"/clips/{clipId}")
+        collectGarbage()
+
+        assert self.feed(1) == []
+        assert TimelineEntry.query.count() == 0
+
+    def testTimelineIsCapped(self):
+        app.config["TIMELINE_LENGTH"] = 3
+        self.client.put("/follow/1/2")
+
+        clipIds = [self.uploadClip(2) for _ in range(6)]
+
+        # Each timeline may run a little past the cap before it is trimmed back to it
+        assert TimelineEntry.query.filter_by(userId=1).count() == 3
+        assert self.feed(1) == list(reversed(clipIds))[:3]
+
+    def testPopularAuthorIsReadOnDemand(self):
+        app.config["FANOUT_FOLLOWER_LIMIT"] = 1
+        self.client.put("/follow/1/2")
+        pushed = self.uploadClip(2)
+        # The second follower takes user 2 past the limit, so later clips are no longer pushed
+        self.client.put("/follow/3/2")
+        assert User.query.get(2).fanOutOnRead
+        onDemand = self.uploadClip(2)
+
+        assert TimelineEntry.query.filter_by(clipId=onDemand).count() == 0
+        assert self.feed(1) == [onDemand, pushed]
+        assert self.feed(3) == [onDemand, pushed]
+
+        response = self.client.get("/follow/clips/1?limit=1")
+        assert [clip["id"] for clip in response.json["clips"]] == [onDemand]
+        response = self.client.get(f"/follow/clips/1?limit=1&cursor={response.json['nextCursor']}")
+        assert [clip["id"] for clip in response.json["clips"]] == [pushed]
+        assert response.json["nextCursor"] is None
+
+    def testChunkedUploadIsPushedToFollowers(self):
+        self.client.put("/follow/1/2")
+        uploadId = self.client.post("/uploads", json=dict(authorId=2, title="Bob sick league clip!", size=len(TEST_CLIP))).json["uploadId"]
+        self.client.put(f"/uploads/{uploadId}/chunks/0", data=TEST_CLIP,
+                        headers={"Upload-Offset": "0", "X-Chunk-Checksum": hashlib.sha256(TEST_CLIP).hexdigest()})
+
+        clipId = self.client.post(f"/uploads/{uploadId}/finalize").json["id"]
+
+        assert self.feed(1) == [clipId]
+
+class FollowGraphRoutes(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        for id in range(1, 7):
+            db.session.add(User(id=id, username=f"user{id}", password="pass123"))
+        db.session.commit()
+        db.session.execute(followers.insert(), [{"followerId": follower, "followedId": followed} for follower, followed in
+            [(1, 2), (1, 3), (2, 1), (2, 4), (3, 4), (3, 5), (4, 1), (5, 1), (6, 4)]])
+        db.session.commit()
+        self.patch = mock.patch("application.followGraph", FollowGraphIndex(loadFollowGraph, 300))
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        super().tearDown()
+
+    def ids(self, response):
+        return [user["id"] for user in response.json["users"]]
+
+    def testListsArePaged(self):
+        response = self.client.get("/user/1/followers?limit=2")
+
+        assert response.json["users"] == [{"id": 2, "username": "user2"}, {"id": 4, "username": "user4"}]
+        last = self.client.get(f"/user/1/followers?limit=2&cursor={response.json['nextCursor']}")
+        assert self.ids(last) == [5]
+        assert last.json["nextCursor"] is None
+        assert self.ids(self.client.get("/user/1/following")) == [2, 3]
+        assert self.ids(self.client.get("/user/1/mutuals")) == [2]
+
+    def testFollowsReachTheGraph(self):
+        self.client.get("/user/1/following")
+
+        self.client.put("/follow/1/5")
+        self.client.delete("/follow/1/2")
+
+        assert self.ids(self.client.get("/user/1/following")) == [3, 5]
+        assert self.ids(self.client.get("/user/1/mutuals")) == [5]
+        assert self.ids(self.client.get("/user/2/followers")) == []
+
+    def testSuggestions(self):
+        response = self.client.get("/user/1/suggestions")
+
+        assert response.json["users"] == [{"id": 4, "username": "user4", "followedBy": 2},
+                                          {"id": 5, "username": "user5", "followedBy": 1}]
+        assert self.ids(self.client.get("/user/1/suggestions?limit=1")) == [4]
+        assert self.client.get("/user/1/suggestions?limit=0").status_code == 400
+        assert self.ids(self.client.get("/user/6/suggestions")) == [1]
+
+    def testBadRequests(self):
+        assert self.client.get("/user/99/followers").status_code == 404
+        assert self.client.get("/user/99/suggestions").status_code == 404
+        assert self.client.get("/user/1/followers?cursor=bad").status_code == 400
+
+class AdmissionRoutes(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(self.createUser())
+        db.session.commit()
+        self.admission = AdmissionControl([Lane("lists", 1)], {"getClipIds": "lists"}, TokenBuckets(),
+            {"client": (0, 1), "author": (0, 1)}, 0.01)
+        self.patch = mock.patch("application.admission", self.admission)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        super().tearDown()
+
+    def testFullLaneIsShed(self):
+        lane = self.admission.admit("getClipIds", "elsewhere")
+
+        response = self.client.get("/clips")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+        assert self.client.get("/user/1").status_code == 200
+
+        self.admission.release(lane)
+        assert self.client.get("/clips").status_code == 200
+        assert self.client.get("/admission/stats").json == {"lanes": {"lists": {"limit": 1, "active": 0, "waiting": 0}},
+                                                            "rejections": {"lane_full": {"getClipIds": 1}}}
+
+    def testSlotIsReleasedWhenTheViewFails(self):
+        with mock.patch("application.isPageRequest", side_effect=RuntimeError("lost the database")):
+            with self.assertRaises(RuntimeError):
+                self.client.get("/clips")
+
+        assert self.admission.lanes["lists"].active == 0
+
+    def testRequestsQueuedTooLongAreShed(self):
+        response = self.client.get("/user/1", headers={"X-Request-Start": f"t={time.time() - 5:.3f}"})
+
+        assert response.status_code == 503
+        assert self.client.get("/user/1", headers={"X-Request-Start": f"t={time.time():.3f}"}).status_code == 200
+
+    def testRateLimits(self):
+        db.session.add(User(id=2, username="alice", password="pass123"))
+        db.session.commit()
+        self.admission.limits = {"client": (0.001, 3), "author": (0.001, 1)}
+
+        assert self.client.put("/follow/1/2").status_code == 200
+        response = self.client.delete("/follow/1/2")
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) > 1
+        assert self.client.get("/user/1").status_code == 200
+        assert self.client.get("/user/1").status_code == 429
+        assert set(self.admission.stats()["rejections"]) == {"author_rate", "client_rate"}
+
+class PackedRepresentation:
+    # Stands in for MessagePack, with a body that is not text
+    name = "packed"
+    mimetype = "application/msgpack"
+
+    def dumps(self, data):
+        return b"\xff" + repr(data).encode()
+
+class ResponseEncoding(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(self.createUser())
+        db.session.add_all([self.createClip(id=id, authorId=1, clipUuid=str(uuid.uuid4())) for id in range(1, 301)])
+        db.session.commit()
+
+    def testLargeResponsesAreCompressed(self):
+        response = self.client.get("/clips", headers={"Accept-Encoding": "gzip, deflate"})
+        cached = self.client.get("/clips", headers={"Accept-Encoding": "gzip"})
+        plain = self.client.get("/clips")
+
+        assert response.headers["Content-Encoding"] == cached.headers["Content-Encoding"] == "gzip"
+        assert json.loads(gzip.decompress(response.data)) == json.loads(gzip.decompress(cached.data)) == plain.json
+        assert sorted(plain.json) == list(range(1, 301))
+        assert "Content-Encoding" not in plain.headers
+        assert "Accept-Encoding" in plain.headers["Vary"]
+
+    def testSmallResponsesAreSentAsTheyAre(self):
+        response = self.client.get("/user/1", headers={"Accept-Encoding": "gzip"})
+
+        assert "Content-Encoding" not in response.headers
+        assert response.json["user"] == "bob"
+
+    def testRepresentationIsNegotiated(self):
+        with mock.patch.object(app, "representations", [JsonRepresentation(), PackedRepresentation()]):
+            packed = self.client.get("/clips", headers={"Accept": "application/msgpack"})
+            cachedPacked = self.client.get("/clips", headers={"Accept": "application/msgpack"})
+            plain = self.client.get("/clips", headers={"Accept": "*/*"})
+
+        assert packed.mimetype == "application/msgpack"
+        assert packed.data == cachedPacked.data == b"\xff" + repr(plain.json).encode()
+        assert plain.mimetype == "application/json"
+        assert "Accept" in packed.headers["Vary"] and "Accept" in plain.headers["Vary"]
+
+    def testMessagePackIsServed(self):
+        plain = self.client.get("/clips?limit=5")
+        packed = self.client.get("/clips?limit=5", headers={"Accept": "application/msgpack"})
+
+        assert packed.mimetype == "application/msgpack"
+        assert msgpack.unpackb(packed.data) == plain.json
+
+class ResponseCaching(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(self.createUser())
+        db.session.add(User(id=2, username="tempuser", password="asdf"))
+        db.session.add(self.createClip(id=5, authorId=1, title="CSGO ACE", dateOfCreation=datetime.min))
+        db.session.commit()
+
+    def tearDown(self):
+        for clip in Clip.query.all():
+            if os.path.exists(storage.path(clip.sourceKey())):
+                os.remove(storage.path(clip.sourceKey()))
+        super().tearDown()
+
+    def endpointStats(self, endpoint):
+        return self.client.get("/cache/stats").json["endpoints"].get(endpoint, {"hits": 0, "misses": 0})
+
+    def testRepeatedReadIsServedFromCache(self):
+        before = self.endpointStats("getClipInformation")
+
+        first = self.client.get("/clips/info/5")
+        second = self.client.get("/clips/info/5")
+
+        after = self.endpointStats("getClipInformation")
+        assert first.json == second.json
+        assert after["hits"] - before["hits"] == 1
+        assert after["misses"] - before["misses"] == 1
+
+    def testCommentInvalidatesCommentsAndPages(self):
+        assert self.client.get("/comments/5").json == []
+        assert self.client.get("/clips?limit=5").json["clips"][0]["numComments"] == 0
+
+        self.client.put("/comments/5", json=dict(authorId=2, comment="nice ace"))
+
+        assert [comment["comment"] for comment in self.client.get("/comments/5").json] == ["nice ace"]
+        assert self.client.get("/clips?limit=5").json["clips"][0]["numComments"] == 1
+
+    def testFlushedViewsInvalidatePages(self):
+        hour = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        assert self.client.get("/clips?limit=5").json["clips"][0]["views"] == 0
+
+        flushViewCounts({(5, hour): [3, 4]})
+
+        assert self.client.get("/clips?limit=5").json["clips"][0]["views"] == 3
+
+    def testNewClipInvalidatesListsAndUser(self):
+        assert self.client.get("/clips").json == [5]
+        assert self.client.get("/1/clips").json == [5]
+        assert self.client.get("/user/1").json["numClips"] == 1
+
+        response = self.client.put("/clips", data={"file": (io.BytesIO(TEST_CLIP), "test.mp4"), "authorId": 1, "title": "new clip"})
+
+        assert self.client.get("/clips").json == [response.json["id"], 5]
+        assert self.client.get("/1/clips").json == [response.json["id"], 5]
+        assert self.client.get("/user/1").json["numClips"] == 2
+
+    def testDeleteInvalidatesClip(self):
+        open(Clip.getClipPath(Clip.query.get(5).clipUuid), "w").close()
+        assert self.client.get("/clips/info/5").status_code == 200
+
+        self.client.delete("/clips/5")
+        collectGarbage()
+
+        assert self.client.get("/clips/info/5").status_code == 404
+        assert self.client.get("/clips").json == []
+
+    def testFollowInvalidatesFollowFeed(self):
+        assert self.client.get("/follow/clips/2").json == []
+
+        self.client.put("/follow/2/1")
+        assert self.client.get("/follow/clips/2").json == [5]
+
+        self.client.delete("/follow/2/1")
+        assert self.client.get("/follow/clips/2").json == []
+
+    def testEquivalentIdsShareInvalidation(self):
+        assert self.client.get("/comments/05").json == []
+
+        self.client.put("/comments/5", json=dict(authorId=2, comment="nice ace"))
+
+        assert len(self.client.get("/comments/05").json) == 1
+
+class GetClipInformationBatch(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(self.createUser())
+        db.session.add(User(id=2, username="tempuser", password="asdf"))
+        db.session.add(self.createClip(id=5, authorId=1, title="CSGO ACE", dateOfCreation=datetime.min, description="asdfgg"))
+        db.session.add(self.createClip(id=6, authorId=2, clipUuid=str(uuid.uuid4()), title="Valorant clutch"))
+        db.session.commit()
+
+    def testClipsComeBackInRequestedOrder(self):
+        response = self.client.get("/clips/info?ids=6,5")
+
+        assert response.status_code == 200
+        assert [clip["id"] for clip in response.json["clips"]] == [6, 5]
+        assert response.json["clips"][1] == {"id": 5, **self.client.get("/clips/info/5").json}
+        assert response.json["clips"][0]["author"] == "tempuser"
+        assert response.json["missing"] == []
+
+    def testMissingClipsAreReported(self):
+        response = self.client.get("/clips/info?ids=5,40,5,41")
+
+        assert response.status_code == 200
+        assert [clip["id"] for clip in response.json["clips"]] == [5]
+        assert response.json["missing"] == [40, 41]
+
+    def testNewClipIsNoLongerMissing(self):
+        self.client.get("/clips/info?ids=5,7")
+
+        self.client.put("/clips", data={"file": (io.BytesIO(TEST_CLIP), "test.mp4"), "authorId": 1, "title": "new"})
+        os.remove(storage.path(Clip.query.get(7).sourceKey()))
+
+        assert self.client.get("/clips/info?ids=5,7").json["missing"] == []
+
+    def testInvalidIds(self):
+        assert self.client.get("/clips/info").status_code == 400
+        assert self.client.get("/clips/info?ids=5,abc").status_code == 400
+
+    def testBatchSizeIsCapped(self):
+        response = self.client.get("/clips/info?ids=" + ",".join(str(id) for id in range(1, 102)))
+
+        assert response.status_code == 400
+        assert self.client.get("/clips/info?ids=" + ",".join(str(id) for id in range(1, 101))).status_code == 200
+
+    def testRepeatedIdsCountAgainstTheCap(self):
+        assert self.client.get("/clips/info?ids=" + ",".join(["5"] * 101)).status_code == 400
+        assert self.client.get("/clips/info?ids=" + ",".join(["5"] * 100)).json["missing"] == []
+
+    def testOnlyValidIdsBecomeCacheTags(self):
+        with mock.patch.object(responseCache, "tagVersions", wraps=responseCache.tagVersions) as tagVersions:
+            self.client.get("/clips/info?ids=" + ",".join(str(id) for id in range(100000)))
+            self.client.get("/clips/info?ids=5,abc")
+            self.client.get("/clips/info?ids=5,6,5")
+
+        assert [call.args[0] for call in tagVersions.call_args_list] == [["clips"], ["clips"], ["clips", "clip:5", "clip:6"]]
+
+class IsFollowingBatch(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        for id, username in [(1, "bob"), (2, "tempuser"), (3, "alice"), (4, "carol")]:
+            db.session.add(User(id=id, username=username, password="asdf"))
+        db.session.commit()
+        User.query.get(1).follow(User.query.get(2))
+        User.query.get(1).follow(User.query.get(4))
+        User.query.get(3).follow(User.query.get(2))
+        db.session.commit()
+
+    def testFollowStatusOfEachUser(self):
+        response = self.client.get("/follow/1?ids=2,3,4")
+
+        assert response.status_code == 200
+        assert response.json["following"] == {"2": True, "3": False, "4": True}
+        assert response.json["missing"] == []
+
+    def testMatchesSingleLookups(self):
+        response = self.client.get("/follow/3?ids=1,2,4")
+
+        for id in (1, 2, 4):
+            assert response.json["following"][str(id)] == self.client.get(f"/follow/3/{id}").json["following"]
+
+    def testMissingUsersAreReported(self):
+        response = self.client.get("/follow/1?ids=2,9")
+
+        assert response.json["following"] == {"2": True}
+        assert response.json["missing"] == [9]
+
+    def testMissingFollower(self):
+        assert self.client.get("/follow/9?ids=1").status_code == 404
+
+    def testBatchSizeIsCapped(self):
+        assert self.client.get("/follow/1?ids=" + ",".join(str(id) for id in range(1, 102))).status_code == 400
+
+class SearchClips(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(self.createUser())
+        db.session.add(User(id=2, username="acemaster", password="asdf"))
+        db.session.add(self.createClip(id=5, authorId=1, title="CSGO ACE", description="four headshots"))
+        db.session.add(self.createClip(id=6, authorId=1, clipUuid=str(uuid.uuid4()), title="Valorant clutch", description="an ace to finish"))
+        db.session.add(self.createClip(id=7, authorId=2, clipUuid=str(uuid.uuid4()), title="Funny moment"))
+        db.session.commit()
+
+    def searchIds(self, path):
+        response = self.client.get(path)
+        assert response.status_code == 200
+        return [clip["id"] for clip in response.json["clips"]]
+
+    def testTitleMatchesRankAboveOtherColumns(self):
+        assert self.searchIds("/search?q=ace") == [5, 7, 6]
+
+    def testWordsAreMatchedByPrefix(self):
+        assert self.searchIds("/search?q=valo") == [6]
+        assert self.searchIds("/search?q=CSGO head") == [5]
+        assert self.searchIds("/search?q=headshot clutch") == []
+
+    def testResultsHaveClipDetails(self):
+        response = self.client.get("/search?q=funny")
+
+        assert response.json["clips"][0]["author"] == "acemaster"
+        assert response.json["clips"][0]["numComments"] == 0
+        assert response.json["nextCursor"] is None
+
+    def testPagesFollowTheCursor(self):
+        first = self.client.get("/search?q=ace&limit=2").json
+        second = self.client.get(f"/search?q=ace&limit=2&cursor={first['nextCursor']}").json
+
+        assert [clip["id"] for clip in first["clips"] + second["clips"]] == [5, 7, 6]
+        assert second["nextCursor"] is None
+
+    def testBroadSearchesRankTheNewestMatches(self):
+        app.config["SEARCH_CANDIDATES"] = 2
+        try:
+            first = self.client.get("/search?q=ace&limit=1").json
+            second = self.client.get(f"/search?q=ace&limit=1&cursor={first['nextCursor']}").json
+        finally:
+            app.config["SEARCH_CANDIDATES"] = 5000
+
+        assert [clip["id"] for clip in first["clips"] + second["clips"]] == [7, 6]
+        assert second["nextCursor"] is None
+
+    def testQuerySyntaxIsNotInterpreted(self):
+        assert self.searchIds('/search?q=ace" OR "funny') == []
+        assert self.searchIds("/search?q=NEAR(ace") == []
+
+    def testInvalidArguments(self):
+        assert self.client.get("/search").status_code == 400
+        assert self.client.get("/search?q=%22*").status_code == 400
+        assert self.client.get("/search?q=ace&cursor=abc").status_code == 400
+        assert self.client.get("/search?q=ace&limit=0").status_code == 400
+
+    def testIndexFollowsAddedAndDeletedClips(self):
+        self.client.get("/search?q=league")
+        self.client.put("/clips", data={"file": (io.BytesIO(TEST_CLIP), "test.mp4"), "authorId": 2, "title": "League pentakill"})
+        assert self.searchIds("/search?q=league") == [8]
+
+        self.client.delete("/clips/8")
+        collectGarbage()
+        assert self.searchIds("/search?q=league") == []
+
+    def testIndexFollowsUsernames(self):
+        db.session.add(User(id=3, username="zed", password="asdf"))
+        db.session.add(self.createClip(id=8, authorId=3, clipUuid=str(uuid.uuid4()), title="Outplay"))
+        db.session.commit()
+        assert self.searchIds("/search?q=zed") == [8]
+
+        User.query.get(3).username = "zedmain"
+        db.session.commit()
+        assert self.searchIds("/search?q=zedm") == [8]
+
+class CommentPages(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(self.createUser())
+        db.session.add(self.createClip(id=5, authorId=1, title="CSGO ACE"))
+        for day in range(1, 6):
+            db.session.add(Comment(id=day, comment=f"comment {day}", authorId=1, clipId=5, dateOfCreation=datetime(2021, 1, day)))
+        db.session.commit()
+
+    def testPagesAreNewestFirst(self):
+        first = self.client.get("/comments/5?limit=2")
+        second = self.client.get(f"/comments/5?limit=2&cursor={first.json['nextCursor']}")
+        third = self.client.get(f"/comments/5?limit=2&cursor={second.json['nextCursor']}")
+
+        assert [comment["id"] for comment in first.json["comments"]] == [5, 4]
+        assert [comment["id"] for comment in second.json["comments"]] == [3, 2]
+        assert [comment["id"] for comment in third.json["comments"]] == [1]
+        assert third.json["nextCursor"] is None
+        assert first.json["comments"][0]["author"] == "bob"
+
+    def testCommentsWithTheSameDateAreNotSkipped(self):
+        for id in range(6, 9):
+            db.session.add(Comment(id=id, comment="same time", authorId=1, clipId=5, dateOfCreation=datetime(2021, 2, 1)))
+        db.session.commit()
+
+        first = self.client.get("/comments/5?limit=2")
+        second = self.client.get(f"/comments/5?limit=2&cursor={first.json['nextCursor']}")
+
+        assert [comment["id"] for comment in first.json["comments"] + second.json["comments"]] == [8, 7, 6, 5]
+
+    def testCommentsSinceCursor(self):
+        latest = self.client.get("/comments/5?limit=2").json["latestCursor"]
+        assert self.client.get(f"/comments/5?since={latest}").json["comments"] == []
+
+        self.client.put("/comments/5", json=dict(authorId=1, comment="new one"))
+        self.client.put("/comments/5", json=dict(authorId=1, comment="newer one"))
+
+        response = self.client.get(f"/comments/5?since={latest}")
+        assert [comment["comment"] for comment in response.json["comments"]] == ["new one", "newer one"]
+        assert response.json["more"] == False
+        assert self.client.get(f"/comments/5?since={response.json['latestCursor']}").json["comments"] == []
+
+    def testCommentsSinceAreLimited(self):
+        response = self.client.get(f"/comments/5?since={encodeCursor(datetime.min, 0)}&limit=3")
+
+        assert [comment["id"] for comment in response.json["comments"]] == [1, 2, 3]
+        assert response.json["more"] == True
+
+    def testInvalidCursors(self):
+        assert self.client.get("/comments/5?since=nonsense").status_code == 400
+        assert self.client.get("/comments/5?cursor=nonsense").status_code == 400
+
+    def testClipWithoutComments(self):
+        db.session.add(self.createClip(id=6, authorId=1, clipUuid=str(uuid.uuid4())))
+        db.session.commit()
+
+        response = self.client.get("/comments/6?limit=2")
+
+        assert response.json["comments"] == []
+        assert self.client.get(f"/comments/6?since={response.json['latestCursor']}").status_code == 200
+
+class CommentStream(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        app.config["COMMENT_STREAM_DURATION"] = 0.3
+        app.config["COMMENT_STREAM_KEEPALIVE"] = 0.1
+        db.session.add(self.createUser())
+        db.session.add(self.createClip(id=5, authorId=1, title="CSGO ACE"))
+        db.session.add(Comment(id=1, comment="old", authorId=1, clipId=5, dateOfCreation=datetime(2021, 1, 1)))
+        db.session.commit()
+
+    def tearDown(self):
+        app.config["COMMENT_STREAM_DURATION"] = 300
+        app.config["COMMENT_STREAM_KEEPALIVE"] = 15
+        super().tearDown()
+
+    def events(self, body):
+        return [event for event in body.split("\n\n") if event.startswith("id: ")]
+
+    def testNewCommentsArePushed(self):
+        response = self.client.get("/comments/5/stream")
+        self.client.put("/comments/5", json=dict(authorId=1, comment="live"))
+
+        body = response.get_data(as_text=True)
+
+        assert response.mimetype == "text/event-stream"
+        events = self.events(body)
+        assert len(events) == 1
+        assert '"comment": "live"' in events[0]
+        assert ": keep-alive" in body
+
+    def testMissedCommentsAreSentOnReconnect(self):
+        response = self.client.get("/comments/5/stream", headers={"Last-Event-ID": encodeCursor(datetime.min, 0)})
+
+        events = self.events(response.get_data(as_text=True))
+
+        assert len(events) == 1
+        assert events[0].startswith(f"id: {encodeCursor(datetime(2021, 1, 1), 1)}\n")
+        assert '"comment": "old"' in events[0]
+
+    def testStreamOfMissingClip(self):
+        assert self.client.get("/comments/9/stream").status_code == 404
+
+    def testStreamHoldsItsSlotUntilItEnds(self):
+        admission = AdmissionControl([Lane("events", 1)], {"streamComments": "events"}, TokenBuckets(),
+            {"client": (0, 1), "author": (0, 1)}, 0.01)
+        with mock.patch("application.admission", admission):
+            first = self.client.get("/comments/5/stream")
+            assert self.client.get("/comments/5/stream").status_code == 503
+            first.get_data()
+            assert admission.lanes["events"].active == 0
+
+            # Closed by the server before its first event, as when the client goes away at once
+            self.client.get("/comments/5/stream").close()
+            assert admission.lanes["events"].active == 0
+
+class StoredFilesTestCase(BaseTestCase):
+    """Keeps clip files in a directory of their own, so that garbage collection only ever sees this test's files."""
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.clipDirectory = app.config["CLIP_DIRECTORY"]
+        app.config["CLIP_DIRECTORY"] = self.directory
+        self.storage = LocalStorage(self.directory)
+        self.patch = mock.patch("application.storage", self.storage)
+        self.patch.start()
+        db.session.add(self.createUser())
+        db.session.commit()
+
+    def tearDown(self):
+        self.patch.stop()
+        app.config["CLIP_DIRECTORY"] = self.clipDirectory
+        app.config["GC_GRACE_PERIOD"] = 24 * 60 * 60
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def upload(self, data):
+        response = self.client.put("/clips", data={"file": (io.BytesIO(data), "test.mp4"), "authorId": 1, "title": "repost"})
+        return Clip.query.get(response.json["id"])
+
+    def write(self, key, data=b"data"):
+        path = self.storage.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(data)
+        return path
+
+class ClipDeduplication(StoredFilesTestCase):
+    def testSameBytesAreStoredOnce(self):
+        first = self.upload(TEST_CLIP)
+        second = self.upload(TEST_CLIP)
+        other = self.upload(mp4Clip(5))
+
+        assert first.blobDigest == second.blobDigest == hashlib.sha256(TEST_CLIP).hexdigest()
+        assert Blob.query.get(first.blobDigest).refCount == 2
+        assert Blob.query.get(other.blobDigest).refCount == 1
+        assert sorted(key for key, size, modified in self.storage.listKeys()) == sorted(
+            [blobKey(first.blobDigest), blobKey(other.blobDigest)])
+        assert self.client.get(f"/clips/{second.id}").data == TEST_CLIP
+
+    def testBlobGoesWithItsLastReference(self):
+        first = self.upload(TEST_CLIP)
+        second = self.upload(TEST_CLIP)
+        path = self.storage.path(first.sourceKey())
+
+        self.client.delete(f"/clips/{first.id}")
+        collectGarbage()
+        assert os.path.exists(path)
+
+        self.client.delete(f"/clips/{second.id}")
+        collectGarbage()
+        assert not os.path.exists(path)
+        assert Blob.query.count() == 0
+
+    def testResumableUploadIsDeduplicated(self):
+        clip = self.upload(TEST_CLIP)
+        upload = self.client.post("/uploads", json={"authorId": 1, "title": "again", "size": len(TEST_CLIP)}).json
+        self.client.put(f"/uploads/{upload['uploadId']}/chunks/0", data=TEST_CLIP,
+            headers={"Upload-Offset": "0", "X-Chunk-Checksum": hashlib.sha256(TEST_CLIP).hexdigest()})
+
+        again = Clip.query.get(self.client.post(f"/uploads/{upload['uploadId']}/finalize").json["id"])
+
+        assert again.blobDigest == clip.blobDigest
+        assert Blob.query.get(clip.blobDigest).refCount == 2
+        assert not os.path.exists(os.path.join(self.directory, f"{upload['uploadId']}.part"))
+
+    def testFailedCommitLeavesTheUpload(self):
+        upload = self.client.post("/uploads", json={"authorId": 1, "title": "again", "size": len(TEST_CLIP)}).json
+        self.client.put(f"/uploads/{upload['uploadId']}/chunks/0", data=TEST_CLIP,
+            headers={"Upload-Offset": "0", "X-Chunk-Checksum": hashlib.sha256(TEST_CLIP).hexdigest()})
+
+        with mock.patch("application.fanOutClip", side_effect=RuntimeError("lost the database")):
+            with self.assertRaises(RuntimeError):
+                self.client.post(f"/uploads/{upload['uploadId']}/finalize")
+
+        assert open(os.path.join(self.directory, f"{upload['uploadId']}.part"), "rb").read() == TEST_CLIP
+        assert Blob.query.count() == 0
+        assert not self.storage.exists(blobKey(hashlib.sha256(TEST_CLIP).hexdigest()))
+
+    def testFileIsStoredBeforeTheWriteTransaction(self):
+        statements = []
+        putFile = self.storage.putFile
+
+        def recordStatement(connection, cursor, statement, *args):
+            statements.append(statement.split()[0].upper())
+
+        def recordPut(sourcePath, key):
+            statements.append("PUT")
+            putFile(sourcePath, key)
+
+        event.listen(db.engine, "before_cursor_execute", recordStatement)
+        try:
+            with mock.patch.object(self.storage, "putFile", recordPut):
+                self.upload(TEST_CLIP)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", recordStatement)
+
+        writes = [index for index, statement in enumerate(statements) if statement in ("INSERT", "UPDATE", "DELETE")]
+        assert statements.index("PUT") < writes[0]
+
+    def testCollectedBlobIsStoredAgain(self):
+        clip = self.upload(TEST_CLIP)
+        self.client.delete(f"/clips/{clip.id}")
+        path = self.storage.path(blobKey(clip.blobDigest))
+        exists = self.storage.exists
+
+        def collectedAfterTheCheck(key):
+            # The garbage collector removes the unreferenced file just after the upload saw it
+            found = exists(key)
+            if os.path.exists(path):
+                os.remove(path)
+            return found
+
+        with mock.patch.object(self.storage, "exists", collectedAfterTheCheck):
+            again = self.upload(TEST_CLIP)
+
+        assert Blob.query.get(again.blobDigest).refCount == 1
+        assert self.client.get(f"/clips/{again.id}").data == TEST_CLIP
+
+    def testMigrationCollapsesDuplicates(self):
+        for id, data in ((1, b"same highlight"), (2, b"same highlight"), (3, b"another")):
+            clip = self.createClip(id=id, authorId=1, clipUuid=str(uuid.uuid4()))
+            db.session.add(clip)
+            self.write(clipKey(clip.clipUuid), data)
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=["dedup-clips"])
+
+        assert "Moved 3 clips into blobs and reclaimed 14 bytes" in result.output
+        assert Clip.query.get(1).blobDigest == Clip.query.get(2).blobDigest
+        assert Blob.query.get(Clip.query.get(1).blobDigest).refCount == 2
+        assert len(list(self.storage.listKeys())) == 2
+        assert self.client.get("/clips/2").data == b"same highlight"
+
+class DataTransfer(StoredFilesTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(User(id=2, username="alice", password="pass123"))
+        db.session.commit()
+        self.digest = self.upload(TEST_CLIP).blobDigest
+        self.upload(TEST_CLIP)
+        own = self.createClip(id=3, authorId=2, clipUuid=str(uuid.uuid4()), title="flick")
+        db.session.add(own)
+        db.session.add(Rendition(clipId=3, name="360p", width=640, height=360, size=4))
+        db.session.add(Comment(comment="Nice", authorId=1, clipId=3))
+        db.session.commit()
+        self.write(clipKey(own.clipUuid), b"own file")
+        self.write(clipKey(own.clipUuid, "360p"), b"360p")
+        self.client.put("/follow/1/2")
+        self.exportDirectory = tempfile.mkdtemp()
+        self.files = os.path.join(self.exportDirectory, "files")
+
+    def tearDown(self):
+        shutil.rmtree(self.exportDirectory)
+        super().tearDown()
+
+    def invoke(self, *args):
+        return app.test_cli_runner(mix_stderr=False).invoke(args=["data", *args])
+
+    def emptyDatabase(self):
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        shutil.rmtree(self.directory)
+
+    def testRoundTrip(self):
+        path = os.path.join(self.exportDirectory, "export.ndjson.gz")
+        exported = self.invoke("export", path, "--files", self.files)
+        assert exported.exit_code == 0
+        assert "Exported 9 rows and 3 files" in exported.stderr
+        self.emptyDatabase()
+
+        imported = self.invoke("import", path, "--files", self.files)
+
+        assert imported.exit_code == 0, imported.stderr
+        assert "Imported 9 rows" in imported.stderr
+        assert [user.username for user in User.query.order_by(User.id)] == ["bob", "alice"]
+        assert User.query.get(2).followerCount == 1
+        assert Clip.query.get(3).commentCount == 1
+        assert Blob.query.get(self.digest).refCount == 2
+        assert TimelineEntry.query.filter_by(userId=1).count() == 1
+        assert [clip["id"] for clip in self.client.get("/search?q=flick").json["clips"]] == [3]
+        assert self.client.get("/clips/1").data == TEST_CLIP
+        assert self.client.get("/clips/3?rendition=360p").data == b"360p"
+        assert self.client.put("/clips", data={"file": (io.BytesIO(mp4Clip(5)), "test.mp4"), "authorId": 1,
+            "title": "new"}).json["id"] == 4
+
+    def testCorruptFilesAreReported(self):
+        path = os.path.join(self.exportDirectory, "export.ndjson")
+        self.invoke("export", path, "--files", self.files)
+        with open(os.path.join(self.files, *clipKey(Clip.query.get(3).clipUuid).split("/")), "wb") as file:
+            file.write(b"own fil3")
+        self.emptyDatabase()
+
+        imported = self.invoke("import", path, "--files", self.files)
+
+        assert imported.exit_code == 1
+        assert "1 clip files were missing or failed their checksum" in imported.stderr
+        assert Clip.query.count() == 3
+        assert not self.storage.exists(clipKey(Clip.query.get(3).clipUuid))
+        assert self.storage.exists(clipKey(Clip.query.get(3).clipUuid, "360p"))
+
+    def testImportNeedsAnEmptyDatabase(self):
+        path = os.path.join(self.exportDirectory, "export.ndjson")
+        self.invoke("export", path)
+
+        imported = self.invoke("import", path)
+
+        assert imported.exit_code == 1
+        assert "already has rows, the import needs an empty database" in imported.stderr
+        assert User.query.count() == 2
+
+class StorageReconciliation(StoredFilesTestCase):
+    def setUp(self):
+        super().setUp()
+        app.config["GC_GRACE_PERIOD"] = 0
+        self.clip = self.upload(TEST_CLIP)
+        db.session.add(Rendition(clipId=self.clip.id, name="360p", width=640, height=360, size=4))
+        db.session.commit()
+        self.write(clipKey(self.clip.clipUuid, "360p"))
+        self.write(getThumbnailKey(self.clip.clipUuid, "poster"))
+        self.uploadId = self.client.post("/uploads", json={"authorId": 1, "title": "partial", "size": 10}).json["uploadId"]
+        self.orphans = sorted([
+            self.write(clipKey(str(uuid.uuid4()))),
+            self.write(clipKey(self.clip.clipUuid, "720p")),
+            self.write(getThumbnailKey(str(uuid.uuid4()), "poster")),
+            self.write(blobKey("ab" * 32)),
+            self.write(f"{uuid.uuid4()}.part"),
+        ])
+        self.write("notes.txt")
+
+    def files(self):
+        return sorted(os.path.join(root, name) for root, directories, names in os.walk(self.directory) for name in names)
+
+    def testDryRunOnlyReports(self):
+        before = self.files()
+
+        result = app.test_cli_runner().invoke(args=["reconcile-storage", "--dry-run"])
+
+        assert "Found 5 orphaned files, 20 bytes" in result.output
+        for path in self.orphans:
+            assert os.path.relpath(path, self.directory).replace(os.sep, "/") in result.output
+        assert self.files() == before
+
+    def testOrphansAreRemoved(self):
+        before = self.files()
+
+        result = app.test_cli_runner().invoke(args=["reconcile-storage"])
+
+        assert "Removed 5 orphaned files, 20 bytes" in result.output
+        assert self.files() == sorted(set(before) - set(self.orphans))
+        assert Blob.query.count() == 1
+
+    def testRecentFilesAreLeftAlone(self):
+        app.config["GC_GRACE_PERIOD"] = 60 * 60
+
+        result = app.test_cli_runner().invoke(args=["reconcile-storage", "--dry-run"])
+
+        assert "Found 0 orphaned files" in result.output
+
+    def testDeletedClipsAreLeftToTheCollector(self):
+        self.client.delete(f"/clips/{self.clip.id}")
+
+        result = app.test_cli_runner().invoke(args=["reconcile-storage", "--dry-run"])
+
+        # The stray rendition of the deleted clip included
+        assert "Found 4 orphaned files" in result.output
+        assert clipKey(self.clip.clipUuid, "720p") not in result.output
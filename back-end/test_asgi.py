@@ -0,0 +1,424 @@
+import pytest
+pytest.importorskip("aiosqlite")
+
+from werkzeug.test import EnvironBuilder
+from test_application import TEST_CLIP
+from test_database import FileDatabaseTestCase
+from unittest import mock
+from application import app, db, storage, flushViewCounts, sessionTokens, User, Clip, UploadSession
+from asgi import asgiApp
+from views import ViewCounter
+from admission import AdmissionControl, Lane, TokenBuckets
+from auth import HASH_PREFIX, PasswordHasher
+import asyncio, hashlib, io, json, os, uuid
+
+def asgiScope(method, path, headers=(), query=b""):
+    return {"type": "http", "http_version": "1.1", "method": method, "scheme": "http", "path": path,
+            "root_path": "", "query_string": query, "server": ("testserver", 80), "client": ("127.0.0.1", 5000),
+            "headers": [(name.lower().encode(), value.encode()) for name, value in headers]}
+
+def asgiRequest(method, path, body=b"", headers=(), query=b""):
+    """Runs one request through the ASGI app and returns its status, headers and body."""
+    scope = asgiScope(method, path, headers, query)
+    # Split the body in two messages, like a client sending it in several packets
+    messages = [{"type": "http.request", "body": body[:len(body) // 2], "more_body": True},
+                {"type": "http.request", "body": body[len(body) // 2:], "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    async def run():
+        try:
+            await asgiApp(scope, receive, send)
+        finally:
+            # Each request runs in its own event loop, which the pooled connections cannot outlive
+            await asgiApp.close()
+
+    asyncio.run(run())
+    start = sent[0]
+    assert start["type"] == "http.response.start"
+    assert sent[-1].get("more_body", False) == False
+    return (start["status"], {name.decode(): value.decode() for name, value in start["headers"]},
+            b"".join(message.get("body", b"") for message in sent[1:]))
+
+class OpenRequest:
+    """A request running on the current event loop whose client stays connected until disconnect() is called."""
+    def __init__(self, method, path, body=b"", headers=()):
+        self.scope = asgiScope(method, path, headers)
+        self.body = body
+        self.sent = []
+        self.received = False
+        self.gone = asyncio.Event()
+        self.task = asyncio.ensure_future(asgiApp(self.scope, self.receive, self.send))
+
+    async def receive(self):
+        if not self.received:
+            self.received = True
+            return {"type": "http.request", "body": self.body, "more_body": False}
+        await self.gone.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(self, message):
+        self.sent.append(message)
+
+    def disconnect(self):
+        self.gone.set()
+
+    def status(self):
+        return self.sent[0]["status"] if self.sent else None
+
+    def text(self):
+        return b"".join(message.get("body", b"") for message in self.sent[1:]).decode()
+
+def runRequests(scenario):
+    async def run():
+        try:
+            await scenario()
+        finally:
+            await asgiApp.close()
+    asyncio.run(run())
+
+class AsgiTestCase(FileDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(User(id=1, username="bob", password="pass123"))
+        db.session.commit()
+        self.paths = []
+
+    def tearDown(self):
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+        super().tearDown()
+
+    def addClipFile(self, data):
+        clipUuid = str(uuid.uuid4())
+        db.session.add(Clip(id=1, authorId=1, clipUuid=clipUuid, title="clip", description=""))
+        db.session.commit()
+        Clip.getClipsDirectory()
+        self.paths.append(Clip.getClipPath(clipUuid))
+        with open(Clip.getClipPath(clipUuid), "wb") as file:
+            file.write(data)
+        return clipUuid
+
+class AsgiClipStreaming(AsgiTestCase):
+    def testWholeClipMatchesFlask(self):
+        self.addClipFile(b"0123456789")
+
+        status, headers, body = asgiRequest("GET", "/clips/1")
+        flaskResponse = self.client.get("/clips/1")
+
+        assert status == 200
+        assert body == flaskResponse.data == b"0123456789"
+        for name in ("ETag", "Cache-Control", "Accept-Ranges", "Content-Length", "Content-Type"):
+            assert headers[name.lower()] == flaskResponse.headers[name]
+
+    def testSingleRange(self):
+        self.addClipFile(b"0123456789")
+
+        status, headers, body = asgiRequest("GET", "/clips/1", headers=[("Range", "bytes=2-5")])
+
+        assert status == 206
+        assert body == b"2345"
+        assert headers["content-range"] == "bytes 2-5/10"
+
+    def testPlaybackIsCounted(self):
+        self.addClipFile(b"0123456789")
+        counter = ViewCounter(flushViewCounts, 60, 1000, 30, 3600)
+
+        with mock.patch("application.viewCounter", counter):
+            asgiRequest("GET", "/clips/1")
+            asgiRequest("GET", "/clips/1", headers=[("Range", "bytes=5-")])
+            counter.flush()
+
+        db.session.expire_all()
+        assert (Clip.query.get(1).viewCount, Clip.query.get(1).playCount) == (1, 1)
+
+    def testEmptyClip(self):
+        self.addClipFile(b"")
+
+        status, headers, body = asgiRequest("GET", "/clips/1")
+
+        assert status == 200
+        assert body == b""
+
+    def testNotModifiedIsAnsweredByFlask(self):
+        clipUuid = self.addClipFile(b"0123456789")
+
+        status, headers, body = asgiRequest("GET", "/clips/1", headers=[("If-None-Match", f'"{clipUuid}"')])
+
+        assert status == 304
+
+    def testMissingClipIsAnsweredByFlask(self):
+        status, headers, body = asgiRequest("GET", "/clips/7")
+
+        assert status == 404
+
+class AsgiAdmission(AsgiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.admission = AdmissionControl([Lane("streams", 1)], {"getClipById": "streams"}, TokenBuckets(),
+            {"client": (0.001, 3), "author": (0, 1)}, 0.01)
+        self.patches = [mock.patch("asgi.admission", self.admission), mock.patch("application.admission", self.admission)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        super().tearDown()
+
+    def testStreamsHoldALaneSlot(self):
+        clipUuid = self.addClipFile(b"0123456789")
+        lane = self.admission.admit("getClipById", "elsewhere")
+
+        status, headers, body = asgiRequest("GET", "/clips/1")
+        assert status == 503
+        assert headers["retry-after"] == "1"
+
+        self.admission.release(lane)
+        assert asgiRequest("GET", "/clips/1")[0] == 200
+        # Answered by Flask, without being counted against the client a second time
+        assert asgiRequest("GET", "/clips/1", headers=[("If-None-Match", f'"{clipUuid}"')])[0] == 304
+        assert self.admission.lanes["streams"].active == 0
+        assert asgiRequest("GET", "/clips/1")[0] == 429
+
+class AsgiCommentStream(AsgiTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(Clip(id=1, authorId=1, clipUuid=str(uuid.uuid4()), title="clip", description=""))
+        db.session.commit()
+        app.config["COMMENT_STREAM_DURATION"] = 30
+        app.config["COMMENT_STREAM_KEEPALIVE"] = 0.05
+        self.admission = AdmissionControl([Lane("events", 50)], {"streamComments": "events"}, TokenBuckets(),
+            {"client": (0, 1), "author": (0, 1)}, 0.01)
+        self.patches = [mock.patch("asgi.admission", self.admission), mock.patch("application.admission", self.admission)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        app.config["COMMENT_STREAM_DURATION"] = 300
+        app.config["COMMENT_STREAM_KEEPALIVE"] = 15
+        super().tearDown()
+
+    async def waitFor(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        raise AssertionError("timed out")
+
+    def testNewCommentsArePushed(self):
+        async def scenario():
+            stream = OpenRequest("GET", "/comments/1/stream")
+            await self.waitFor(lambda: "keep-alive" in stream.text())
+            comment = OpenRequest("PUT", "/comments/1", json.dumps({"authorId": 1, "comment": "live"}).encode(),
+                [("Content-Type", "application/json")])
+            await comment.task
+            await self.waitFor(lambda: "event: comment" in stream.text())
+            stream.disconnect()
+            await stream.task
+
+            assert stream.status() == 200
+            assert dict(stream.sent[0]["headers"])[b"content-type"] == b"text/event-stream; charset=utf-8"
+            assert '"comment": "live"' in stream.text()
+
+        runRequests(scenario)
+        assert self.admission.lanes["events"].active == 0
+
+    def testOtherRequestsAreServedWhileStreamsAreOpen(self):
+        # Idle streams that wait long for their next event, as they do between keep-alives
+        app.config["COMMENT_STREAM_KEEPALIVE"] = 10
+
+        async def scenario():
+            streams = [OpenRequest("GET", "/comments/1/stream") for _ in range(40)]
+            await self.waitFor(lambda: all(stream.status() == 200 for stream in streams))
+
+            user = OpenRequest("GET", "/user/1")
+            await asyncio.wait_for(user.task, 2)
+
+            assert user.status() == 200
+            assert not any(stream.task.done() for stream in streams)
+            for stream in streams:
+                stream.disconnect()
+            await asyncio.gather(*[stream.task for stream in streams])
+
+        runRequests(scenario)
+        assert self.admission.lanes["events"].active == 0
+
+    def testStreamsHoldAnEventsSlot(self):
+        self.admission.lanes["events"] = Lane("events", 1)
+
+        async def scenario():
+            first = OpenRequest("GET", "/comments/1/stream")
+            await self.waitFor(lambda: first.status() == 200)
+            second = OpenRequest("GET", "/comments/1/stream")
+            await second.task
+
+            assert second.status() == 503
+            first.disconnect()
+            await first.task
+
+        runRequests(scenario)
+        assert self.admission.lanes["events"].active == 0
+
+    def testStreamOfMissingClipIsAnsweredByFlask(self):
+        assert asgiRequest("GET", "/comments/9/stream")[0] == 404
+
+class AsgiSignIn(AsgiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.hasher = PasswordHasher(1, workers=1, backlog=0)
+        self.patch = mock.patch("asgi.passwordHasher", self.hasher)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        super().tearDown()
+
+    def signIn(self, path, username, password):
+        body = json.dumps({"username": username, "password": password}).encode()
+        status, headers, response = asgiRequest("POST", path, body, [("Content-Type", "application/json")])
+        return status, json.loads(response)
+
+    def testRegisterThenLogin(self):
+        status, registered = self.signIn("/register", "alice", "secret")
+        assert status == 200
+        assert sessionTokens.verify(registered["token"]) == registered["id"]
+        # Hashed by the patched hasher, so on the event loop rather than by the Flask view
+        assert User.query.get(registered["id"]).password.startswith(f"{HASH_PREFIX}ln=1,")
+
+        status, loggedIn = self.signIn("/login", "alice", "secret")
+        assert status == 200
+        assert loggedIn["id"] == registered["id"]
+        assert self.signIn("/login", "alice", "wrong") == (404, {"status": "not a valid login"})
+        assert self.signIn("/login", "nobody", "secret")[0] == 404
+
+    def testPlaintextPasswordIsRehashedOnLogin(self):
+        assert self.signIn("/login", "bob", "pass123")[0] == 200
+
+        db.session.expire_all()
+        assert User.query.get(1).password.startswith(f"{HASH_PREFIX}ln=1,")
+        assert self.signIn("/login", "bob", "pass123")[0] == 200
+
+    def testTakenUsername(self):
+        assert self.signIn("/register", "bob", "secret") == \
+            (400, {"status": "unsuccessful registration: user with username already exists"})
+        assert self.signIn("/register", "a" * 21, "secret")[0] == 400
+
+    def testBusyHasher(self):
+        self.hasher.slots.acquire()
+        try:
+            status, body = self.signIn("/register", "alice", "secret")
+        finally:
+            self.hasher.slots.release()
+
+        assert status == 503
+        assert User.query.filter_by(username="alice").first() is None
+
+    def testOtherBodiesAreAnsweredByFlask(self):
+        body = json.dumps({"username": 5, "password": "x"}).encode()
+
+        status, headers, response = asgiRequest("POST", "/login", body, [("Content-Type", "application/json")])
+
+        assert status == 404
+
+class AsgiFlaskRoutes(AsgiTestCase):
+    def testJsonRoute(self):
+        status, headers, body = asgiRequest("GET", "/user/1")
+
+        assert status == 200
+        assert json.loads(body)["user"] == "bob"
+
+    def testClipUpload(self):
+        builder = EnvironBuilder(method="PUT", data={"file": (io.BytesIO(TEST_CLIP), "test.mp4"),
+            "authorId": "1", "title": "asgi upload"})
+        environ = builder.get_environ()
+        body = environ["wsgi.input"].read()
+        builder.close()
+
+        status, headers, response = asgiRequest("PUT", "/clips", body,
+            [("Content-Type", environ["CONTENT_TYPE"]), ("Content-Length", str(len(body)))])
+
+        assert status == 200
+        clip = Clip.query.get(json.loads(response)["id"])
+        self.paths.append(storage.path(clip.sourceKey()))
+        with open(storage.path(clip.sourceKey()), "rb") as file:
+            assert file.read() == TEST_CLIP
+
+class AsgiResumableUpload(AsgiTestCase):
+    def createUpload(self, size):
+        body = json.dumps({"authorId": 1, "title": "chunked", "size": size}).encode()
+        status, headers, response = asgiRequest("POST", "/uploads", body, [("Content-Type", "application/json")])
+        assert status == 200
+        upload = json.loads(response)
+        self.paths.append(UploadSession(id=upload["uploadId"]).getPartPath())
+        return upload["uploadId"]
+
+    def sendChunk(self, uploadId, index, offset, data, checksum=None):
+        return asgiRequest("PUT", f"/uploads/{uploadId}/chunks/{index}", data, [("Upload-Offset", str(offset)),
+            ("X-Chunk-Checksum", checksum or hashlib.sha256(data).hexdigest())])
+
+    def testUploadInChunks(self):
+        uploadId = self.createUpload(len(TEST_CLIP))
+
+        status, headers, body = self.sendChunk(uploadId, 0, 0, TEST_CLIP[:5])
+        assert status == 200
+        assert json.loads(body)["offset"] == 5
+        assert self.sendChunk(uploadId, 1, 5, TEST_CLIP[5:])[0] == 200
+
+        status, headers, body = asgiRequest("POST", f"/uploads/{uploadId}/finalize")
+        assert status == 200
+        clip = Clip.query.get(json.loads(body)["id"])
+        self.paths.append(storage.path(clip.sourceKey()))
+        with open(storage.path(clip.sourceKey()), "rb") as file:
+            assert file.read() == TEST_CLIP
+
+    def testFirstChunkThatIsNotAnMp4(self):
+        uploadId = self.createUpload(10)
+
+        status, headers, body = self.sendChunk(uploadId, 0, 0, b"0123456789")
+
+        assert status == 400
+        assert json.loads(body)["status"] == "the file had the wrong format"
+        assert json.loads(asgiRequest("GET", f"/uploads/{uploadId}")[2])["offset"] == 0
+        assert os.path.getsize(UploadSession(id=uploadId).getPartPath()) == 0
+
+    def testFailedChunkIsCutBack(self):
+        uploadId = self.createUpload(len(TEST_CLIP))
+        self.sendChunk(uploadId, 0, 0, TEST_CLIP[:5])
+
+        async def failingAppend(chunks, path, offset, maxLength, parser=None):
+            with open(path, "ab") as file:
+                file.write(b"half a chunk")
+            raise OSError("the disk is full")
+
+        with mock.patch("asgi.appendChunkAsync", failingAppend):
+            with pytest.raises(OSError):
+                self.sendChunk(uploadId, 1, 5, TEST_CLIP[5:])
+
+        assert os.path.getsize(UploadSession(id=uploadId).getPartPath()) == 5
+        assert json.loads(asgiRequest("GET", f"/uploads/{uploadId}")[2])["offset"] == 5
+
+    def testChecksumMismatchKeepsTheOffset(self):
+        uploadId = self.createUpload(10)
+
+        status, headers, body = self.sendChunk(uploadId, 0, 0, b"01234", checksum="0" * 64)
+
+        assert status == 400
+        assert json.loads(body)["status"] == "the chunk checksum did not match"
+        assert json.loads(asgiRequest("GET", f"/uploads/{uploadId}")[2])["offset"] == 0
+
+    def testOutOfOrderChunkIsAnsweredByFlask(self):
+        uploadId = self.createUpload(10)
+
+        status, headers, body = self.sendChunk(uploadId, 1, 5, b"56789")
+
+        assert status == 409
+        assert json.loads(body)["nextChunk"] == 0
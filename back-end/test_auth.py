@@ -0,0 +1,95 @@
+from auth import HasherBusy, PasswordHasher, SessionTokens, hashPassword, needsRehash, verifyPassword
+from cache import LocalCache
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import asyncio, threading, time
+
+# The lowest cost hashlib accepts, so the tests do not spend their time hashing
+COST = 1
+
+class TestPasswords:
+    def testHashRoundTrip(self):
+        stored = hashPassword("pass123", COST)
+
+        assert stored.startswith("$scrypt$ln=1,r=8,p=1$")
+        assert verifyPassword("pass123", stored)
+        assert not verifyPassword("pass124", stored)
+        assert hashPassword("pass123", COST) != stored
+
+    def testLegacyPasswordsNeedRehash(self):
+        assert verifyPassword("pass123", "pass123")
+        assert needsRehash("pass123", COST)
+        assert needsRehash(hashPassword("pass123", COST), COST + 1)
+        assert not needsRehash(hashPassword("pass123", COST), COST)
+
+class TestPasswordHasher:
+    def testUnknownUserNeverVerifies(self):
+        hasher = PasswordHasher(COST, workers=1, backlog=0)
+
+        assert not hasher.verify("anything", None)
+        assert hasher.verify("pass123", hasher.hash("pass123"))
+
+    def testBurstPastBacklogIsRefused(self):
+        hasher = PasswordHasher(COST, workers=1, backlog=1)
+        release = threading.Event()
+        hasher.pool.submit(release.wait)
+
+        with ThreadPoolExecutor(2) as waiting:
+            queued = waiting.submit(hasher.hash, "pass123")
+            while hasher.slots._value == 2:
+                time.sleep(0.001)
+            second = waiting.submit(hasher.hash, "pass123")
+            while hasher.slots._value == 1:
+                time.sleep(0.001)
+
+            try:
+                hasher.hash("pass123")
+                assert False
+            except HasherBusy:
+                pass
+            release.set()
+            assert verifyPassword("pass123", queued.result()) and verifyPassword("pass123", second.result())
+
+    def testAsyncCallsAwaitThePool(self):
+        hasher = PasswordHasher(COST, workers=1, backlog=0)
+
+        async def hashAndVerify():
+            stored = await hasher.hashAsync("pass123")
+            return await hasher.verifyAsync("pass123", stored), await hasher.verifyAsync("pass123", None)
+
+        assert asyncio.run(hashAndVerify()) == (True, False)
+
+        hasher.slots.acquire()
+        try:
+            asyncio.run(hasher.hashAsync("pass123"))
+            assert False
+        except HasherBusy:
+            pass
+
+class TestSessionTokens:
+    def testTokenNamesItsUser(self):
+        tokens = SessionTokens("secret", 60, LocalCache())
+
+        token = tokens.issue(7)
+
+        assert tokens.verify(token) == 7
+        assert SessionTokens("other secret", 60, LocalCache()).verify(token) is None
+        assert tokens.verify(token[:-1] + ("A" if token[-1] != "A" else "B")) is None
+
+    def testTokensExpire(self):
+        tokens = SessionTokens("secret", 60, LocalCache())
+        token = tokens.issue(7)
+
+        with mock.patch("time.time", return_value=time.time() + 120):
+            assert tokens.verify(token) is None
+
+    def testRevokedTokenStopsWorking(self):
+        revoked = LocalCache()
+        tokens = SessionTokens("secret", 60, revoked)
+        token, other = tokens.issue(7), tokens.issue(7)
+
+        assert tokens.revoke(token)
+
+        assert tokens.verify(token) is None
+        assert tokens.verify(other) == 7
+        assert len(revoked.entries) == 1
@@ -0,0 +1,70 @@
+from test_application import BaseTestCase
+from application import app, db, responseCache, storage, followers, User, Clip, Comment, TimelineEntry
+from cache import NoCache
+from benchmark import generateData, runMix, summarize, findRegressions, percentile, REQUEST_MIX
+import random, shutil, tempfile
+
+class GenerateData(BaseTestCase):
+    def testSameSeedGivesSameData(self):
+        generateData(random.Random(7), 20, 50, 80, 100)
+        first = [(clip.authorId, clip.dateOfCreation) for clip in Clip.query.order_by(Clip.id)]
+        db.drop_all()
+        db.create_all()
+
+        generateData(random.Random(7), 20, 50, 80, 100)
+
+        assert [(clip.authorId, clip.dateOfCreation) for clip in Clip.query.order_by(Clip.id)] == first
+        assert User.query.count() == 20
+        assert Comment.query.count() == 80
+        assert db.session.query(followers).count() == 100
+        assert sum(user.clipCount for user in User.query) == 50
+        assert TimelineEntry.query.count() > 0
+
+class RunMix(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.clipDirectory = app.config["CLIP_DIRECTORY"]
+        self.directory = tempfile.mkdtemp()
+        # Keeps the clips PUT /clips uploads out of the real clips folder
+        app.config["CLIP_DIRECTORY"] = storage.directory = self.directory
+        # Like the benchmark's default, so every request reaches the database
+        self.cacheBackend = responseCache.backend
+        responseCache.backend = NoCache()
+
+    def tearDown(self):
+        responseCache.backend = self.cacheBackend
+        app.config["CLIP_DIRECTORY"] = storage.directory = self.clipDirectory
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def testEveryRouteIsReported(self):
+        generateData(random.Random(1), 20, 50, 80, 100)
+
+        results = runMix(random.Random(1), 300, 1, 20, 50)
+        report = summarize(results, 1.0)
+
+        assert report["requests"] == 300
+        assert set(report["routes"]) == {name for name, weight, request in REQUEST_MIX}
+        for route in report["routes"].values():
+            assert route["errors"] == 0
+            assert route["p50"] <= route["p95"] <= route["p99"]
+            assert route["statements"] >= 1
+
+class TestFindRegressions:
+    def report(self, p95, statements):
+        return {"routes": {"GET /clips": {"p95": p95, "statements": statements}}}
+
+    def testSlowerRouteIsARegression(self):
+        assert findRegressions(self.report(20.0, 1), self.report(10.0, 1), 0.2) != []
+
+    def testNoiseWithinTheThresholdIsNot(self):
+        assert findRegressions(self.report(11.0, 1), self.report(10.0, 1), 0.2) == []
+        assert findRegressions(self.report(0.9, 1), self.report(0.5, 1), 0.2) == []
+
+    def testMoreStatementsIsARegression(self):
+        assert findRegressions(self.report(10.0, 3), self.report(10.0, 2), 0.2) != []
+
+    def testPercentileIsAMeasuredValue(self):
+        assert percentile([1, 2, 3, 4], 50) == 2
+        assert percentile([1, 2, 3, 4], 99) == 4
+        assert percentile([5], 95) == 5
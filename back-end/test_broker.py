@@ -0,0 +1,39 @@
+from broker import LocalBroker
+import asyncio, threading
+
+class TestLocalBroker:
+    def testSubscribersOfTheChannelGetTheMessage(self):
+        broker = LocalBroker()
+        first = broker.subscribe("comments:1")
+        second = broker.subscribe("comments:1")
+        other = broker.subscribe("comments:2")
+
+        broker.publish("comments:1", "hello")
+
+        assert first.get(0.1) == "hello"
+        assert second.get(0.1) == "hello"
+        assert other.get(0.01) is None
+
+    def testEventLoopSubscriptionGetsMessagesFromOtherThreads(self):
+        broker = LocalBroker()
+
+        async def receive():
+            subscription = broker.subscribe("comments:1", asyncio.get_running_loop())
+            threading.Thread(target=broker.publish, args=("comments:1", "hello")).start()
+            first = await subscription.get(1)
+            second = await subscription.get(0.01)
+            subscription.close()
+            return first, second
+
+        assert asyncio.run(receive()) == ("hello", None)
+        assert broker.subscriberCount("comments:1") == 0
+
+    def testClosedSubscriptionGetsNothing(self):
+        broker = LocalBroker()
+        subscription = broker.subscribe("comments:1")
+
+        subscription.close()
+        broker.publish("comments:1", "hello")
+
+        assert subscription.get(0.01) is None
+        assert broker.subscriberCount("comments:1") == 0
@@ -0,0 +1,83 @@
+from cache import LocalCache, RedisCache, InMemoryRedis, ResponseCache
+from flask import Flask, Response
+import time
+
+class TestLocalCache:
+    def testLeastRecentlyUsedIsEvicted(self):
+        cache = LocalCache(maxEntries=2)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        cache.get("a")
+
+        cache.set("c", "3")
+
+        assert cache.get("a") == "1"
+        assert cache.get("b") is None
+        assert cache.get("c") == "3"
+
+    def testEntriesExpire(self):
+        cache = LocalCache()
+        cache.set("a", "1", ttl=0.01)
+
+        time.sleep(0.02)
+
+        assert cache.get("a") is None
+
+class TestResponseCache:
+    def respond(self, responseCache, key, tags, body):
+        calls = []
+
+        def build():
+            calls.append(body)
+            return Response(body, mimetype="application/json")
+
+        with Flask(__name__).app_context():
+            response = responseCache.respond(key, tags, "endpoint", build)
+        return response.get_data(as_text=True), len(calls)
+
+    def testHitUntilTagIsInvalidated(self):
+        responseCache = ResponseCache(LocalCache())
+
+        assert self.respond(responseCache, "/clips/info/5", ["clip:5"], "first") == ("first", 1)
+        assert self.respond(responseCache, "/clips/info/5", ["clip:5"], "second") == ("first", 0)
+
+        responseCache.invalidate("clip:6")
+        assert self.respond(responseCache, "/clips/info/5", ["clip:5"], "second") == ("first", 0)
+
+        responseCache.invalidate("clip:5")
+        assert self.respond(responseCache, "/clips/info/5", ["clip:5"], "second") == ("second", 1)
+
+        assert responseCache.stats()["hits"] == 2
+        assert responseCache.stats()["misses"] == 2
+        assert responseCache.stats()["endpoints"]["endpoint"] == {"hits": 2, "misses": 2}
+
+    def testEvictedTagVersionNeverServesOldEntry(self):
+        responseCache = ResponseCache(LocalCache(maxEntries=100))
+        self.respond(responseCache, "/comments/5", ["comments:5"], "first")
+
+        responseCache.backend.delete("tag:comments:5")
+
+        assert self.respond(responseCache, "/comments/5", ["comments:5"], "second") == ("second", 1)
+
+    def testErrorsAreNotCached(self):
+        responseCache = ResponseCache(LocalCache())
+
+        with Flask(__name__).app_context():
+            responseCache.respond("/user/1", ["user:1"], "endpoint", lambda: Response("missing", status=404))
+            response = responseCache.respond("/user/1", ["user:1"], "endpoint", lambda: Response("found"))
+
+        assert response.get_data(as_text=True) == "found"
+
+    def testSharedBackendIsSeenByEveryProcess(self):
+        server = InMemoryRedis()
+        firstProcess = ResponseCache(RedisCache(server))
+        secondProcess = ResponseCache(RedisCache(server))
+
+        self.respond(firstProcess, "/clips", ["clips"], "first")
+        assert self.respond(secondProcess, "/clips", ["clips"], "second") == ("first", 0)
+
+        secondProcess.invalidate("clips")
+        assert self.respond(firstProcess, "/clips", ["clips"], "third") == ("third", 1)
+
+        firstProcess.clear()
+        assert server.values == {}
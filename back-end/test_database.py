@@ -0,0 +1,106 @@
+from sqlalchemy.exc import OperationalError
+from test_application import BaseTestCase
+from application import app, db, retryOnLock, followers, User, Clip, Comment
+from concurrent.futures import ThreadPoolExecutor
+import os, sqlite3, shutil, tempfile
+
+class FileDatabaseTestCase(BaseTestCase):
+    """Runs against a SQLite file, which unlike the in-memory database gets a real pool and WAL."""
+    def create_app(self):
+        test_app = super().create_app()
+        self.directory = tempfile.mkdtemp()
+        test_app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{os.path.join(self.directory, 'test.db')}"
+        return test_app
+
+    def tearDown(self):
+        super().tearDown()
+        db.engine.dispose()
+        shutil.rmtree(self.directory)
+
+class SqliteEngine(FileDatabaseTestCase):
+    def testPragmasAreSetOnConnect(self):
+        with db.engine.connect() as connection:
+            assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+            # 1 is NORMAL
+            assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+            assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == app.config["SQLITE_BUSY_TIMEOUT"]
+
+    def testEngineIsPooled(self):
+        assert db.engine.pool.size() == app.config["DATABASE_POOL_SIZE"]
+
+class ConcurrentWrites(FileDatabaseTestCase):
+    THREADS = 8
+    WRITES = 10
+
+    def setUp(self):
+        super().setUp()
+        for id in range(1, self.THREADS + 1):
+            db.session.add(User(id=id, username=f"user{id}", password="asdf"))
+        db.session.add(Clip(id=1, authorId=1, clipUuid="concurrent", title="clip", description=""))
+        db.session.commit()
+
+    def hammer(self, id):
+        client = app.test_client()
+        followee = id % self.THREADS + 1
+        codes = []
+        for write in range(self.WRITES):
+            codes.append(client.put("/comments/1", json=dict(authorId=id, comment=f"comment {write}")).status_code)
+            codes.append(client.put(f"/follow/{id}/{followee}").status_code)
+            if write % 2 == 0:
+                codes.append(client.delete(f"/follow/{id}/{followee}").status_code)
+        return codes
+
+    def testWriteRoutesFromManyThreads(self):
+        with ThreadPoolExecutor(self.THREADS) as executor:
+            codes = [code for threadCodes in executor.map(self.hammer, range(1, self.THREADS + 1)) for code in threadCodes]
+
+        assert set(codes) == {200}
+        db.session.expire_all()
+        assert Comment.query.count() == self.THREADS * self.WRITES
+        assert Clip.query.get(1).commentCount == self.THREADS * self.WRITES
+        assert db.session.query(followers).count() == self.THREADS
+        assert all(user.followerCount == 1 for user in User.query.all())
+
+class RetryOnLock(BaseTestCase):
+    def lockedError(self):
+        return OperationalError("INSERT", {}, sqlite3.OperationalError("database is locked"))
+
+    def testRetriesUntilTheLockIsFree(self):
+        attempts = []
+
+        @retryOnLock
+        def view():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise self.lockedError()
+            return "done"
+
+        with app.test_request_context():
+            assert view() == "done"
+        assert len(attempts) == 3
+
+    def testGivesUpWithServiceUnavailable(self):
+        attempts = []
+
+        @retryOnLock
+        def view():
+            attempts.append(1)
+            raise self.lockedError()
+
+        with app.test_request_context():
+            body, code, headers = view()
+        assert code == 503
+        assert "Retry-After" in headers
+        assert len(attempts) == app.config["DATABASE_LOCK_RETRIES"] + 1
+
+    def testOtherErrorsAreNotRetried(self):
+        attempts = []
+
+        @retryOnLock
+        def view():
+            attempts.append(1)
+            raise OperationalError("SELECT", {}, sqlite3.OperationalError("no such table: clip"))
+
+        with app.test_request_context():
+            self.assertRaises(OperationalError, view)
+        assert len(attempts) == 1
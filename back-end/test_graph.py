@@ -0,0 +1,84 @@
+from graph import Adjacency, FollowGraph, FollowGraphIndex
+from unittest import mock
+import graph
+
+def buildGraph(edges, size=10):
+    return FollowGraph.build(sorted(edges), sorted((followed, follower) for follower, followed in edges), size)
+
+class TestAdjacency:
+    def testRowsAreSlicesOfOneArray(self):
+        adjacency = Adjacency.fromSortedPairs([(1, 2), (1, 5), (3, 1)], 5)
+
+        assert list(adjacency.offsets) == [0, 0, 2, 2, 3, 3]
+        assert list(adjacency.neighbours(1)) == [2, 5]
+        assert list(adjacency.neighbours(2)) == []
+        assert list(adjacency.neighbours(99)) == []
+        assert adjacency.contains(1, 5) and not adjacency.contains(1, 3)
+        assert adjacency.memoryUsage() == 6 * 8 + 3 * 4
+
+class TestFollowGraph:
+    def testFollowsOnTopOfTheArrays(self):
+        follows = buildGraph([(1, 2), (1, 3), (2, 1)])
+
+        follows.follow(1, 4)
+        follows.unfollow(1, 2)
+        follows.follow(12, 1)
+
+        assert follows.isFollowing(1, 4) and not follows.isFollowing(1, 2)
+        assert list(follows.followedBy(1)) == [3, 4]
+        assert list(follows.followersOf(1)) == [2, 12]
+        assert follows.followerCount(2) == 0
+        assert follows.edgeCount() == 4
+
+        follows.follow(1, 2)
+        follows.unfollow(1, 4)
+        assert list(follows.followedBy(1)) == [2, 3]
+        assert follows.edgeCount() == 4
+
+    def testMutuals(self):
+        follows = buildGraph([(1, 2), (2, 1), (1, 3), (4, 1), (1, 5), (5, 1)])
+
+        assert follows.mutuals(1) == [2, 5]
+
+    def testSuggestionsCountSecondHops(self):
+        follows = buildGraph([(1, 2), (1, 3), (2, 4), (3, 4), (2, 5), (3, 1), (6, 5), (7, 5), (2, 3)])
+
+        # 4 and 5 are followed by the same number of people 1 follows, but 5 has more followers
+        assert follows.suggestions(1, 2) == [(4, 2), (5, 1)]
+        assert follows.suggestions(1, 1) == [(4, 2)]
+        assert follows.suggestions(8, 5) == []
+
+    def testSuggestionWorkIsCapped(self):
+        follows = buildGraph([(1, 2), (1, 3), (2, 4), (2, 5), (3, 6)])
+
+        with mock.patch.object(graph, "MAX_SUGGESTION_WORK", 2):
+            assert sorted(follows.suggestions(1, 5)) == [(4, 1), (5, 1)]
+
+class TestFollowGraphIndex:
+    def testChangesDuringARebuildAreReplayed(self):
+        loads = [buildGraph([(1, 2)]), buildGraph([(1, 2), (3, 1)])]
+        index = FollowGraphIndex(lambda: loads.pop(0), refresh=0)
+        index.follow(5, 1)
+        assert list(index.get().followedBy(5)) == []
+
+        with mock.patch("threading.Thread"):
+            index.get()
+        index.follow(1, 4)
+        index.rebuild()
+
+        assert index.rebuilding is None
+        assert list(index.graph.followersOf(1)) == [3]
+        assert list(index.graph.followedBy(1)) == [2, 4]
+
+    def testFailedRebuildKeepsTheGraph(self):
+        current = buildGraph([(1, 2)])
+        index = FollowGraphIndex(lambda: current, refresh=0)
+        index.get()
+        index.load = mock.Mock(side_effect=RuntimeError("database is locked"))
+
+        with mock.patch("threading.Thread"):
+            index.get()
+        index.rebuild()
+
+        assert index.graph is current
+        assert index.rebuilding is None
@@ -0,0 +1,95 @@
+from test_application import BaseTestCase
+from application import app, db, metrics, User, Clip
+from instrumentation import SamplingProfiler, normalizeStatement
+import os, threading, time, uuid
+
+class InstrumentationTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        app.config["INSTRUMENTATION"] = True
+        db.session.add(User(id=1, username="bob", password="pass123"))
+        db.session.commit()
+
+    def tearDown(self):
+        app.config["INSTRUMENTATION"] = False
+        super().tearDown()
+
+class RequestInstrumentation(InstrumentationTestCase):
+    def testServerTimingCountsStatements(self):
+        response = self.client.get("/user/1")
+
+        entries = response.headers["Server-Timing"].split(", ")
+        assert entries[0].startswith("db;dur=") and entries[0].endswith('desc="1 statements"')
+        assert entries[-1].startswith("total;dur=")
+
+    def testNoHeaderWhenOff(self):
+        app.config["INSTRUMENTATION"] = False
+
+        assert "Server-Timing" not in self.client.get("/user/1").headers
+        assert self.client.get("/metrics").status_code == 404
+
+    def testMetricsHaveRouteHistograms(self):
+        self.client.get("/user/1")
+
+        response = self.client.get("/metrics")
+
+        assert response.status_code == 200
+        assert response.content_type.startswith("text/plain")
+        assert 'hypeclips_request_duration_seconds_bucket{method="GET",route="/user/<userid>",le="+Inf"}' in response.get_data(as_text=True)
+
+    def testClipBytesAreCounted(self):
+        clipUuid = str(uuid.uuid4())
+        db.session.add(Clip(id=1, authorId=1, clipUuid=clipUuid, title="clip", description=""))
+        db.session.commit()
+        Clip.getClipsDirectory()
+        with open(Clip.getClipPath(clipUuid), "wb") as file:
+            file.write(b"0123456789")
+
+        try:
+            before = metrics.bytesSent["getClipById"]
+            self.client.get("/clips/1").close()
+            self.client.get("/clips/1", headers={"Range": "bytes=0-3"}).close()
+        finally:
+            os.remove(Clip.getClipPath(clipUuid))
+
+        assert metrics.bytesSent["getClipById"] - before == 14
+
+    def testSlowQueriesAreLoggedWithoutValues(self):
+        app.config["SLOW_QUERY_MS"] = 0
+        try:
+            with self.assertLogs(app.logger, "WARNING") as logs:
+                self.client.post("/login", json=dict(username="bob", password="pass123"))
+        finally:
+            app.config["SLOW_QUERY_MS"] = 100
+
+        assert any("Slow query" in line for line in logs.output)
+        assert not any("bob" in line or "pass123" in line for line in logs.output)
+
+class TestNormalizeStatement:
+    def testValuesAreReplaced(self):
+        assert normalizeStatement("SELECT * FROM user WHERE id = 5 AND username = 'bob'") == \
+            "SELECT * FROM user WHERE id = ? AND username = ?"
+
+    def testListsOfAnyLengthMatch(self):
+        assert normalizeStatement("SELECT id FROM clip WHERE id IN (?, ?, ?)") == \
+            normalizeStatement("SELECT id FROM clip\n  WHERE id IN (?)")
+
+    def testIdentifiersWithDigitsAreKept(self):
+        assert normalizeStatement("SELECT user1.id FROM user AS user1") == "SELECT user1.id FROM user AS user1"
+
+class TestSamplingProfiler:
+    def busyFunction(self):
+        end = time.perf_counter() + 0.05
+        while time.perf_counter() < end:
+            pass
+
+    def testSamplesTheProfiledThread(self):
+        profiler = SamplingProfiler(threading.get_ident(), 0.001)
+        profiler.start()
+        self.busyFunction()
+        profiler.stop()
+
+        folded = profiler.folded()
+        assert "test_instrumentation.py:busyFunction" in folded
+        stack, count = folded.splitlines()[0].rsplit(" ", 1)
+        assert int(count) > 0
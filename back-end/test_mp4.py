@@ -0,0 +1,142 @@
+from mp4 import InvalidMp4, Mp4Parser, SEEK_ENTRY, keyframeIndex, parseEsdsCodec, parseFile, seekEntry
+from mp4_fixtures import box, buildMp4
+from unittest import mock
+import random, struct, pytest
+
+def feedInPieces(data, size):
+    parser = Mp4Parser()
+    for start in range(0, len(data), size):
+        parser.feed(data[start:start + size])
+    return parser.finish()
+
+class TestMp4Parser:
+    def testReadsTheMovie(self):
+        info = feedInPieces(buildMp4(width=1280, height=720, frames=300, keyframeInterval=60), 4096)
+
+        assert (info["width"], info["height"]) == (1280, 720)
+        assert info["duration"] == pytest.approx(10.01)
+        assert info["codec"] == "avc1.64001f"
+        assert info["brand"] == "isom"
+        assert info["moovOffset"] < info["mdatOffset"]
+        assert len(info["seekIndex"]) == 5 * SEEK_ENTRY.size
+
+    def testPieceBoundariesDoNotMatter(self):
+        data = buildMp4(frames=10, frameSize=4, keyframeInterval=3)
+
+        assert feedInPieces(data, 1) == feedInPieces(data, 7) == feedInPieces(data, len(data))
+
+    def testMoovAfterTheMediaData(self, tmp_path):
+        data = buildMp4(frames=90, faststart=False)
+        path = tmp_path / "clip.mp4"
+        path.write_bytes(data)
+
+        info = parseFile(str(path))
+
+        assert info == feedInPieces(data, 65536)
+        assert info["mdatOffset"] < info["moovOffset"]
+
+    def testOtherFormatsAreRejectedAtTheFirstHeader(self):
+        parser = Mp4Parser()
+        parser.feed(b"this is")
+        with pytest.raises(InvalidMp4):
+            parser.feed(b" a test")
+
+        with pytest.raises(InvalidMp4):
+            Mp4Parser().feed(b"\x1aE\xdf\xa3\x9fB\x86\x81\x01")
+
+    def testTruncatedUploadIsRejected(self):
+        data = buildMp4(frames=10, frameSize=4)
+
+        with pytest.raises(InvalidMp4):
+            feedInPieces(data[:-3], 1000)
+        with pytest.raises(InvalidMp4):
+            feedInPieces(box(b"ftyp", b"isom\x00\x00\x00\x00"), 1000)
+
+    def testOversizedMoovIsRejectedBeforeItIsRead(self):
+        parser = Mp4Parser(maxMoovSize=100)
+
+        with pytest.raises(InvalidMp4):
+            parser.feed(buildMp4(frames=10, frameSize=4))
+
+    def testMoovToTheEndOfTheFileIsCheckedBeforeItIsRead(self, tmp_path):
+        data = buildMp4(frames=10, frameSize=4, faststart=False)
+        moovStart = data.index(b"moov") - 4
+        path = tmp_path / "clip.mp4"
+        path.write_bytes(data[:moovStart] + b"\x00\x00\x00\x00" + data[moovStart + 4:])
+        moovSize = len(data) - moovStart - 8
+
+        assert parseFile(str(path), maxMoovSize=moovSize)["seekIndex"] == parseFile(str(path))["seekIndex"]
+        with pytest.raises(InvalidMp4, match="too large"):
+            parseFile(str(path), maxMoovSize=moovSize - 1)
+
+    def testSampleCountBeyondTheFileIsRejected(self):
+        data = bytearray(buildMp4(frames=10, frameSize=4))
+        sampleTable = data.index(b"stsz") + 8
+        data[sampleTable:sampleTable + 8] = struct.pack(">II", 4, 400000000)
+
+        with pytest.raises(InvalidMp4):
+            feedInPieces(bytes(data), 4096)
+
+    def testTableLongerThanItsBoxIsRejected(self):
+        data = bytearray(buildMp4(frames=10, frameSize=4))
+        chunkTable = data.index(b"stco") + 8
+        data[chunkTable:chunkTable + 4] = struct.pack(">I", 1000)
+
+        with pytest.raises(InvalidMp4):
+            feedInPieces(bytes(data), 4096)
+
+    def testDamagedMoovOnlyRaisesInvalidMp4(self):
+        data = buildMp4(frames=30, frameSize=4, keyframeInterval=5, samplesPerChunk=4)
+        moovStart = data.index(b"moov") - 4
+        moovEnd = moovStart + struct.unpack_from(">I", data, moovStart)[0]
+        rng = random.Random(0)
+        for _ in range(2000):
+            damaged = bytearray(data)
+            for _ in range(rng.randint(1, 4)):
+                damaged[rng.randrange(moovStart + 8, moovEnd)] = rng.randrange(256)
+            try:
+                feedInPieces(bytes(damaged), 4096)
+            except InvalidMp4:
+                pass
+
+class TestSeekIndex:
+    def testKeyframeAtOrBeforeTheTime(self):
+        data = buildMp4(frames=90, frameSize=100, keyframeInterval=30, samplesPerChunk=7)
+        index = feedInPieces(data, 65536)["seekIndex"]
+        mediaStart = data.index(b"mdat") + 12
+
+        assert seekEntry(index, 0) == (0.0, mediaStart)
+        assert seekEntry(index, 1.5) == (1.001, mediaStart + 30 * 100)
+        assert seekEntry(index, 60) == (2.002, mediaStart + 60 * 100)
+        assert seekEntry(b"", 1) is None
+
+    def testEverySampleIsAKeyframeWithoutSyncTable(self):
+        track = {"timescale": 10, "stts": [100, 1], "stsc": [1, 10, 1], "stco": list(range(0, 10000, 1000)),
+                 "sampleSize": 100, "sampleCount": 100}
+
+        entries = list(SEEK_ENTRY.iter_unpack(keyframeIndex(track, 10000)))
+
+        assert entries[:3] == [(0, 0), (1000, 1000), (2000, 2000)]
+        assert len(entries) == 10
+
+    def testSpacedKeyframesSkipOverSamples(self):
+        # A billion one byte samples of a microsecond each, with no sync sample table
+        track = {"timescale": 1000000, "stts": [10 ** 9, 1], "stsc": [1, 10 ** 9, 1], "stco": [0],
+                 "sampleSize": 1, "sampleCount": 10 ** 9}
+
+        entries = list(SEEK_ENTRY.iter_unpack(keyframeIndex(track, 10 ** 9)))
+
+        assert len(entries) == 1000
+        assert entries[1] == (1000, 10 ** 6)
+
+    def testSpacedKeyframesAreCapped(self):
+        track = {"timescale": 1, "stts": [10 ** 9, 1], "stsc": [1, 10 ** 9, 1], "stco": [0],
+                 "sampleSize": 1, "sampleCount": 10 ** 9}
+
+        with mock.patch("mp4.MAX_SPACED_KEYFRAMES", 50):
+            assert len(keyframeIndex(track, 10 ** 9)) == 50 * SEEK_ENTRY.size
+
+    def testAudioCodecFromDescriptors(self):
+        descriptors = bytes([0, 0, 0, 0, 3, 25, 0, 1, 0, 4, 17, 0x40, 0x15] + [0] * 11 + [5, 2, 0x12, 0x10])
+
+        assert parseEsdsCodec(descriptors, 0, len(descriptors)) == "mp4a.40.2"
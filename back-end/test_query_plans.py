@@ -0,0 +1,316 @@
+from sqlalchemy import event, inspect
+from test_application import BaseTestCase, TEST_CLIP
+from application import db, responseCache, storage, collectGarbage, encodeCursor, writeViewCounts, loadFollowGraph, encodeSearchCursor, migrateDatabase, rebuildTimelines, recountCounters, followers, User, Clip, Comment
+from graph import FollowGraphIndex
+from datetime import datetime
+from unittest import mock
+import os, io, uuid
+
+class QueryPlanTestCase(BaseTestCase):
+    """
+    Runs a route, records every statement it sends to SQLite, and checks the EXPLAIN QUERY PLAN of each one.
+    A plan fails if it scans a whole table or has to build a temporary B-tree to sort or group rows.
+    """
+    def setUp(self):
+        super().setUp()
+        db.session.add(User(id=1, username="bob", password="pass123"))
+        db.session.add(User(id=2, username="tempuser", password="asdf"))
+        db.session.commit()
+        db.session.execute(followers.insert().values(followerId=1, followedId=2))
+        db.session.add(Clip(id=5, authorId=2, clipUuid=str(uuid.uuid4()), title="CSGO ACE", description="", dateOfCreation=datetime.min))
+        db.session.add(Comment(comment="Nice", authorId=1, clipId=5))
+        db.session.commit()
+        rebuildTimelines()
+
+    def recordStatements(self, run):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            run()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+
+        return [(statement, parameters) for statement, parameters in statements
+                if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE"))
+                or (statement.lstrip().upper().startswith("INSERT") and "SELECT" in statement.upper())]
+
+    def queryPlan(self, statement, parameters):
+        with db.engine.connect() as connection:
+            return [row[3] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+
+    def badSteps(self, plan):
+        bad = []
+        for step in plan:
+            if step.startswith("SCAN ") and "INDEX" not in step:
+                bad.append(step)
+            if "TEMP B-TREE" in step:
+                bad.append(step)
+        return bad
+
+    def sendRequest(self, sendRequest):
+        response = sendRequest()
+        assert response.status_code == 200
+
+    def assertIndexedPlans(self, sendRequest):
+        self.assertIndexedStatements(lambda: self.sendRequest(sendRequest))
+
+    def assertIndexedStatements(self, run):
+        statements = self.recordStatements(run)
+        assert len(statements) > 0
+        for statement, parameters in statements:
+            plan = self.queryPlan(statement, parameters)
+            assert self.badSteps(plan) == [], f"{statement}\n{plan}"
+
+class RouteQueryPlans(QueryPlanTestCase):
+    def testLogin(self):
+        self.assertIndexedPlans(lambda: self.client.post("/login", json=dict(username="bob", password="pass123")))
+
+    def testGetClipIds(self):
+        self.assertIndexedPlans(lambda: self.client.get("/clips"))
+
+    def testGetClipPage(self):
+        self.assertIndexedPlans(lambda: self.client.get("/clips?limit=1"))
+        cursor = encodeCursor(datetime(2021, 1, 1), 1)
+        self.assertIndexedPlans(lambda: self.client.get(f"/clips?limit=1&cursor={cursor}"))
+
+    def testGetClipIdsForAuthor(self):
+        self.assertIndexedPlans(lambda: self.client.get("/2/clips"))
+        self.assertIndexedPlans(lambda: self.client.get("/2/clips?limit=1"))
+
+    def testGetClipInformation(self):
+        self.assertIndexedPlans(lambda: self.client.get("/clips/info/5"))
+
+    def testGetClipInformationBatch(self):
+        self.assertIndexedPlans(lambda: self.client.get("/clips/info?ids=5,6"))
+
+    def testGetComments(self):
+        self.assertIndexedPlans(lambda: self.client.get("/comments/5"))
+
+    def testGetCommentPage(self):
+        self.assertIndexedPlans(lambda: self.client.get("/comments/5?limit=1"))
+        cursor = encodeCursor(datetime(2021, 1, 1), 1)
+        self.assertIndexedPlans(lambda: self.client.get(f"/comments/5?limit=1&cursor={cursor}"))
+        self.assertIndexedPlans(lambda: self.client.get(f"/comments/5?since={cursor}"))
+
+    def testAddComment(self):
+        self.assertIndexedPlans(lambda: self.client.put("/comments/5", json=dict(authorId=2, comment="nice ace")))
+
+    def testGetUser(self):
+        self.assertIndexedPlans(lambda: self.client.get("/user/2"))
+
+    def testIsFollowing(self):
+        self.assertIndexedPlans(lambda: self.client.get("/follow/1/2"))
+        self.assertIndexedPlans(lambda: self.client.get("/follow/2/1"))
+
+    def testIsFollowingBatch(self):
+        self.assertIndexedPlans(lambda: self.client.get("/follow/1?ids=2,3"))
+
+    def testFollow(self):
+        self.assertIndexedPlans(lambda: self.client.put("/follow/2/1"))
+
+    def testUnfollow(self):
+        self.assertIndexedPlans(lambda: self.client.delete("/follow/1/2"))
+
+    def testDeleteClip(self):
+        open(Clip.getClipPath(Clip.query.get(5).clipUuid), "w").close()
+
+        self.assertIndexedPlans(lambda: self.client.delete("/clips/5"))
+        collectGarbage()
+
+    def testCollectGarbage(self):
+        self.client.delete("/clips/5")
+
+        self.assertIndexedStatements(collectGarbage)
+
+    def testClipViews(self):
+        self.assertIndexedPlans(lambda: self.client.get("/clips/5/views?by=hour"))
+        self.assertIndexedPlans(lambda: self.client.get("/clips/5/views?by=day"))
+
+    def testWriteViewCounts(self):
+        hour = datetime(2021, 1, 1, 12)
+
+        self.assertIndexedStatements(lambda: writeViewCounts({(5, hour): [1, 2], (6, hour): [1, 1]}))
+        assert (Clip.query.get(5).viewCount, Clip.query.get(5).playCount) == (1, 2)
+
+    def testLoadFollowGraph(self):
+        self.assertIndexedStatements(loadFollowGraph)
+
+    def testFollowGraphRoutes(self):
+        with mock.patch("application.followGraph", FollowGraphIndex(loadFollowGraph, 300)):
+            for route in ["following", "followers", "mutuals", "suggestions"]:
+                self.assertIndexedPlans(lambda: self.client.get(f"/user/1/{route}"))
+
+    def testFollowersLookup(self):
+        user = User.query.get(2)
+
+        self.assertIndexedStatements(lambda: user.followers.all())
+
+    def testGetFollowFeed(self):
+        self.assertIndexedPlans(lambda: self.client.get("/follow/clips/1"))
+        self.assertIndexedPlans(lambda: self.client.get("/follow/clips/1?limit=1"))
+
+    def testGetFollowFeedWithAuthorReadOnDemand(self):
+        User.query.get(2).fanOutOnRead = True
+        db.session.commit()
+
+        self.assertIndexedPlans(lambda: self.client.get("/follow/clips/1?limit=1"))
+        self.assertIndexedPlans(lambda: self.client.get(f"/follow/clips/1?limit=1&cursor={encodeCursor(datetime(2021, 1, 1), 1)}"))
+
+    def testAddClipFanOut(self):
+        self.assertIndexedPlans(lambda: self.client.put("/clips", data={"file": (io.BytesIO(TEST_CLIP), "test.mp4"), "authorId": 2, "title": "Bob sick league clip!"}))
+
+        os.remove(storage.path(Clip.query.order_by(Clip.id.desc()).first().sourceKey()))
+
+    def testSearch(self):
+        # Ranking sorts the candidate clips, which is the only sort allowed here. The index itself is always read
+        # through its full-text lookup.
+        for path in ("/search?q=ace", f"/search?q=csg&limit=1&cursor={encodeSearchCursor(-1.0, 5, 1)}"):
+            statements = self.recordStatements(lambda: self.sendRequest(lambda: self.client.get(path)))
+            for statement, parameters in statements:
+                plan = self.queryPlan(statement, parameters)
+                if "clip_search" not in statement:
+                    assert self.badSteps(plan) == [], f"{statement}\n{plan}"
+                    continue
+                assert plan[0].startswith("SCAN clip_search VIRTUAL TABLE INDEX") and ":M" in plan[0]
+                assert plan[1:] in ([], ["USE TEMP B-TREE FOR ORDER BY"]), plan
+
+class MigrateDatabase(BaseTestCase):
+    def createLegacySchema(self):
+        db.drop_all()
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql("CREATE TABLE user (id INTEGER NOT NULL, username VARCHAR(20) NOT NULL, "
+                "password VARCHAR(40) NOT NULL, PRIMARY KEY (id), UNIQUE (username))")
+            connection.exec_driver_sql('CREATE TABLE clip (id INTEGER NOT NULL, "clipUuid" VARCHAR(100) NOT NULL, '
+                '"authorId" INTEGER NOT NULL, "dateOfCreation" DATETIME NOT NULL, title VARCHAR(20) NOT NULL, '
+                'description VARCHAR(200), PRIMARY KEY (id), FOREIGN KEY("authorId") REFERENCES user (id))')
+            connection.exec_driver_sql('CREATE TABLE comment (id INTEGER NOT NULL, comment VARCHAR(200) NOT NULL, '
+                '"dateOfCreation" DATETIME NOT NULL, "authorId" INTEGER NOT NULL, "clipId" INTEGER NOT NULL, '
+                'PRIMARY KEY (id), FOREIGN KEY("authorId") REFERENCES user (id), FOREIGN KEY("clipId") REFERENCES clip (id))')
+            connection.exec_driver_sql('CREATE TABLE followers ("followerId" INTEGER, "followedId" INTEGER, '
+                'FOREIGN KEY("followerId") REFERENCES user (id), FOREIGN KEY("followedId") REFERENCES user (id))')
+            connection.exec_driver_sql("INSERT INTO user VALUES (1, 'bob', 'pass123'), (2, 'tempuser', 'asdf')")
+            connection.exec_driver_sql("INSERT INTO followers VALUES (1, 2), (1, 2), (2, 1)")
+
+    def testMigrationAddsIndexesAndCollapsesDuplicateFollows(self):
+        self.createLegacySchema()
+
+        migrateDatabase()
+
+        inspector = inspect(db.engine)
+        assert inspector.get_pk_constraint("followers")["constrained_columns"] == ["followerId", "followedId"]
+        assert {"ix_clip_dateOfCreation", "ix_clip_authorId_dateOfCreation"} <= {index["name"] for index in inspector.get_indexes("clip")}
+        assert "ix_comment_clipId_dateOfCreation" in {index["name"] for index in inspector.get_indexes("comment")}
+        assert "ix_followers_followedId_followerId" in {index["name"] for index in inspector.get_indexes("followers")}
+        with db.engine.connect() as connection:
+            assert connection.exec_driver_sql("SELECT COUNT(*) FROM followers").scalar() == 2
+        assert User.query.get(1).isFollowing(User.query.get(2))
+
+    def testMigrationIndexesExistingClipsForSearch(self):
+        self.createLegacySchema()
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql('INSERT INTO clip VALUES (5, \'abc\', 2, \'2021-01-01 00:00:00\', \'CSGO ACE\', \'\')')
+
+        migrateDatabase()
+
+        response = self.client.get("/search?q=tempuser")
+        assert [clip["id"] for clip in response.json["clips"]] == [5]
+
+    def testMigrationIsRepeatable(self):
+        self.createLegacySchema()
+
+        migrateDatabase()
+        migrateDatabase()
+
+        response = self.client.get("/follow/1/2")
+        assert response.status_code == 200
+        assert response.json["following"] == True
+
+class RouteQueryCounts(QueryPlanTestCase):
+    """The number of statements a read route sends must not grow with the number of rows it returns."""
+    def statementCount(self, path):
+        db.session.expire_all()
+        return len(self.recordStatements(lambda: self.sendRequest(lambda: self.client.get(path))))
+
+    def addUsers(self, count):
+        for id in range(3, count + 3):
+            db.session.add(User(id=id, username=f"user{id}", password="asdf"))
+
+    def testGetCommentsFromManyAuthors(self):
+        few = self.statementCount("/comments/5")
+
+        self.addUsers(20)
+        for id in range(3, 23):
+            db.session.add(Comment(comment="Nice", authorId=id, clipId=5))
+        db.session.commit()
+        responseCache.clear()
+
+        assert self.statementCount("/comments/5") == few
+
+    def testGetUserWithManyClips(self):
+        few = self.statementCount("/user/2")
+
+        for id in range(10, 30):
+            db.session.add(Clip(id=id, authorId=2, clipUuid=str(uuid.uuid4()), title="clip", description=""))
+        db.session.commit()
+        responseCache.clear()
+
+        assert self.statementCount("/user/2") == few
+        assert self.client.get("/user/2").json["numClips"] == 21
+
+    def testGetClipInformation(self):
+        assert self.statementCount("/clips/info/5") <= 2
+
+    def testBatchesTakeAFixedNumberOfStatements(self):
+        few = self.statementCount("/clips/info?ids=5")
+        fewFollows = self.statementCount("/follow/1?ids=2")
+
+        self.addUsers(20)
+        for id in range(3, 23):
+            db.session.add(Clip(id=id + 100, authorId=id, clipUuid=str(uuid.uuid4()), title="clip", description=""))
+        db.session.commit()
+        responseCache.clear()
+
+        assert self.statementCount("/clips/info?ids=5," + ",".join(str(id + 100) for id in range(3, 23))) == few
+        assert self.statementCount("/follow/1?ids=" + ",".join(str(id) for id in range(2, 23))) == fewFollows == 2
+
+    def testClipPageWithManyAuthors(self):
+        few = self.statementCount("/clips?limit=50")
+
+        self.addUsers(20)
+        for id in range(3, 23):
+            db.session.add(Clip(id=id + 100, authorId=id, clipUuid=str(uuid.uuid4()), title="clip", description=""))
+        db.session.commit()
+        responseCache.clear()
+
+        assert self.statementCount("/clips?limit=50") == few
+
+class DenormalizedCounters(QueryPlanTestCase):
+    def testCountersFollowWrites(self):
+        self.client.put("/comments/5", json=dict(authorId=2, comment="nice ace"))
+        self.client.put("/follow/2/1")
+        assert Clip.query.get(5).commentCount == 2
+        assert User.query.get(1).followerCount == 1
+
+        self.client.delete("/follow/2/1")
+        assert User.query.get(1).followerCount == 0
+
+        open(Clip.getClipPath(Clip.query.get(5).clipUuid), "w").close()
+        self.client.delete("/clips/5")
+        collectGarbage()
+        assert User.query.get(2).clipCount == 0
+
+    def testRecountRepairsDrift(self):
+        User.query.get(2).clipCount = 40
+        User.query.get(2).followerCount = 7
+        Clip.query.get(5).commentCount = 0
+        db.session.commit()
+
+        recountCounters()
+
+        assert User.query.get(2).clipCount == 1
+        assert User.query.get(2).followerCount == 1
+        assert Clip.query.get(5).commentCount == 1
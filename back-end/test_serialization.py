@@ -0,0 +1,68 @@
+from serialization import JsonRepresentation, MsgpackRepresentation, compressResponse, negotiateEncoding, negotiateRepresentation
+from werkzeug.datastructures import Accept, MIMEAccept
+from werkzeug.http import parse_accept_header
+from flask import Response
+from datetime import date, datetime
+from unittest import mock
+import gzip, json, msgpack, orjson
+import serialization
+
+RECORD = {"id": 5, "date": datetime(2021, 1, 1, 12, 30, 5, 250), "day": date(2021, 1, 1), "ids": [1, 2, 3]}
+
+class TestRepresentations:
+    def testDatesKeepTheirFormat(self):
+        assert json.loads(JsonRepresentation().dumps(RECORD)) == \
+            {"id": 5, "date": "2021-01-01 12:30:05.000250", "day": "2021-01-01", "ids": [1, 2, 3]}
+
+    def testStandardLibraryFallback(self):
+        with mock.patch.object(serialization, "orjson", None):
+            fallback = JsonRepresentation().dumps(RECORD)
+
+        assert json.loads(fallback) == json.loads(JsonRepresentation().dumps(RECORD))
+
+    def testOrjsonIsUsed(self):
+        # The tests above only cover orjson's encoding when it is installed, as requirements.txt makes sure
+        assert serialization.orjson is orjson
+
+    def testMsgpack(self):
+        assert msgpack.unpackb(MsgpackRepresentation().dumps(RECORD))["date"] == "2021-01-01 12:30:05.000250"
+
+    def testNegotiation(self):
+        representations = [JsonRepresentation(), MsgpackRepresentation()]
+
+        def negotiate(header, offered=representations):
+            return negotiateRepresentation(parse_accept_header(header, MIMEAccept), offered).name
+
+        assert negotiate("") == "json"
+        assert negotiate("*/*") == "json"
+        assert negotiate("application/msgpack") == "msgpack"
+        assert negotiate("application/x-msgpack, application/json;q=0.5") == "msgpack"
+        assert negotiate("application/msgpack", representations[:1]) == "json"
+
+class TestCompression:
+    encodings = {"br": lambda data: b"br:" + data, "gzip": gzip.compress}
+
+    def testBestAcceptedEncoding(self):
+        def negotiate(header):
+            return negotiateEncoding(parse_accept_header(header, Accept), self.encodings)
+
+        assert negotiate("gzip, deflate, br") == "br"
+        assert negotiate("gzip, br;q=0.5") == "gzip"
+        assert negotiate("*") == "br"
+        assert negotiate("deflate") is None
+        assert negotiate("") is None
+
+    def testOnlyBodiesOverTheThresholdAreCompressed(self):
+        accept = parse_accept_header("gzip", Accept)
+        body = json.dumps(list(range(1000)))
+
+        response = compressResponse(Response(body, mimetype="application/json"), accept, self.encodings, 1024)
+        small = compressResponse(Response("[1]", mimetype="application/json"), accept, self.encodings, 1024)
+        video = compressResponse(Response(body, mimetype="video/mp4"), accept, self.encodings, 1024)
+
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(response.get_data()).decode() == body
+        assert response.content_length < len(body)
+        assert response.headers["Vary"] == small.headers["Vary"] == "Accept-Encoding"
+        assert "Content-Encoding" not in small.headers
+        assert "Content-Encoding" not in video.headers and "Vary" not in video.headers
@@ -0,0 +1,61 @@
+from transfer import copyWithDigest, openDump, readBatches, writeFile, writeRow
+from datetime import date, datetime
+import sqlalchemy as sa
+import hashlib, io, pytest
+
+metadata = sa.MetaData()
+CLIPS = sa.Table("clip", metadata, sa.Column("id", sa.Integer, primary_key=True), sa.Column("made", sa.DateTime),
+    sa.Column("day", sa.Date), sa.Column("index", sa.LargeBinary), sa.Column("title", sa.String))
+USERS = sa.Table("user", metadata, sa.Column("id", sa.Integer, primary_key=True))
+
+def dump(*lines, files=()):
+    stream = io.StringIO()
+    for table, row in lines:
+        writeRow(stream, table, row)
+    for file in files:
+        writeFile(stream, *file)
+    stream.seek(0)
+    return stream
+
+class TestRows:
+    def testValuesSurviveTheirColumnTypes(self):
+        row = {"id": 1, "made": datetime(2021, 1, 1, 12, 30, 5, 250), "day": date(2021, 1, 1), "index": b"\x00\xff", "title": None}
+
+        assert list(readBatches(dump((CLIPS, row)), [CLIPS])) == [(CLIPS, [row])]
+
+    def testBatchesSplitAtTablesAndSize(self):
+        stream = dump((USERS, {"id": 1}), (USERS, {"id": 2}), (USERS, {"id": 3}),
+                      (CLIPS, {"id": 1, "made": None, "day": None, "index": None, "title": "a"}),
+                      files=[("blobs/ab/cd/abcd.mp4", 4, "00")])
+
+        batches = list(readBatches(stream, [USERS, CLIPS], size=2))
+
+        assert [(table.name, len(rows)) for table, rows in batches[:-1]] == [("user", 2), ("user", 1), ("clip", 1)]
+        assert batches[-1] == (None, {"file": "blobs/ab/cd/abcd.mp4", "size": 4, "sha256": "00"})
+
+    def testUnknownColumnsAreDroppedAndTablesRejected(self):
+        stream = io.StringIO('{"table":"user","row":{"id":1,"gone":true}}\n\n{"table":"session","row":{}}\n')
+
+        batches = readBatches(stream, [USERS])
+        with pytest.raises(ValueError, match="line 3"):
+            list(batches)
+
+        assert list(readBatches(io.StringIO('{"table":"user","row":{"id":1,"gone":true}}\n'), [USERS])) == [(USERS, [{"id": 1}])]
+
+class TestFiles:
+    def testCompressedDumps(self, tmp_path):
+        path = str(tmp_path / "export.ndjson.gz")
+        with openDump(path, "w") as stream:
+            writeRow(stream, USERS, {"id": 7})
+
+        assert open(path, "rb").read(2) == b"\x1f\x8b"
+        with openDump(path, "r") as stream:
+            assert list(readBatches(stream, [USERS])) == [(USERS, [{"id": 7}])]
+
+    def testCopyWithDigest(self, tmp_path):
+        (tmp_path / "clip.mp4").write_bytes(b"highlight")
+
+        size, digest = copyWithDigest(str(tmp_path / "clip.mp4"), str(tmp_path / "ab" / "clip.mp4"))
+
+        assert (size, digest) == (9, hashlib.sha256(b"highlight").hexdigest())
+        assert (tmp_path / "ab" / "clip.mp4").read_bytes() == b"highlight"
@@ -0,0 +1,65 @@
+from views import ViewCounter, hourOf, isPlaybackStart
+import pytest
+
+HOUR = 1609459200
+
+def makeCounter(flush=None, threshold=1000):
+    batches = []
+    counter = ViewCounter(flush or batches.append, interval=60, threshold=threshold, playWindow=30, viewWindow=3600)
+    return counter, batches
+
+class TestPlaybackStarts:
+    def testOnlyRequestsFromTheFirstByteStartAPlayback(self):
+        assert isPlaybackStart(None)
+        assert isPlaybackStart("bytes=0-")
+        assert isPlaybackStart("bytes=0-1")
+        assert isPlaybackStart("not a range")
+        assert not isPlaybackStart("bytes=65536-")
+        assert not isPlaybackStart("bytes=-500")
+
+class TestViewCounter:
+    def testContinuationsOfAPlaybackAreOnePlay(self):
+        counter, batches = makeCounter()
+
+        counter.record(5, "viewer", None, now=HOUR)
+        counter.record(5, "viewer", "bytes=1000-", now=HOUR + 1)
+        counter.record(5, "viewer", "bytes=0-", now=HOUR + 20)
+        counter.record(5, "viewer", "bytes=0-", now=HOUR + 45)
+        counter.flush()
+
+        assert batches == [{(5, hourOf(HOUR)): [1, 1]}]
+
+    def testPlaysAndViewsHaveTheirOwnWindows(self):
+        counter, batches = makeCounter()
+
+        counter.record(5, "viewer", None, now=HOUR)
+        counter.record(5, "viewer", None, now=HOUR + 100)
+        counter.record(5, "other viewer", None, now=HOUR + 100)
+        counter.record(5, "viewer", None, now=HOUR + 3700)
+        counter.flush()
+
+        assert batches == [{(5, hourOf(HOUR)): [2, 3], (5, hourOf(HOUR + 3600)): [1, 1]}]
+
+    def testFailedFlushKeepsTheCounts(self):
+        def failingFlush(counts):
+            raise RuntimeError("database is locked")
+        counter, _ = makeCounter(failingFlush)
+        counter.record(5, "viewer", None, now=HOUR)
+
+        with pytest.raises(RuntimeError):
+            counter.flush()
+        counter.record(5, "other viewer", None, now=HOUR + 1)
+
+        batches = []
+        counter.flushBatch = batches.append
+        assert counter.flush() == 1
+        assert batches == [{(5, hourOf(HOUR)): [2, 2]}]
+        assert counter.flush() == 0
+
+    def testThresholdWakesTheFlusher(self):
+        counter, _ = makeCounter(threshold=2)
+
+        counter.record(5, "viewer", None, now=HOUR)
+        assert not counter.wake.is_set()
+        counter.record(6, "viewer", None, now=HOUR)
+        assert counter.wake.is_set()
@@ -0,0 +1,38 @@
+from storage import keyPath
+import os, tempfile
+
+# The feed shows the poster in place of the video until the clip is played, and the sprite is a
+# grid of small frames spread across the clip for scrubbing previews.
+POSTER_WIDTH = 640
+SPRITE_COLUMNS = 5
+SPRITE_ROWS = 2
+SPRITE_FRAME_WIDTH = 160
+THUMBNAIL_KINDS = ["poster", "sprite"]
+
+def getThumbnailKey(clipUuid, kind):
+    # Keyed by the clipUuid, which never gets reused, so an image never needs invalidating. The two character
+    # prefix directory keeps any single directory from growing too large.
+    return f"thumbnails/{clipUuid[:2]}/{clipUuid}-{kind}.jpg"
+
+def getThumbnailPath(clipsDirectory, clipUuid, kind):
+    return keyPath(clipsDirectory, getThumbnailKey(clipUuid, kind))
+
+def makeThumbnail(encoder, sourcePath, clipsDirectory, clipUuid, kind, duration):
+    path = getThumbnailPath(clipsDirectory, clipUuid, kind)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Without a probed duration (an unprocessed clip) take the first frame and one frame a second
+    duration = duration or 0
+    # Each call writes a file of its own, since two requests for a missing thumbnail can make it at once
+    handle, temporaryPath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(handle)
+    try:
+        if kind == "poster":
+            encoder.extractPoster(sourcePath, temporaryPath, min(1.0, duration / 2), POSTER_WIDTH)
+        else:
+            interval = max(duration / (SPRITE_COLUMNS * SPRITE_ROWS), 1.0) if duration else 1.0
+            encoder.extractSprite(sourcePath, temporaryPath, interval, SPRITE_COLUMNS, SPRITE_ROWS, SPRITE_FRAME_WIDTH)
+        os.replace(temporaryPath, path)
+    finally:
+        if os.path.exists(temporaryPath):
+            os.remove(temporaryPath)
+    return path
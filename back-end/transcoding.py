@@ -0,0 +1,115 @@
+from mp4 import InvalidMp4, parseFile
+from storage import clipKey, keyPath
+from thumbnails import THUMBNAIL_KINDS, makeThumbnail
+import json, os, shutil, subprocess
+
+# Renditions made for every clip, smallest first. A rendition is skipped when the source is not taller than it.
+RENDITION_LADDER = [("360p", 360), ("720p", 720)]
+ORIGINAL_RENDITION = "original"
+
+class FfmpegEncoder:
+    def probe(self, path):
+        output = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "v:0",
+            "-show_entries", "stream=width,height:format=duration", "-of", "json", path],
+            check=True, capture_output=True).stdout
+        info = json.loads(output)
+        stream = info["streams"][0]
+        return {"duration": float(info["format"]["duration"]), "width": stream["width"], "height": stream["height"]}
+
+    def remuxFaststart(self, source, destination):
+        # Copies the streams unchanged but moves the moov atom to the front, so playback starts before the download ends
+        subprocess.run(["ffmpeg", "-v", "error", "-y", "-i", source, "-c", "copy", "-movflags", "+faststart",
+            "-f", "mp4", destination], check=True)
+
+    def transcode(self, source, destination, width, height):
+        subprocess.run(["ffmpeg", "-v", "error", "-y", "-i", source, "-vf", f"scale={width}:{height}",
+            "-c:v", "libx264", "-preset", "veryfast", "-crf", "23", "-c:a", "aac", "-b:a", "128k",
+            "-movflags", "+faststart", "-f", "mp4", destination], check=True)
+
+    def extractPoster(self, source, destination, seconds, width):
+        subprocess.run(["ffmpeg", "-v", "error", "-y", "-ss", str(seconds), "-i", source, "-frames:v", "1",
+            "-vf", f"scale={width}:-2", "-f", "image2", destination], check=True)
+
+    def extractSprite(self, source, destination, interval, columns, rows, width):
+        subprocess.run(["ffmpeg", "-v", "error", "-y", "-i", source, "-frames:v", "1",
+            "-vf", f"fps=1/{interval},scale={width}:-2,tile={columns}x{rows}", "-f", "image2", destination], check=True)
+
+class StubEncoder:
+    """Stands in for ffmpeg in tests: reports a fixed resolution and copies bytes instead of encoding them."""
+    def __init__(self, width=1280, height=720, duration=10.0):
+        self.width = width
+        self.height = height
+        self.duration = duration
+
+    def probe(self, path):
+        return {"duration": self.duration, "width": self.width, "height": self.height}
+
+    def remuxFaststart(self, source, destination):
+        shutil.copyfile(source, destination)
+
+    def transcode(self, source, destination, width, height):
+        shutil.copyfile(source, destination)
+
+    def extractPoster(self, source, destination, seconds, width):
+        with open(source, "rb"), open(destination, "wb") as image:
+            image.write(b"stub poster")
+
+    def extractSprite(self, source, destination, interval, columns, rows, width):
+        with open(source, "rb"), open(destination, "wb") as image:
+            image.write(b"stub sprite")
+
+ENCODERS = {"ffmpeg": FfmpegEncoder, "stub": StubEncoder}
+
+def getRenditionPath(clipsDirectory, clipUuid, name):
+    return keyPath(clipsDirectory, clipKey(clipUuid, name))
+
+def scaledWidth(width, height, targetHeight):
+    # H.264 needs even dimensions
+    return max(2, round(width * targetHeight / height / 2) * 2)
+
+def encodeInto(clipsDirectory, clipUuid, name, encode):
+    # Encodes to a temporary name first so a half-written rendition is never served
+    path = getRenditionPath(clipsDirectory, clipUuid, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporaryPath = f"{path}.tmp"
+    try:
+        encode(temporaryPath)
+        os.replace(temporaryPath, path)
+    finally:
+        if os.path.exists(temporaryPath):
+            os.remove(temporaryPath)
+    return os.path.getsize(path)
+
+def renditionSeekIndex(clipsDirectory, clipUuid, name):
+    # Remuxing and encoding move the keyframes, so each rendition gets an index of its own
+    try:
+        return parseFile(getRenditionPath(clipsDirectory, clipUuid, name))["seekIndex"] or None
+    except InvalidMp4:
+        return None
+
+def processClip(encoder, sourcePath, clipsDirectory, clipUuid):
+    """
+    Probes an uploaded clip and writes its renditions next to it. Runs in a worker process, so it only
+    touches files and returns plain data for the caller to record in the database.
+    """
+    info = encoder.probe(sourcePath)
+    renditions = []
+
+    size = encodeInto(clipsDirectory, clipUuid, ORIGINAL_RENDITION,
+        lambda destination: encoder.remuxFaststart(sourcePath, destination))
+    renditions.append({"name": ORIGINAL_RENDITION, "width": info["width"], "height": info["height"], "size": size,
+                       "seekIndex": renditionSeekIndex(clipsDirectory, clipUuid, ORIGINAL_RENDITION)})
+
+    for name, height in RENDITION_LADDER:
+        if height >= info["height"]:
+            continue
+        width = scaledWidth(info["width"], info["height"], height)
+        size = encodeInto(clipsDirectory, clipUuid, name,
+            lambda destination: encoder.transcode(sourcePath, destination, width, height))
+        renditions.append({"name": name, "width": width, "height": height, "size": size,
+                           "seekIndex": renditionSeekIndex(clipsDirectory, clipUuid, name)})
+
+    for kind in THUMBNAIL_KINDS:
+        makeThumbnail(encoder, sourcePath, clipsDirectory, clipUuid, kind, info["duration"])
+
+    return {"probe": info, "renditions": renditions}
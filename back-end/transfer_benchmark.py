@@ -0,0 +1,66 @@
+"""
+Measures flask data import and export on a SQLite file: writes a synthetic export with the given number of
+users, clips and comments, imports it into an empty database and exports it again, printing rows per second for
+each. Run it from the back-end folder:
+
+    python transfer_benchmark.py --comments 10000000 --gzip
+"""
+from application import app, db, importData, exportData, User, Clip, Comment
+from transfer import openDump, writeRow
+from datetime import datetime, timedelta
+import os, random, shutil, tempfile, time, uuid, click
+
+def writeExport(path, rng, users, clips, comments):
+    start = datetime(2021, 1, 1)
+    with openDump(path, "w") as stream:
+        for id in range(1, users + 1):
+            writeRow(stream, User.__table__, {"id": id, "username": f"user{id}", "password": "pass123",
+                "fanOutOnRead": False, "clipCount": 0, "followerCount": 0, "timelineLength": 0})
+        for id in range(1, clips + 1):
+            writeRow(stream, Clip.__table__, {column.name: None for column in Clip.__table__.columns} | {
+                "id": id, "clipUuid": str(uuid.UUID(int=rng.getrandbits(128), version=4)), "authorId": rng.randint(1, users),
+                "dateOfCreation": start + timedelta(seconds=id), "title": f"clip {id}", "description": "",
+                "processingStatus": "ready", "commentCount": 0, "viewCount": 0, "playCount": 0})
+        for id in range(1, comments + 1):
+            writeRow(stream, Comment.__table__, {"id": id, "comment": "Nice clip", "authorId": rng.randint(1, users),
+                "clipId": rng.randint(1, clips), "dateOfCreation": start + timedelta(seconds=id)})
+
+@click.command()
+@click.option("--users", default=10000)
+@click.option("--clips", default=100000)
+@click.option("--comments", default=1000000)
+@click.option("--gzip", is_flag=True, help="Compress the export.")
+@click.option("--seed", default=0)
+def transferBenchmark(users, clips, comments, gzip, seed):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "export.ndjson" + (".gz" if gzip else ""))
+    rows = users + clips + comments
+    try:
+        start = time.perf_counter()
+        writeExport(path, random.Random(seed), users, clips, comments)
+        print(f"{rows} rows written in {time.perf_counter() - start:.1f} s, {os.path.getsize(path) / 2 ** 20:.0f} MB")
+
+        with app.app_context():
+            app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{os.path.join(directory, 'import.db')}"
+            db.create_all()
+            try:
+                start = time.perf_counter()
+                with openDump(path, "r") as stream:
+                    importData(stream)
+                seconds = time.perf_counter() - start
+                print(f"import: {seconds:.1f} s, {rows / seconds:.0f} rows/s, "
+                      f"{10 ** 7 / (rows / seconds) / 60:.1f} min per 10M rows at this rate")
+
+                start = time.perf_counter()
+                with openDump(path, "w") as stream:
+                    exportData(stream)
+                seconds = time.perf_counter() - start
+                print(f"export: {seconds:.1f} s, {rows / seconds:.0f} rows/s")
+            finally:
+                db.session.remove()
+                db.engine.dispose()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    transferBenchmark()
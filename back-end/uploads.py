@@ -0,0 +1,98 @@
+import asyncio, hashlib, os
+
+READ_SIZE = 64 * 1024
+
+class ChunkTooLarge(Exception):
+    pass
+
+def appendChunk(stream, path, offset, maxLength, parser=None):
+    """
+    Streams a request body onto the end of a partial upload without holding more than READ_SIZE bytes in memory.
+    Returns the number of bytes written and their SHA-256. If the body turns out to be longer than maxLength the
+    file is cut back to offset and ChunkTooLarge is raised. The bytes are also fed to parser, if given, and the
+    file is cut back the same way if it raises.
+    """
+    digest = hashlib.sha256()
+    written = 0
+    with open(path, "r+b" if os.path.exists(path) else "wb") as file:
+        file.seek(offset)
+        file.truncate()
+        while True:
+            data = stream.read(READ_SIZE)
+            if not data:
+                break
+            written += len(data)
+            if written > maxLength:
+                file.truncate(offset)
+                raise ChunkTooLarge()
+            if parser is not None:
+                try:
+                    parser.feed(data)
+                except Exception:
+                    file.truncate(offset)
+                    raise
+            digest.update(data)
+            file.write(data)
+    return written, digest.hexdigest()
+
+def saveUpload(stream, path, parser=None):
+    """
+    Streams a whole upload to path, hashing it on the way and feeding it to parser, if given, which stops the
+    upload where it raises. Returns its size and SHA-256.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "wb") as file:
+        while True:
+            data = stream.read(READ_SIZE)
+            if not data:
+                break
+            size += len(data)
+            if parser is not None:
+                parser.feed(data)
+            digest.update(data)
+            file.write(data)
+    return size, digest.hexdigest()
+
+def fileDigest(path):
+    # The SHA-256 of a file already on disk, for resumable uploads whose chunks arrived over many requests
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while True:
+            data = file.read(READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+def truncateUpload(path, offset):
+    with open(path, "r+b") as file:
+        file.truncate(offset)
+
+async def appendChunkAsync(chunks, path, offset, maxLength, parser=None):
+    """
+    appendChunk for the ASGI server: the body arrives as an async iterator of bytes, and every file operation
+    runs in a worker thread so the event loop never waits on the disk.
+    """
+    digest = hashlib.sha256()
+    written = 0
+    file = await asyncio.to_thread(open, path, "r+b" if os.path.exists(path) else "wb")
+    try:
+        await asyncio.to_thread(file.seek, offset)
+        await asyncio.to_thread(file.truncate)
+        async for data in chunks:
+            written += len(data)
+            if written > maxLength:
+                await asyncio.to_thread(file.truncate, offset)
+                raise ChunkTooLarge()
+            if parser is not None:
+                try:
+                    await asyncio.to_thread(parser.feed, data)
+                except Exception:
+                    await asyncio.to_thread(file.truncate, offset)
+                    raise
+            digest.update(data)
+            await asyncio.to_thread(file.write, data)
+    finally:
+        await asyncio.to_thread(file.close)
+    return written, digest.hexdigest()
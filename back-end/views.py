@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from datetime import datetime
+from werkzeug.http import parse_range_header
+import atexit, os, threading, time
+
+# Most (clip, viewer) pairs remembered to tell a new playback from the rest of one. The oldest are forgotten first.
+MAX_RECENT_VIEWERS = 100000
+
+def isPlaybackStart(rangeHeader):
+    # Players fetch a clip as many Range requests. Only a request from the first byte, or for all of it, starts one.
+    if not rangeHeader:
+        return True
+    ranges = parse_range_header(rangeHeader)
+    return ranges is None or ranges.ranges[0][0] == 0
+
+def hourOf(timestamp):
+    return datetime.utcfromtimestamp(timestamp - timestamp % 3600)
+
+class ViewCounter:
+    """
+    Counts clip plays and views in memory and hands them to flush in batches, summed per clip and hour, so a
+    playback costs no database write. A play is a playback start, merged with any other start by the same viewer
+    within playWindow seconds (players often fetch the first bytes twice). A view is a play by a viewer not
+    counted for that clip within viewWindow seconds. Batches go out every interval seconds, or sooner once
+    threshold clip hours are waiting, so a crash loses at most one interval of counts.
+    """
+    def __init__(self, flush, interval, threshold, playWindow, viewWindow):
+        self.flushBatch = flush
+        self.interval = interval
+        self.threshold = threshold
+        self.playWindow = playWindow
+        self.viewWindow = viewWindow
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.recent = OrderedDict()
+        self.wake = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def record(self, clipId, viewer, rangeHeader, now=None):
+        if not isPlaybackStart(rangeHeader):
+            return
+        now = time.time() if now is None else now
+        key = (clipId, viewer)
+        with self.lock:
+            lastStart, lastView = self.recent.pop(key, (None, None))
+            played = lastStart is None or now - lastStart >= self.playWindow
+            viewed = played and (lastView is None or now - lastView >= self.viewWindow)
+            # The window slides, so a long playback that keeps going back to the start stays one play
+            self.recent[key] = (now, now if viewed else lastView)
+            if len(self.recent) > MAX_RECENT_VIEWERS:
+                self.recent.popitem(last=False)
+            if not played:
+                return
+            counts = self.pending.setdefault((clipId, hourOf(now)), [0, 0])
+            counts[0] += viewed
+            counts[1] += played
+            full = len(self.pending) >= self.threshold
+        if full:
+            self.wake.set()
+
+    def flush(self):
+        """Hands the waiting counts to flush. If it raises they are put back for the next attempt."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        try:
+            self.flushBatch(pending)
+        except Exception:
+            with self.lock:
+                for key, (views, plays) in pending.items():
+                    counts = self.pending.setdefault(key, [0, 0])
+                    counts[0] += views
+                    counts[1] += plays
+            raise
+        return len(pending)
+
+    def start(self):
+        # Called with every count, since the thread does not survive the fork into a worker process
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name="view-counter", daemon=True)
+            self.thread.start()
+        atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                # The flush function logs its errors, and the counts wait for the next interval
+                pass
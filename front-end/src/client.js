@@ -1,4 +1,6 @@
 import axios from "axios"
+import { get as readStore } from "svelte/store"
+import { token } from "./store"
 
 const serverUrl = "http://localhost:5000/"
 
@@ -6,9 +8,10 @@ const instance = axios.create({
   baseURL: serverUrl
 })
 
-const request = async (method, url, data) => {
+const request = async (method, url, data, extraHeaders = {}) => {
   const headers = {
-    authorization: ""
+    authorization: readStore(token) ? `Bearer ${readStore(token)}` : "",
+    ...extraHeaders
   }
 
   const res = await instance({
@@ -25,9 +28,9 @@ const get = async (url, data = {}) => request("get", url, data)
 
 const del = async (url, data = {}) => request("delete", url, data)
 
-const post = async (url, data = {}) => request("post", url, data)
+const post = async (url, data = {}, headers = {}) => request("post", url, data, headers)
 
-const put = async (url, data = {}) => request("put", url, data)
+const put = async (url, data = {}, headers = {}) => request("put", url, data, headers)
 
 const patch = async (url, data = {}) => request("patch", url, data)
 
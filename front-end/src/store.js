@@ -4,4 +4,8 @@ import { UNDEFINED_ID } from "./constants"
 // Connecting a Svelte store to local storage: https://dev.to/danawoodman/svelte-quick-tip-connect-a-store-to-local-storage-4idi
 const storedId = localStorage.getItem("id")
 export const id = writable(storedId || UNDEFINED_ID)
-id.subscribe(newId => localStorage.id = newId)
\ No newline at end of file
+id.subscribe(newId => localStorage.id = newId)
+
+// Session token sent with every request, empty when logged out
+export const token = writable(localStorage.getItem("token") || "")
+token.subscribe(newToken => localStorage.token = newToken)
\ No newline at end of file